@@ -1,21 +1,173 @@
+import time
 from zipline.pipeline import CustomFactor
 import numpy as np
+import pandas as pd
+
 
 class ScoreFactor(CustomFactor):
+    """
+    Serves precomputed scores from a dense sessions x sids array.
+    Call ScoreFactor.set_scores(scores) before attaching the pipeline.
+    """
     window_length = 1
     inputs = []
     dtype = float
     scores = None
 
+    # Dense score array with a trailing all-NaN column for sids without scores
+    values = None
+    session_rows = None
+    sid_index = None
+    nan_row = None
+
+    # Positions of the last seen pipeline asset ordering within sid_index
+    cached_assets = None
+    cached_positions = None
+
+    @classmethod
+    def set_scores(cls, scores, values=None):
+        """
+        Precompute the contiguous score array and the session -> row lookup.
+        values, when given, is scores' values already followed by the all-NaN column, e.g. the
+        memory map from shared_scores.attach_score_values, and is served as is without a copy.
+        """
+        cls.scores = scores
+        if values is None:
+            values = np.ascontiguousarray(scores.values, dtype=np.float64)
+            values = np.hstack([values, np.full((len(values), 1), np.nan)])
+        cls.values = values
+        cls.session_rows = {ts.value: i for i, ts in enumerate(pd.DatetimeIndex(scores.index))}
+        cls.sid_index = pd.Index(scores.columns)
+        cls.nan_row = np.full(cls.values.shape[1], np.nan)
+        cls.cached_assets = None
+        cls.cached_positions = None
+
+    @classmethod
+    def asset_positions(cls, assets):
+        """
+        Column positions of the given sids, with missing sids mapped to the trailing NaN column.
+        """
+        cached = cls.cached_assets
+        if cached is None or not np.array_equal(cached, assets):
+            positions = cls.sid_index.get_indexer(assets)
+            cls.cached_assets = np.asarray(assets).copy()
+            cls.cached_positions = positions  # -1 selects the trailing NaN column
+        return cls.cached_positions
+
     def compute(self, today, assets, out, *inputs):
-        out[:] = ScoreFactor.scores.loc[today].reindex(assets, fill_value=np.nan).values
+        row = ScoreFactor.session_rows.get(pd.Timestamp(today).value)
+        scores = ScoreFactor.values[row] if row is not None else ScoreFactor.nan_row
+        out[:] = scores[ScoreFactor.asset_positions(assets)]
+
 
 class IsFilingDateFactor(CustomFactor):
+    """
+    Flags sessions on which a sid's score changes, i.e. a new filing was scored.
+    Call IsFilingDateFactor.set_scores(scores) with the same frame given to ScoreFactor.
+    """
     window_length = 1
     inputs = []
     dtype = float
     scores = None
 
+    # Filing-event mask packed to one bit per sid and session
+    bitmap = None
+    n_sids = None
+    session_rows = None
+    sid_index = None
+
+    cached_assets = None
+    cached_positions = None
+
+    @classmethod
+    def set_scores(cls, scores):
+        """
+        Compute (scores != scores.shift(1)) & scores.notna() once and store it as a bitmap.
+        """
+        cls.scores = scores
+        values = np.asarray(scores.values, dtype=np.float64)
+        previous = np.vstack([np.full((1, values.shape[1]), np.nan), values[:-1]])
+        is_filing_date = (values != previous) & ~np.isnan(values)
+
+        cls.bitmap = np.packbits(is_filing_date, axis=1)
+        cls.n_sids = values.shape[1]
+        cls.session_rows = {ts.value: i for i, ts in enumerate(pd.DatetimeIndex(scores.index))}
+        cls.sid_index = pd.Index(scores.columns)
+        cls.cached_assets = None
+        cls.cached_positions = None
+
+    @classmethod
+    def asset_positions(cls, assets):
+        cached = cls.cached_assets
+        if cached is None or not np.array_equal(cached, assets):
+            cls.cached_assets = np.asarray(assets).copy()
+            cls.cached_positions = cls.sid_index.get_indexer(assets)
+        return cls.cached_positions
+
     def compute(self, today, assets, out, *inputs):
-        is_filing_date = ((ScoreFactor.scores != ScoreFactor.scores.shift(1)) & ScoreFactor.scores.notna())
-        out[:] = is_filing_date.loc[today].reindex(assets, fill_value=np.nan).values
\ No newline at end of file
+        positions = IsFilingDateFactor.asset_positions(assets)
+        row = IsFilingDateFactor.session_rows.get(pd.Timestamp(today).value)
+        if row is None:
+            out[:] = np.nan
+            return
+
+        flags = np.unpackbits(IsFilingDateFactor.bitmap[row], count=IsFilingDateFactor.n_sids)
+        out[:] = np.where(positions >= 0, flags[positions], np.nan)
+
+
+def benchmark_score_factor(n_years=15, n_sids=500, n_universe=3000):
+    """
+    Time ScoreFactor through SimplePipelineEngine.run_chunked_pipeline over n_years of sessions for
+    an S&P 500 sized score matrix, against the previous loc/reindex implementation. The assets and
+    closes are synthetic, so no bundle is needed.
+    """
+    import sqlalchemy as sa
+    from zipline.assets import AssetDBWriter, AssetFinder
+    from zipline.assets.synthetic import make_simple_equity_info
+    from zipline.pipeline import Pipeline
+    from zipline.pipeline.data import USEquityPricing
+    from zipline.pipeline.domain import US_EQUITIES
+    from zipline.pipeline.engine import SimplePipelineEngine
+    from zipline.pipeline.loaders.frame import DataFrameLoader
+
+    sessions = US_EQUITIES.all_sessions()
+    sessions = sessions[sessions >= pd.Timestamp('2008-01-01', tz=sessions.tz)][:252 * n_years]
+    sids = np.sort(np.random.choice(n_universe, n_sids, replace=False))
+    scores = pd.DataFrame(np.random.randn(len(sessions), n_sids), index=sessions, columns=sids)
+
+    asset_engine = sa.create_engine('sqlite://')
+    AssetDBWriter(asset_engine).write(
+        equities=make_simple_equity_info(np.arange(n_universe), sessions[0], sessions[-1], exchange='NYSE'),
+        exchanges=pd.DataFrame({'exchange': ['NYSE'], 'canonical_name': ['NYSE'], 'country_code': ['US']}))
+    closes = pd.DataFrame(20 + np.random.rand(len(sessions), n_universe), index=sessions,
+                          columns=np.arange(n_universe))
+    close_loader = DataFrameLoader(USEquityPricing.close, closes)
+    pipeline_engine = SimplePipelineEngine(lambda column: close_loader, AssetFinder(asset_engine),
+                                           default_domain=US_EQUITIES)
+
+    class LegacyScoreFactor(CustomFactor):
+        window_length = 1
+        inputs = []
+
+        def compute(self, today, assets, out):
+            out[:] = scores.loc[today].reindex(assets, fill_value=np.nan).values
+
+    def timed_run(factor):
+        pipeline = Pipeline(columns={'score': factor()}, screen=USEquityPricing.close.latest.notnull(),
+                            domain=US_EQUITIES)
+        start = time.perf_counter()
+        output = pipeline_engine.run_chunked_pipeline(pipeline, sessions[1], sessions[-1], chunksize=252)
+        return time.perf_counter() - start, output['score']
+
+    legacy_seconds, legacy_out = timed_run(LegacyScoreFactor)
+    ScoreFactor.set_scores(scores)
+    dense_seconds, dense_out = timed_run(ScoreFactor)
+
+    assert np.allclose(legacy_out.values, dense_out.values, equal_nan=True)
+    print(f'run_pipeline over {len(sessions) - 1} sessions x {n_universe} assets: loc/reindex {legacy_seconds:.2f}s, '
+          f'dense {dense_seconds:.2f}s, speedup {legacy_seconds / dense_seconds:.1f}x')
+    return legacy_seconds, dense_seconds
+
+
+if __name__ == "__main__":
+    benchmark_score_factor()
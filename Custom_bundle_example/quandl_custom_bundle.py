@@ -1,5 +1,10 @@
+import time
+import tempfile
+import bcolz
 import pandas as pd
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 import numpy as np
 from tqdm import tqdm
@@ -13,21 +18,67 @@ hist_data_name = "QUOTEMEDIA_PRICES_247f636d651d8ef83d8ca1e756cf5ee4.csv"
 ticker_data_name = 'QUOTEMEDIA_TICKERS_6d75499fefd916e54334b292986eafcc.csv'
 idx = pd.IndexSlice
 
+# Threads building per-sid frames and how many frames may wait ahead of the bar writer
+prefetch_workers = 4
+prefetch_depth = 64
+
+# Environment variable naming a price file whose new rows are appended to the latest ingestion
+incremental_source_env = 'QUANDL_INCREMENTAL_SOURCE'
+source_fields = ['adj_open', 'adj_high', 'adj_low', 'adj_close', 'adj_volume']
+bar_fields = ['open', 'high', 'low', 'close', 'volume']
+
 
 def load_equities():
     return pd.read_hdf(custom_data_path / 'quandl.h5', 'equities')
 
 
-def ticker_generator():
+def ticker_generator(equities=None):
     """
     Lazily return (sid, ticker) tuple
     """
-    return (v for v in load_equities().values)
+    equities = load_equities() if equities is None else equities
+    return (v for v in equities.values)
+
+
+def load_prices():
+    """
+    Return the sid-sorted price frame and each sid's (start, stop) row range
+    """
+    with pd.HDFStore(custom_data_path / 'quandl.h5', mode='r') as store:
+        return store['prices'], store['price_offsets']
 
 
-def data_generator():
-    for sid, symbol, exchange_, asset_name in ticker_generator():
-        df = pd.read_hdf(custom_data_path / 'quandl.h5', 'prices/{}'.format(sid))
+def prefetch(function, items, n_workers=prefetch_workers, depth=prefetch_depth):
+    """
+    Yield function(item) for each item in order, computing up to depth results ahead on a thread pool
+    so the consumer overlaps with the work. n_workers=0 runs serially.
+    """
+    if n_workers == 0:
+        yield from map(function, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def data_generator(equities=None, n_workers=prefetch_workers, depth=prefetch_depth, convert=None):
+    """
+    Yield the per-sid bar frames and metadata, built ahead of the consumer by the prefetch queue.
+    convert, e.g. the bar writer's to_ctable, is applied to each frame on the prefetch threads.
+    """
+    prices, offsets = load_prices()
+
+    def read_sid(row):
+        sid, symbol, exchange_, asset_name = row
+        start, stop = offsets.loc[sid]
+        df = prices.iloc[start:stop].set_index('date')
+        df.index.name = None
         df.columns = ['open', 'high', 'low', 'close', 'volume']
         start_date = df.index[0]
         end_date = df.index[-1]
@@ -36,10 +87,14 @@ def data_generator():
         auto_close_date = end_date + pd.Timedelta(days=1)
         exchange = 'NYSE'
 
-        yield (sid, df), symbol, asset_name, start_date, end_date, first_traded, auto_close_date, exchange
+        if convert is not None:
+            df = convert(df)
+        return (sid, df), symbol, asset_name, start_date, end_date, first_traded, auto_close_date, exchange
+
+    return prefetch(read_sid, ticker_generator(equities), n_workers, depth)
 
 
-def metadata_frame():
+def metadata_frame(equities=None):
     dtype = [
         ('symbol', 'object'),
         ('asset_name', 'object'),
@@ -48,7 +103,156 @@ def metadata_frame():
         ('first_traded', 'datetime64[ns]'),
         ('auto_close_date', 'datetime64[ns]'),
         ('exchange', 'object')]
-    return pd.DataFrame(np.empty(len(load_equities()), dtype=dtype))
+    equities = load_equities() if equities is None else equities
+    return pd.DataFrame(np.empty(len(equities), dtype=dtype))
+
+
+def previous_ingestion(output_dir):
+    """
+    Return the daily bar table of the latest earlier ingestion of this bundle, or None
+    """
+    output_dir = Path(output_dir)
+    if not output_dir.parent.exists():
+        return None
+    # Ingestion directories are named by timestamp, so they sort chronologically
+    ingestions = sorted(path for path in output_dir.parent.iterdir()
+                        if path.name != output_dir.name and (path / 'daily_equities.bcolz').exists())
+    return ingestions[-1] / 'daily_equities.bcolz' if ingestions else None
+
+
+def read_daily_bars(path):
+    """
+    Return the columns and attributes of a daily bar table
+    """
+    table = bcolz.ctable(rootdir=str(path), mode='r')
+    columns = {name: table[name][:] for name in table.names}
+    attrs = {key: table.attrs[key] for key in ['first_trading_day', 'first_row', 'last_row', 'calendar_offset',
+                                               'calendar_name', 'start_session_ns', 'end_session_ns']}
+    return columns, attrs
+
+
+def read_new_rows(source, equities, after, chunksize=1_000_000):
+    """
+    Read the rows of the price file dated after the given session, with sids looked up by ticker.
+    Tickers missing from equities are new listings and need a full ingest.
+    """
+    frames = []
+    for chunk in pd.read_csv(source, usecols=['ticker', 'date'] + source_fields, chunksize=chunksize):
+        dates = pd.to_datetime(chunk['date'], format='%Y-%m-%d')
+        keep = (dates > after).values
+        if keep.any():
+            frames.append(chunk[keep].assign(date=dates[keep]))
+    if not frames:
+        return pd.DataFrame(columns=['sid', 'date'] + bar_fields)
+
+    rows = pd.concat(frames, ignore_index=True).rename(columns=dict(zip(source_fields, bar_fields)))
+    unknown = ~rows.ticker.isin(equities.ticker)
+    if unknown.any():
+        print(f'Skipping {rows.ticker[unknown].nunique()} tickers not in quandl.h5, run a full ingest to add them')
+    rows = rows.merge(equities[['sid', 'ticker']], on='ticker')
+    return rows.drop_duplicates(['sid', 'date'], keep='last').sort_values(['sid', 'date'])[['sid', 'date'] + bar_fields]
+
+
+def append_bars(columns, first_row, last_row, new_days, new_bars, present):
+    """
+    Append sessions to each sid's block of a sid-major daily bar table.
+    first_row and last_row hold each sid's (inclusive) row range, new_days the appended sessions in the
+    table's epoch seconds, and new_bars a sids x sessions array per bar column in the table's units,
+    valid where present. Missing bars are forward-filled from the sid's previous bar, as the full
+    build fills them, and sessions a sid already holds are skipped.
+    Returns the new columns and row ranges.
+    """
+    last_day = columns['day'][last_row]
+    append = new_days[None, :] > last_day[:, None]
+    counts = append.sum(axis=1)
+
+    # Seed each sid's fill with its last stored bar
+    rows = np.where(np.concatenate([np.ones((len(last_row), 1), bool), present & append], axis=1),
+                    np.arange(len(new_days) + 1), 0)
+    np.maximum.accumulate(rows, axis=1, out=rows)
+    sid_pos = np.arange(len(last_row))[:, None]
+
+    # Sids in table order, so each block's new rows land right after it
+    order = np.argsort(first_row, kind='stable')
+    positions = np.repeat(last_row[order] + 1, counts[order])
+    appended = {}
+    for name, values in columns.items():
+        if name == 'day':
+            panel = np.broadcast_to(new_days, append.shape)
+        elif name == 'id':
+            panel = np.broadcast_to(values[last_row][:, None], append.shape)
+        else:
+            seeded = np.concatenate([values[last_row][:, None], new_bars[name].astype(values.dtype)], axis=1)
+            panel = seeded[sid_pos, rows][:, 1:]
+        appended[name] = np.insert(values, positions, panel[order][append[order]].astype(values.dtype))
+
+    shift = np.empty_like(counts)
+    shift[order] = np.cumsum(counts[order]) - counts[order]
+    return appended, first_row + shift, last_row + shift + counts
+
+
+def append_ingestion(previous, source, equities, daily_bar_writer, calendar):
+    """
+    Write the previous ingestion's daily bars plus the new rows of source to daily_bar_writer's table
+    and return the asset metadata with the extended end dates. Only the new rows are parsed and
+    converted; the stored bars are copied as arrays.
+    The table is written to the writer's private _filename: zipline points the writer into a temporary
+    working directory that only replaces output_dir after ingest returns, and exposes no public path for it.
+    """
+    started = time.perf_counter()
+    columns, attrs = read_daily_bars(previous)
+    sids = np.array(sorted(attrs['first_row'], key=int))
+    first_row = np.array([attrs['first_row'][sid] for sid in sids])
+    last_row = np.array([attrs['last_row'][sid] for sid in sids])
+    sids = sids.astype(np.int64)
+
+    last_day = pd.to_datetime(columns['day'][last_row], unit='s')
+    rows = read_new_rows(source, equities, last_day.min())
+    new_end = max(last_day.max(), rows.date.max()) if len(rows) else last_day.max()
+    sessions = pd.DatetimeIndex([])
+    if new_end > last_day.min():
+        first_new = last_day.min() + pd.Timedelta(days=1)
+        sessions = pd.DatetimeIndex(calendar.sessions_in_range(first_new.strftime('%Y-%m-%d'),
+                                                               new_end.strftime('%Y-%m-%d')))
+        sessions = sessions.tz_localize(None) if sessions.tz is not None else sessions
+
+    # Convert with the writer's own scaling and winsorising, then scatter into sids x sessions
+    sid_pos = pd.Index(sids).get_indexer(rows.sid)
+    session_pos = sessions.get_indexer(pd.DatetimeIndex(rows.date))
+    keep = (sid_pos >= 0) & (session_pos >= 0)
+    present = np.zeros((len(sids), len(sessions)), bool)
+    present[sid_pos[keep], session_pos[keep]] = True
+    new_bars = {name: np.zeros(present.shape, columns[name].dtype) for name in bar_fields}
+    if keep.any():
+        bars = daily_bar_writer.to_ctable(rows[keep].set_index('date')[bar_fields], 'warn')
+        for name in bar_fields:
+            new_bars[name][sid_pos[keep], session_pos[keep]] = bars[name][:]
+
+    new_days = (sessions.values.astype('datetime64[s]').astype(np.int64)).astype(columns['day'].dtype)
+    columns, first_row, last_row = append_bars(columns, first_row, last_row, new_days, new_bars, present)
+
+    table = bcolz.ctable(columns=list(columns.values()), names=list(columns), rootdir=daily_bar_writer._filename,
+                         mode='w')
+    attrs['first_row'] = {str(sid): int(row) for sid, row in zip(sids, first_row)}
+    attrs['last_row'] = {str(sid): int(row) for sid, row in zip(sids, last_row)}
+    attrs['end_session_ns'] = max(attrs['end_session_ns'], pd.Timestamp(new_end).value)
+    for key, value in attrs.items():
+        table.attrs[key] = value
+    table.flush()
+
+    start_date = pd.to_datetime(columns['day'][first_row], unit='s')
+    end_date = pd.to_datetime(columns['day'][last_row], unit='s')
+    names = equities.set_index('sid').reindex(sids)
+    metadata = pd.DataFrame({'symbol': names.ticker.values,
+                             'asset_name': names.iloc[:, -1].values,
+                             'start_date': start_date,
+                             'end_date': end_date,
+                             'first_traded': start_date,
+                             'auto_close_date': end_date + pd.Timedelta(days=1),
+                             'exchange': 'NYSE'}, index=pd.Index(sids, name='sid'))
+    print(f'Appended {len(sessions)} sessions, {len(rows)} source rows to {len(sids)} sids '
+          f'in {time.perf_counter() - started:.1f}s')
+    return metadata
 
 
 def quandl_to_bundle(interval='1d'):
@@ -64,13 +268,25 @@ def quandl_to_bundle(interval='1d'):
                show_progress,
                output_dir
                ):
-        metadata = metadata_frame()
+        equities = load_equities()
+        source = environ.get(incremental_source_env)
+        previous = previous_ingestion(output_dir) if source else None
 
-        def daily_data_generator():
-            return (sid_df for (sid_df, *metadata.iloc[sid_df[0]]) in data_generator())
+        if previous is not None:
+            # Incremental: append the source's new sessions to the latest ingestion
+            metadata = append_ingestion(previous, Path(source).expanduser(), equities, daily_bar_writer, calendar)
+        else:
+            metadata = metadata_frame(equities)
 
-        daily_bar_writer.write(daily_data_generator(), show_progress=True)
-        metadata.dropna(inplace=True)
+            def to_ctable(df):
+                # The writer passes ctables through, so the conversion runs on the prefetch threads
+                return daily_bar_writer.to_ctable(df, 'warn')
+
+            def daily_data_generator():
+                return (sid_df for (sid_df, *metadata.iloc[sid_df[0]]) in data_generator(equities, convert=to_ctable))
+
+            daily_bar_writer.write(daily_data_generator(), show_progress=True)
+            metadata.dropna(inplace=True)
         exchange = {'exchange': 'NYSE', 'canonical_name': 'NYSE', 'country_code': 'US'}
         exchange_df = pd.DataFrame(exchange, index=[0])
         asset_db_writer.write(equities=metadata, exchanges=exchange_df)
@@ -86,3 +302,74 @@ def quandl_to_bundle(interval='1d'):
         adjustment_writer.write()
 
     return ingest
+
+
+def _legacy_data_generator(equities, path):
+    # Previous reader: one read_hdf of a table-format node per sid, on the consumer thread
+    for sid, symbol, exchange_, asset_name in equities.values:
+        df = pd.read_hdf(path, 'prices/{}'.format(sid))
+        df.columns = ['open', 'high', 'low', 'close', 'volume']
+        yield sid, df
+
+
+def benchmark_ingest(n_sids=3000, n_workers=4, start='2008-01-10', end='2022-12-30'):
+    """
+    Time the daily bar write of a synthetic store with n_sids sids: per-sid table nodes read
+    serially, the bulk layout read serially, and the bulk layout through the prefetch queue.
+    """
+    global custom_data_path
+    from zipline.data.bcolz_daily_bars import BcolzDailyBarWriter
+    from zipline.utils.calendar_utils import get_calendar
+
+    calendar = get_calendar('NYSE')
+    sessions = calendar.sessions_in_range(pd.Timestamp(start), pd.Timestamp(end))
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        saved_path, custom_data_path = custom_data_path, Path(tmp_dir)
+        try:
+            # Each sid trades a contiguous block of sessions
+            bounds = np.sort(rng.integers(0, len(sessions), (n_sids, 2)), axis=1)
+            bounds[:, 1] += 1
+            lengths = bounds[:, 1] - bounds[:, 0]
+            dates = np.concatenate([sessions.values[a:b] for a, b in bounds])
+            prices = pd.DataFrame({'date': dates})
+            for field in ['adj_open', 'adj_high', 'adj_low', 'adj_close']:
+                prices[field] = (rng.random(len(dates)) * 100).astype('float32')
+            prices['adj_volume'] = rng.integers(0, 10_000_000, len(dates)).astype('int32')
+            stops = np.cumsum(lengths)
+            starts = stops - lengths
+            offsets = pd.DataFrame({'start': starts, 'stop': stops}, index=pd.Index(np.arange(n_sids), name='sid'))
+            equities = pd.DataFrame({'sid': np.arange(n_sids), 'ticker': [f'T{i:05d}' for i in range(n_sids)],
+                                     'exchange': 'NYSE', 'name': [f'Company {i}' for i in range(n_sids)]})
+            with pd.HDFStore(custom_data_path / 'quandl.h5', mode='w') as store:
+                store.put('equities', equities, format='t')
+                store.put('prices', prices, format='fixed')
+                store.put('price_offsets', offsets, format='fixed')
+            # The previous layout lives in its own file, as its prices/<sid> nodes would clash with prices
+            legacy_path = custom_data_path / 'quandl_per_sid.h5'
+            with pd.HDFStore(legacy_path, mode='w') as store:
+                for sid in range(n_sids):
+                    store.put(f'prices/{sid}', prices.iloc[starts[sid]:stops[sid]].set_index('date'), format='t')
+
+            runs = [('per-sid read_hdf', lambda writer: _legacy_data_generator(equities, legacy_path)),
+                    ('bulk, serial', lambda writer: data_generator(equities, n_workers=0)),
+                    (f'bulk, {n_workers} prefetch threads',
+                     lambda writer: data_generator(equities, n_workers=n_workers,
+                                                   convert=lambda df: writer.to_ctable(df, 'warn')))]
+            timings = {}
+            for i, (name, generator) in enumerate(runs):
+                writer = BcolzDailyBarWriter(str(Path(tmp_dir, f'daily_{i}.bcolz')), calendar,
+                                             sessions[0], sessions[-1])
+                started = time.perf_counter()
+                items = generator(writer)
+                writer.write(item if i == 0 else item[0] for item in items)
+                timings[name] = time.perf_counter() - started
+                print(f'{n_sids} sids, {name}: {timings[name]:.1f}s')
+        finally:
+            custom_data_path = saved_path
+    return timings
+
+
+if __name__ == '__main__':
+    benchmark_ingest()
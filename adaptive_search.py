@@ -0,0 +1,318 @@
+import os
+import copy
+import math
+import json
+import random
+import argparse
+import itertools
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from config import Backtest_Setting
+from run_catalog import pending_settings, query_runs, settings_hash
+
+# Backtest_Setting fields the search varies
+search_params = ['lookback', 'holdingdays', 'N_LONGS', 'N_SHORTS', 'lag', 'days_offset']
+
+# Directory receiving one sub-directory of trial records per search
+search_dir = "./plots/search"
+
+
+def window_start(start_date, end_date, fraction):
+    """
+    Start of the trailing window covering the given fraction of start_date..end_date.
+    """
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    return (end - (end - start) * fraction).strftime('%Y-%m-%d')
+
+
+def make_setting(base, params, fraction):
+    """
+    Copy of the base setting with the searched parameters set and the dates cut to the trailing window.
+    """
+    setting = copy.copy(base)
+    for name, value in params.items():
+        setattr(setting, name, value)
+    if fraction < 1:
+        setting.start_date = window_start(base.start_date, base.end_date, fraction)
+    return setting
+
+
+class RandomSampler(object):
+    """
+    Draw configs uniformly from the grid without repeating one until the grid is exhausted.
+    """
+
+    def __init__(self, space, seed=0):
+        self.grid = [dict(zip(space, values)) for values in itertools.product(*space.values())]
+        self.rng = random.Random(seed)
+        self.unused = []
+
+    def sample(self, n):
+        configs = []
+        while len(configs) < min(n, len(self.grid)):
+            if not self.unused:
+                self.unused = self.rng.sample(self.grid, len(self.grid))
+            config = self.unused.pop()
+            if config not in configs:
+                configs.append(config)
+        return [(config, None) for config in configs]
+
+    def tell(self, token, value):
+        pass
+
+
+class TPESampler(object):
+    """
+    Model-based sampler: optuna's Tree-structured Parzen Estimator proposes configs from the results
+    of earlier brackets. Requires optuna.
+    """
+
+    def __init__(self, space, seed=0, lower_is_better=False):
+        try:
+            import optuna
+        except ImportError:
+            raise ImportError("The tpe sampler requires optuna: pip install optuna")
+        optuna.logging.set_verbosity(optuna.logging.WARNING)
+        self.optuna = optuna
+        self.space = space
+        self.study = optuna.create_study(direction='minimize' if lower_is_better else 'maximize',
+                                         sampler=optuna.samplers.TPESampler(seed=seed))
+
+    def sample(self, n):
+        configs = []
+        for _ in range(n):
+            trial = self.study.ask()
+            configs.append(({name: trial.suggest_categorical(name, values) for name, values in self.space.items()},
+                            trial))
+        return configs
+
+    def tell(self, token, value):
+        # Configs whose runs failed are reported as failed trials
+        if np.isnan(value):
+            self.study.tell(token, state=self.optuna.trial.TrialState.FAIL)
+        else:
+            self.study.tell(token, value)
+
+
+def catalog_metric(settings, metric, engine=None):
+    """
+    Latest value of the metric recorded in the run catalog for each setting, NaN when it has none.
+    Only runs with engine count when it is given.
+    """
+    hashes = [settings_hash(setting) for setting in settings]
+    filters = {'settings_hash': sorted(set(hashes))}
+    if engine is not None:
+        filters['engine'] = engine
+    runs = query_runs(filters, order_by='created_at', columns=['settings_hash', metric])
+    values = runs.drop_duplicates('settings_hash', keep='last').set_index('settings_hash')[metric].astype(float)
+    return [float(values.get(key, np.nan)) for key in hashes]
+
+
+def successive_halving(configs, base, run_settings, metric, bracket, min_fraction, eta, lower_is_better,
+                       trials, budget_left, engine=None):
+    """
+    Evaluate configs on a trailing window of min_fraction of the date range, keep the best 1/eta
+    and re-evaluate them on a window eta times longer, until the full range. Returns the compute
+    spent in full-range run equivalents and each config's last value. Stops early when the next
+    rung would exceed budget_left.
+    """
+    spent = 0.0
+    values = [np.nan] * len(configs)
+    alive = list(range(len(configs)))
+    n_rungs = int(round(math.log(1 / min_fraction, eta))) + 1
+    for rung in range(n_rungs):
+        fraction = min(1.0, min_fraction * eta ** rung)
+        if spent + len(alive) * fraction > budget_left + 1e-9:
+            print(f"Budget exhausted before rung {rung} of bracket {bracket}")
+            break
+
+        settings = [make_setting(base, configs[i], fraction) for i in alive]
+        run_settings(pending_settings(settings, engine=engine))
+        spent += len(alive) * fraction
+        rung_values = catalog_metric(settings, metric, engine)
+
+        for i, setting, value in zip(alive, settings, rung_values):
+            values[i] = value
+            trials.append({'bracket': bracket, 'rung': rung, 'fraction': fraction, **configs[i],
+                           'start_date': setting.start_date, 'end_date': setting.end_date,
+                           'settings_hash': settings_hash(setting), metric: value})
+
+        # Promote the best 1/eta; failed runs (NaN) rank last
+        keys = [(-np.inf if np.isnan(v) else (-v if lower_is_better else v)) for v in rung_values]
+        order = sorted(range(len(alive)), key=lambda j: keys[j], reverse=True)
+        alive = [alive[j] for j in order[:max(1, len(alive) // eta)]]
+    return spent, values
+
+
+def search(base, space, run_settings, metric='sharpe', mode='hyperband', eta=3, min_fraction=1 / 9,
+           budget=None, sampler='random', lower_is_better=False, seed=0, output_dir=None, engine=None):
+    """
+    Adaptive search over the Backtest_Setting parameters in space ({name: list of values}).
+
+    Each bracket samples configs, evaluates them on short trailing windows of the
+    start_date..end_date range and promotes the best to longer windows up to the full range
+    (successive halving). mode='hyperband' runs brackets from the most aggressive (many configs,
+    windows of min_fraction) to a plain full-range evaluation; mode='halving' runs the first only.
+    run_settings(settings) runs a list of Backtest_Setting and records them in the run catalog,
+    where the metric is read back from the runs made with engine (any engine when None).
+    budget caps compute in full-range run equivalents.
+    sampler is 'random' or 'tpe' (model-based, requires optuna).
+    Every trial is written to output_dir/trials.csv. Returns the trials DataFrame, best first
+    among full-range trials.
+    """
+    output_dir = output_dir or os.path.join(search_dir, datetime.now().strftime('%Y%m%d_%H%M%S'))
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'search.json'), 'w') as f:
+        json.dump({'space': space, 'metric': metric, 'mode': mode, 'eta': eta, 'min_fraction': min_fraction,
+                   'budget': budget, 'sampler': sampler, 'lower_is_better': lower_is_better, 'seed': seed,
+                   'engine': engine,
+                   'start_date': base.start_date, 'end_date': base.end_date}, f, indent=4)
+
+    if sampler == 'tpe':
+        proposer = TPESampler(space, seed=seed, lower_is_better=lower_is_better)
+    else:
+        proposer = RandomSampler(space, seed=seed)
+
+    s_max = int(round(math.log(1 / min_fraction, eta)))
+    brackets = range(s_max, -1, -1) if mode == 'hyperband' else [s_max]
+    budget_left = np.inf if budget is None else budget
+    trials = []
+    for s in brackets:
+        n_configs = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        proposals = proposer.sample(n_configs)
+        configs = [config for config, _ in proposals]
+        print(f"Bracket {s}: {len(configs)} configs from {eta ** -s:.3f} of the date range")
+        spent, values = successive_halving(configs, base, run_settings, metric, s, eta ** -s, eta,
+                                           lower_is_better, trials, budget_left, engine)
+        budget_left -= spent
+        for (_, token), value in zip(proposals, values):
+            proposer.tell(token, value)
+
+        pd.DataFrame(trials).to_csv(os.path.join(output_dir, 'trials.csv'), index=False)
+        if budget_left <= 0:
+            break
+
+    trials = pd.DataFrame(trials)
+    if len(trials):
+        trials = trials.sort_values(['fraction', metric], ascending=[False, lower_is_better])
+        best = trials.iloc[0]
+        print(f"Best {metric} {best[metric]:.4f} on {best['fraction']:.3f} of the range: "
+              + ' '.join(f'{name}={best[name]}' for name in space))
+    print(f"{len(trials)} trials recorded in {output_dir}/trials.csv")
+    return trials
+
+
+def parse_args():
+    """
+    Parse command-line arguments: the fixed settings, the searched parameter options and the search controls.
+    """
+    parser = argparse.ArgumentParser(description="Adaptive search over backtest parameters")
+
+    # Basic settings
+    parser.add_argument("--start-date", type=str, default="2008-01-10", help="Backtest start date (YYYY-MM-DD)")
+    parser.add_argument("--end-date", type=str, default="2022-12-31", help="Backtest end date (YYYY-MM-DD)")
+    parser.add_argument("--fiscal-start-year", type=int, default=2007, help="Fiscal start year")
+    parser.add_argument("--fiscal-end-year", type=int, default=2022, help="Fiscal end year")
+    parser.add_argument("--source", type=str, choices=["10kq", "mdna", "call transcripts"], default="mdna",
+                        help="Source of the data")
+    parser.add_argument("--score", type=str, default="datascore", help="Score used in the backtest")
+    parser.add_argument("--primaryindex", type=str, choices=["S&P 500", "Russell 2000", "Russell 1000"],
+                        default="S&P 500", help="Primary index (e.g., S&P 500, Russell 2000)")
+    parser.add_argument("--exit-mode", type=str, choices=["Rebalance", "EventBased"], default="Rebalance",
+                        help="Exit mode")
+    parser.add_argument("--up-cutoff", type=float, default=0.5, help="Upper cutoff for rankings")
+    parser.add_argument("--low-cutoff", type=float, default=0.5, help="Lower cutoff for rankings")
+    parser.add_argument("--initial-cash", type=float, default=1000000, help="Initial cash for the backtest")
+    parser.add_argument("--do-short", action='store_true', help="Enable shorting in the strategy")
+    parser.add_argument("--engine", type=str, choices=["zipline", "vectorized"], default="zipline",
+                        help="Simulation engine (vectorized supports the Rebalance exit mode only)")
+
+    # Searched parameter options
+    parser.add_argument("--lookback-options", type=int, nargs='+', default=[20, 40, 60, 90, 120])
+    parser.add_argument("--holdingdays-options", type=int, nargs='+', default=[80])
+    parser.add_argument("--n-longs-options", type=int, nargs='+', default=[50, 100, 200, 500, 1000])
+    parser.add_argument("--n-shorts-options", type=int, nargs='+', default=[1000])
+    parser.add_argument("--lag-options", type=int, nargs='+', default=[0, 1, 2, 5])
+    parser.add_argument("--days-offset-options", type=int, nargs='+', default=[0, 5, 10, 15])
+
+    # Search controls
+    parser.add_argument("--metric", type=str, default="sharpe", help="Catalog metric to optimize")
+    parser.add_argument("--lower-is-better", action='store_true', help="Minimize the metric instead")
+    parser.add_argument("--mode", type=str, choices=["hyperband", "halving"], default="hyperband")
+    parser.add_argument("--sampler", type=str, choices=["random", "tpe"], default="random",
+                        help="Config sampler; tpe is model-based and requires optuna")
+    parser.add_argument("--eta", type=int, default=3, help="Keep 1/eta of the configs at each rung")
+    parser.add_argument("--min-fraction", type=float, default=1 / 9,
+                        help="Shortest evaluation window as a fraction of the date range")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="Compute budget in full date range backtests (default: unlimited)")
+    parser.add_argument("--seed", type=int, default=0)
+
+    from sweep_scheduler import add_scheduler_args
+    add_scheduler_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    from zipline.data import bundles
+    from zipline.utils.run_algo import load_extensions
+    from utils import load_score
+    from shared_scores import release_scores
+    from sweep_scheduler import run_jobs
+    from backtest_Parallelize_ import run_single_backtest, publish_sweep_scores
+
+    base = Backtest_Setting(
+        start_date=args.start_date,
+        end_date=args.end_date,
+        fiscal_start_year=args.fiscal_start_year,
+        fiscal_end_year=args.fiscal_end_year,
+        source=args.source,
+        score=args.score,
+        primaryindex=args.primaryindex,
+        ExitMode=args.exit_mode,
+        up_cutoff=args.up_cutoff,
+        low_cutoff=args.low_cutoff,
+        initial_cash=args.initial_cash,
+        DoShort=args.do_short,
+    )
+    space = {
+        'lookback': args.lookback_options,
+        'holdingdays': args.holdingdays_options,
+        'N_LONGS': args.n_longs_options,
+        'N_SHORTS': args.n_shorts_options,
+        'lag': args.lag_options,
+        'days_offset': args.days_offset_options,
+    }
+
+    load_extensions(default=True, extensions=[], strict=True, environ=None)
+    bundle_data = bundles.load('quandl_custom_bundle')
+
+    def run_settings(settings):
+        # load_score resolves tickers to assets as of the start date, so each window start gets its own
+        # scores and assets; every config of a rung shares one window, so this loads once per rung
+        by_start = {}
+        for setting in settings:
+            by_start.setdefault(setting.start_date, []).append(setting)
+        for window_settings in by_start.values():
+            scores, assets = load_score(bundle_data, window_settings[0])
+            # Align and share the scores only for the lags and lookbacks of this window
+            scores_handles = publish_sweep_scores(scores, window_settings)
+            del scores
+            try:
+                run_jobs(run_single_backtest,
+                         [(setting, scores_handles, assets, args.engine) for setting in window_settings],
+                         n_workers=args.n_jobs, job_memory_mb=args.job_memory_mb,
+                         memory_budget_mb=args.memory_budget_mb, thread_limit=args.threads_per_job,
+                         timeout=args.job_timeout,
+                         names=[' '.join(f'{name}={getattr(setting, name)}' for name in search_params)
+                                + f' from {setting.start_date}' for setting in window_settings])
+            finally:
+                release_scores(scores_handles)
+
+    search(base, space, run_settings, metric=args.metric, mode=args.mode, eta=args.eta,
+           min_fraction=args.min_fraction, budget=args.budget, sampler=args.sampler,
+           lower_is_better=args.lower_is_better, seed=args.seed, engine=args.engine)
@@ -29,6 +29,8 @@ def parse_args():
     parser.add_argument("--do-short", action='store_true', help="Enable shorting in the strategy")
     parser.add_argument("--do-log", action='store_true', help="Enable logging during the backtest")
     parser.add_argument("--days-offset", type=int, default=10, help="Number of short positions")
+    parser.add_argument("--engine", type=str, choices=["zipline", "vectorized"], default="zipline",
+                        help="Simulation engine (vectorized supports the Rebalance exit mode only)")
 
     args = parser.parse_args()
     return args
@@ -65,4 +67,4 @@ if __name__ == "__main__":
     load_extensions(default=True, extensions=[], strict=True, environ=None)
     bundle_data = bundles.load('quandl_custom_bundle')
     scores, assets = load_score(bundle_data, BacktestSetting)
-    run(BacktestSetting, scores, assets)
+    run(BacktestSetting, scores, assets, engine=args.engine)
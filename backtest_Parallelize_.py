@@ -1,11 +1,15 @@
+import os
 import argparse
-import time
-from joblib import Parallel, delayed
-from main import run
+from main import run, align_scores
 from config import Backtest_Setting
 from zipline.data import bundles
 from utils import load_score
+from shared_scores import publish_aligned_scores, attach_scores, attach_score_values, release_scores, alignment_key
+from sweep_scheduler import add_scheduler_args, run_jobs
+from run_catalog import pending_settings
+from job_queue import coordinate, default_lease_seconds
 from zipline.utils.run_algo import load_extensions
+from zipline.utils.calendar_utils import get_calendar
 
 
 def parse_args():
@@ -44,6 +48,20 @@ def parse_args():
                         help="Number of short positions options (multiple values)")
     parser.add_argument("--do-short", action='store_true', help="Enable shorting in the strategy")
     parser.add_argument("--do-log", action='store_true', help="Enable logging during the backtest")
+    parser.add_argument("--engine", type=str, choices=["zipline", "vectorized"], default="zipline",
+                        help="Simulation engine (vectorized supports the Rebalance exit mode only)")
+    parser.add_argument("--rerun", action='store_true',
+                        help="Run every config, including those the run catalog already has a completed run for")
+    add_scheduler_args(parser)
+
+    # Multi-host execution
+    parser.add_argument("--queue", type=str, default=None,
+                        help="Publish the configs for job_queue.py workers instead of running them here: "
+                             "a shared directory, or tcp://host:port to serve the queue from this process")
+    parser.add_argument("--lease-seconds", type=float, default=default_lease_seconds,
+                        help="Seconds without a worker heartbeat before a job is re-queued")
+    parser.add_argument("--token", type=str, default=os.environ.get('JOB_QUEUE_TOKEN'),
+                        help="Token workers must present to a tcp:// queue (default: $JOB_QUEUE_TOKEN)")
 
     args = parser.parse_args()
     return args
@@ -96,22 +114,33 @@ def create_backtest_settings(args):
     return settings_list
 
 
-def run_single_backtest(BacktestSetting, delay_interval):
+def setting_name(Setting):
     """
-    Run a single backtest with a specified delay interval to avoid resource contention.
+    Short label of a config's swept parameters for progress output.
     """
-    # Introduce the delay before starting the backtest
-    time.sleep(delay_interval)
+    return (f'lookback={Setting.lookback} holdingdays={Setting.holdingdays} N_LONGS={Setting.N_LONGS} '
+            f'N_SHORTS={Setting.N_SHORTS} lag={Setting.lag} days_offset={Setting.days_offset}')
 
-    # Load necessary extensions and data bundle
-    load_extensions(default=True, extensions=[], strict=True, environ=None)
-    bundle_data = bundles.load('quandl_custom_bundle')
 
-    # Load scores and assets for the given settings
-    scores, assets = load_score(bundle_data, BacktestSetting)
+def run_single_backtest(BacktestSetting, scores_handles, assets, engine='zipline'):
+    """
+    Run a single backtest against the aligned score matrix the parent process published for its lag and lookback.
+    """
+    # Map the shared, already aligned score matrix instead of reloading and aligning the scores
+    load_extensions(default=True, extensions=[], strict=True, environ=None)
+    handle = scores_handles[alignment_key(BacktestSetting)]
 
     # Execute the backtest
-    run(BacktestSetting, scores, assets)
+    run(BacktestSetting, attach_scores(handle), assets, engine=engine, score_values_=attach_score_values(handle))
+
+
+def publish_sweep_scores(scores, param_list):
+    """
+    Align the scores once per lag and lookback in the sweep and publish each aligned matrix for the workers.
+    """
+    trading_calendar = get_calendar('NYSE')
+    return publish_aligned_scores(scores, param_list,
+                                  lambda scores, Setting: align_scores(scores, Setting, trading_calendar))
 
 
 if __name__ == "__main__":
@@ -121,9 +150,31 @@ if __name__ == "__main__":
     # Create a list of backtest settings based on the provided parameter ranges
     param_list = create_backtest_settings(args)
 
-    # Define delay interval between backtests to avoid resource contention
-    delay_interval = 10
+    if args.queue:
+        # Workers on any host run the configs; this process waits and records their results
+        coordinate(args.queue, param_list, engine=args.engine, names=[setting_name(p) for p in param_list],
+                   rerun=args.rerun, lease_seconds=args.lease_seconds, token=args.token)
+        raise SystemExit
 
-    # Run the backtests in parallel, introducing a delay for each backtest
-    Parallel(n_jobs=-1)(delayed(run_single_backtest)(
-        params, delay_interval * i) for i, params in enumerate(param_list))
\ No newline at end of file
+    # Collapse duplicate configs and skip those completed by an earlier, possibly interrupted, sweep
+    param_list = pending_settings(param_list, rerun=args.rerun, engine=args.engine)
+    if not param_list:
+        raise SystemExit("Every config already has a completed run")
+
+    # The swept parameters do not affect load_score, so build scores and assets once
+    load_extensions(default=True, extensions=[], strict=True, environ=None)
+    bundle_data = bundles.load('quandl_custom_bundle')
+    scores, assets = load_score(bundle_data, param_list[0])
+
+    # Workers map the aligned matrices instead of each building private aligned and padded copies
+    scores_handles = publish_sweep_scores(scores, param_list)
+    del scores
+
+    try:
+        # Run the backtests within the worker and memory budget, every job mapping the same score matrix
+        run_jobs(run_single_backtest, [(params, scores_handles, assets, args.engine) for params in param_list],
+                 n_workers=args.n_jobs, job_memory_mb=args.job_memory_mb, memory_budget_mb=args.memory_budget_mb,
+                 thread_limit=args.threads_per_job, timeout=args.job_timeout,
+                 names=[setting_name(p) for p in param_list])
+    finally:
+        release_scores(scores_handles)
@@ -1,10 +1,18 @@
 import argparse
+import copy
+import os
 import time
-from joblib import Parallel, delayed
-from main import run
+import uuid
+import pandas as pd
+from datetime import datetime
+from main import run, create_results_dir, save_results
+from run_catalog import record_run, pending_settings, settings_hash
+from results_store import store_name, write_tables
+from sweep_scheduler import add_scheduler_args, run_jobs
+from fast_engine import quantile_cutoffs, run_quantiles
 from config import Backtest_Setting
 from zipline.data import bundles
-from utils import load_score
+from utils import load_score, load_benchmark, save_backtest_setting
 from zipline.utils.run_algo import load_extensions
 
 
@@ -41,6 +49,12 @@ def parse_args():
     parser.add_argument("--do-short", action='store_true', help="Enable shorting in the strategy")
     parser.add_argument("--do-log", action='store_true', help="Enable logging during the backtest")
     parser.add_argument("--days-offset", type=int, default=10, help="Days offset for rebalancing schedule")
+    parser.add_argument("--n-quantiles", type=int, default=10, help="Number of quantile buckets")
+    parser.add_argument("--single-pass", action='store_true',
+                        help="Simulate all buckets in one vectorized pass instead of one zipline run per bucket")
+    parser.add_argument("--rerun", action='store_true',
+                        help="Run every bucket, including those the run catalog already has a completed run for")
+    add_scheduler_args(parser)
 
     args = parser.parse_args()
     return args
@@ -53,7 +67,7 @@ def create_backtest_settings(args):
     settings_list = []
 
     # Define different cutoff pairs for testing
-    cutoffs = [[i / 10, i / 10 + 0.1] for i in range(0, 10)]
+    cutoffs = quantile_cutoffs(args.n_quantiles)
 
     for cutoff_pair in cutoffs:
         setting = Backtest_Setting(
@@ -80,13 +94,14 @@ def create_backtest_settings(args):
     return settings_list
 
 
-def run_single_backtest(BacktestSetting, delay_interval):
+# Decile summaries live outside ./plots/temp, which holds one directory per backtest run
+deciles_dir = "./plots/deciles"
+
+
+def run_single_backtest(BacktestSetting):
     """
-    Run a single backtest with a specified delay.
+    Run a single backtest.
     """
-    # Introduce a delay to avoid overwhelming resources
-    time.sleep(delay_interval)
-
     # Load necessary extensions and data bundle
     load_extensions(default=True, extensions=[], strict=True, environ=None)
     bundle_data = bundles.load('quandl_custom_bundle')
@@ -98,6 +113,60 @@ def run_single_backtest(BacktestSetting, delay_interval):
     run(BacktestSetting, scores, assets)
 
 
+def run_single_pass(param_list, n_quantiles, rerun=False):
+    """
+    Rank once per rebalance date and simulate every bucket together with the vectorized engine.
+    Each bucket without a completed run in the catalog (every bucket when rerun is set) is saved
+    like a separate run, and the bucket returns plus the top-minus-bottom spread are saved as
+    Parquet tables in a summary directory under deciles_dir.
+    """
+    if not param_list[0].ExitMode == 'Rebalance':
+        raise ValueError(f"The single pass uses the vectorized engine, which does not support "
+                         f"ExitMode={param_list[0].ExitMode}")
+
+    pending = {settings_hash(setting) for setting in pending_settings(param_list, rerun=rerun, engine='vectorized')}
+    if not pending:
+        print("Every bucket already has a completed run")
+        return
+
+    load_extensions(default=True, extensions=[], strict=True, environ=None)
+    bundle_data = bundles.load('quandl_custom_bundle')
+
+    # The buckets differ only in their cutoffs, so they share one set of scores
+    scores, assets = load_score(bundle_data, param_list[0])
+    start = time.perf_counter()
+    buckets, spread = run_quantiles(param_list[0], scores, assets, n_quantiles=n_quantiles)
+    # The pass is shared, so each bucket is charged an equal share of its run time
+    runtime_seconds = (time.perf_counter() - start) / len(buckets)
+
+    # Score the buckets against the benchmark, as main.run does
+    try:
+        benchmark = load_benchmark(param_list[0].primaryindex, param_list[0].start_date, param_list[0].end_date)
+    except Exception as e:
+        print(f"Benchmark for {param_list[0].primaryindex} unavailable, skipping beta and alpha: {e}")
+        benchmark = None
+
+    bucket_returns = {}
+    for setting, (cutoffs, results, returns, positions, transactions) in zip(param_list, buckets):
+        bucket_returns[f'{cutoffs[0]:.2f}-{cutoffs[1]:.2f}'] = returns
+        if settings_hash(setting) not in pending:
+            continue
+        results_dir = create_results_dir(setting)
+        save_results(results_dir, results, returns, positions, transactions)
+        record_run(results_dir, setting, returns, results, transactions, runtime_seconds=runtime_seconds,
+                   engine='vectorized', positions=positions, benchmark=benchmark)
+
+    # The summary covers the whole cross-section
+    summary_setting = copy.copy(param_list[0])
+    summary_setting.up_cutoff, summary_setting.low_cutoff = 0, 1
+    summary_dir = os.path.join(deciles_dir, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{uuid.uuid4().hex[:8]}")
+    os.makedirs(summary_dir)
+    save_backtest_setting(summary_setting, summary_dir)
+    write_tables(os.path.join(summary_dir, store_name), {'returns': pd.DataFrame(bucket_returns),
+                                                         'spread': spread.to_frame()})
+    print(f"Decile returns and spread saved to {summary_dir}")
+
+
 if __name__ == "__main__":
     # Parse command-line arguments
     args = parse_args()
@@ -105,9 +174,14 @@ if __name__ == "__main__":
     # Create a list of parameter sets for backtesting
     param_list = create_backtest_settings(args)
 
-    # Define delay interval between parallel backtests
-    delay_interval = 10
-
-    # Run backtests in parallel, introducing a delay for each backtest
-    Parallel(n_jobs=-1)(delayed(run_single_backtest)(
-        params, delay_interval * i) for i, params in enumerate(param_list))
\ No newline at end of file
+    if args.single_pass:
+        run_single_pass(param_list, args.n_quantiles, rerun=args.rerun)
+    else:
+        # Collapse duplicate buckets and skip those completed by an earlier, possibly interrupted, sweep
+        param_list = pending_settings(param_list, rerun=args.rerun, engine='zipline')
+
+        # Run the buckets in parallel within the worker and memory budget
+        run_jobs(run_single_backtest, [(params,) for params in param_list], n_workers=args.n_jobs,
+                 job_memory_mb=args.job_memory_mb, memory_budget_mb=args.memory_budget_mb,
+                 thread_limit=args.threads_per_job, timeout=args.job_timeout,
+                 names=[f'{p.up_cutoff:.2f}-{p.low_cutoff:.2f}' for p in param_list])
\ No newline at end of file
@@ -0,0 +1,13 @@
+import time
+import resource
+
+
+def measure_loader(loader, args, queue):
+    """
+    Run loader(*args) and report (seconds, peak RSS in MB, rows) through queue. Meant to run in a fresh process.
+    """
+    start = time.perf_counter()
+    df = loader(*args)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is reported in kilobytes on Linux
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, len(df)))
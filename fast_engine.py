@@ -0,0 +1,376 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+# zipline and main are imported where they are used, so the simulation core runs without zipline
+from portfolio_orders import round_order_amounts
+
+# Must match the models set in main.initialize
+commission_cost = 0.0005
+
+
+def _naive(index):
+    index = pd.DatetimeIndex(index)
+    return index.tz_convert(None) if index.tz is not None else index
+
+
+def rebalance_sessions(trading_calendar, sessions, days_offset):
+    """
+    Boolean mask over sessions matching date_rules.month_start(days_offset).
+    The n-th session of each month is taken from the full calendar month, so a simulation
+    starting mid-month skips that month if its n-th session falls before the start.
+    """
+    first_session, last_session = _naive([trading_calendar.first_session, trading_calendar.last_session])
+    first = max(sessions[0].replace(day=1), first_session)
+    last = min(sessions[-1] + pd.offsets.MonthEnd(0), last_session)
+    month_sessions = _naive(trading_calendar.sessions_in_range(first, last))
+    by_month = pd.Series(month_sessions, index=month_sessions).groupby(month_sessions.to_period('M'))
+    nth = by_month.nth(days_offset)
+    return np.asarray(sessions.isin(pd.DatetimeIndex(nth.values)))
+
+
+def _load_market(Setting, scores, assets, bundle_name, aligned=False):
+    """
+    Load everything the simulation needs as sessions x sids arrays.
+    aligned marks scores as already aligned with main.align_scores for Setting.
+    """
+    from zipline.data import bundles
+    from zipline.utils.calendar_utils import get_calendar
+    from main import align_scores
+
+    trading_calendar = get_calendar('NYSE')
+    sessions = _naive(trading_calendar.sessions_in_range(pd.Timestamp(Setting.start_date),
+                                                         pd.Timestamp(Setting.end_date)))
+    sessions_utc = sessions.tz_localize('UTC')
+
+    # Load prices and volumes for the universe from the bundle
+    bundle = bundles.load(bundle_name)
+    sids = np.array([asset.sid for asset in assets], dtype=np.int64)
+    close, volume = bundle.equity_daily_bar_reader.load_raw_arrays(
+        ['close', 'volume'], sessions[0], sessions[-1], sids)
+    price = pd.DataFrame(close).ffill().values  # last sale price, as used by data.current(asset, 'price')
+
+    # Asset lifetimes define both the pipeline universe and can_trade. Pipelines build their
+    # lifetimes with include_start_date=False, so an asset joins the universe the session after its
+    # start date, while can_trade is already true on the start date.
+    starts = _naive([asset.start_date for asset in assets]).values
+    ends = _naive([asset.end_date for asset in assets]).values
+    listed = (sessions.values[:, None] >= starts[None, :]) & (sessions.values[:, None] <= ends[None, :])
+    alive = listed & (sessions.values[:, None] > starts[None, :])
+
+    # Scores exactly as seen by ScoreFactor, reindexed to sessions x sids
+    if not aligned:
+        scores = align_scores(scores, Setting, trading_calendar)
+    score_matrix = scores.reindex(index=sessions_utc, columns=sids).values
+
+    return {
+        'trading_calendar': trading_calendar,
+        'sessions': sessions,
+        'sessions_utc': sessions_utc,
+        'close': close,
+        'has_bar': ~np.isnan(close) & (volume > 0),
+        'price': price,
+        'alive': alive,
+        'tradable': listed & ~np.isnan(price),
+        'score_matrix': score_matrix,
+        'is_rebalance': rebalance_sessions(trading_calendar, sessions, Setting.days_offset),
+    }
+
+
+def _simulate_books(Setting, market, select_books, n_books):
+    """
+    Step through sessions for n_books independent portfolios at once.
+
+    select_books(latest_scores) is called once per rebalance with the scores of the live universe
+    (indexed by asset position) and returns one (long_idx, short_idx) pair per book.
+    Each book starts with Setting.initial_cash and trades exactly like main.rebalance.
+    """
+    close, price, has_bar = market['close'], market['price'], market['has_bar']
+    alive, tradable = market['alive'], market['tradable']
+    score_matrix, is_rebalance = market['score_matrix'], market['is_rebalance']
+
+    n_sessions, n_assets = close.shape
+    shares = np.zeros((n_books, n_assets))
+    pending = np.zeros((n_books, n_assets))
+    cash = np.full(n_books, float(Setting.initial_cash))
+    longs = np.zeros(n_books, dtype=np.int64)
+    shorts = np.zeros(n_books, dtype=np.int64)
+
+    portfolio_value = np.empty((n_sessions, n_books))
+    ending_cash = np.empty((n_sessions, n_books))
+    long_exposure = np.zeros((n_sessions, n_books))
+    short_exposure = np.zeros((n_sessions, n_books))
+    long_count = np.zeros((n_sessions, n_books), dtype=np.int64)
+    short_count = np.zeros((n_sessions, n_books), dtype=np.int64)
+    n_longs_series = np.zeros((n_sessions, n_books), dtype=np.int64)
+    n_shorts_series = np.zeros((n_sessions, n_books), dtype=np.int64)
+    # Non-zero position values as (book, session, asset, value) arrays, one entry per session
+    position_rows = []
+    txn_rows = []
+
+    for i in range(n_sessions):
+        # Fill orders left open by the last rebalance at this bar's close
+        book_idx, fill = np.nonzero((pending != 0) & has_bar[i])
+        if len(fill):
+            fill_price = close[i, fill]
+            amount = pending[book_idx, fill]
+            commission = np.maximum(fill_price * amount * commission_cost, 0)
+            np.subtract.at(cash, book_idx, fill_price * amount + commission)
+            shares[book_idx, fill] += amount
+            pending[book_idx, fill] = 0
+            txn_rows.append((book_idx, np.full(len(fill), i), fill, amount, fill_price, commission))
+
+        held = shares != 0
+        value_today = np.where(held, shares * np.nan_to_num(price[i]), 0.0)
+        pv = cash + value_today.sum(axis=1)
+
+        if is_rebalance[i]:
+            # Cancel stale orders, then diff current holdings against the new targets
+            pending[:] = 0
+            universe = np.flatnonzero(alive[i])
+            latest_scores = pd.Series(score_matrix[i, universe], index=universe)
+
+            for b, (long_idx, short_idx) in enumerate(select_books(latest_scores)):
+                longs[b], shorts[b] = len(long_idx), len(short_idx)
+
+                in_plan = np.zeros(n_assets, dtype=bool)
+                in_plan[long_idx] = True
+                in_plan[short_idx] = True
+
+                targets = np.full(n_assets, np.nan)
+                if longs[b] > 0:
+                    targets[long_idx] = int(1 / longs[b] * pv[b])
+                if shorts[b] > 0:
+                    targets[short_idx] = int(-1 / shorts[b] * pv[b])
+
+                close_idx = held[b] & ~in_plan & tradable[i]
+                pending[b, close_idx] = round_order_amounts(-shares[b, close_idx])
+
+                open_idx = in_plan & tradable[i]
+                pending[b, open_idx] = round_order_amounts(targets[open_idx] / price[i, open_idx] - shares[b, open_idx])
+
+        portfolio_value[i] = pv
+        ending_cash[i] = cash
+        long_exposure[i] = np.where(value_today > 0, value_today, 0).sum(axis=1)
+        short_exposure[i] = -np.where(value_today < 0, value_today, 0).sum(axis=1)
+        long_count[i] = (value_today > 0).sum(axis=1)
+        short_count[i] = (value_today < 0).sum(axis=1)
+        book_idx, asset_idx = np.nonzero(value_today)
+        position_rows.append((book_idx, np.full(len(book_idx), i), asset_idx, value_today[book_idx, asset_idx]))
+        n_longs_series[i] = longs
+        n_shorts_series[i] = shorts
+
+    return {
+        'portfolio_value': portfolio_value,
+        'ending_cash': ending_cash,
+        'long_exposure': long_exposure,
+        'short_exposure': short_exposure,
+        'long_count': long_count,
+        'short_count': short_count,
+        'position_rows': position_rows,
+        'longs': n_longs_series,
+        'shorts': n_shorts_series,
+        'txn_rows': txn_rows,
+    }
+
+
+def _book_frames(Setting, market, books, assets, b):
+    """
+    Build (results, returns, positions, transactions) for book b in the layout of main.simulate.
+    """
+    sessions_utc = market['sessions_utc']
+    portfolio_value = books['portfolio_value'][:, b]
+    ending_cash = books['ending_cash'][:, b]
+
+    returns = pd.Series(portfolio_value, index=sessions_utc).pct_change()
+    returns.iloc[0] = portfolio_value[0] / Setting.initial_cash - 1
+    returns.name = 'returns'
+
+    # Positions in pyfolio layout: one column per asset held at any point, plus cash
+    book_idx, day_idx, asset_idx, values = (np.concatenate(parts) for parts in zip(*books['position_rows']))
+    mask = book_idx == b
+    day_idx, asset_idx, values = day_idx[mask], asset_idx[mask], values[mask]
+    ever_held, columns = np.unique(asset_idx, return_inverse=True)
+    position_values = np.zeros((len(sessions_utc), len(ever_held)))
+    position_values[day_idx, columns] = values
+    positions = pd.DataFrame(position_values, index=sessions_utc, columns=[assets[j] for j in ever_held])
+    positions['cash'] = ending_cash
+
+    txn_rows = []
+    for book_idx, *parts in books['txn_rows']:
+        mask = book_idx == b
+        if mask.any():
+            txn_rows.append(tuple(part[mask] for part in parts))
+    transactions = _transaction_frame(txn_rows, market['trading_calendar'], market['sessions'], assets)
+
+    # Daily exposure, matching main.record_vars
+    long_exposure = books['long_exposure'][:, b]
+    short_exposure = books['short_exposure'][:, b]
+    gross_exposure = long_exposure + short_exposure
+
+    results = pd.DataFrame({
+        'portfolio_value': portfolio_value,
+        'ending_cash': ending_cash,
+        'ending_value': portfolio_value - ending_cash,
+        'returns': returns.values,
+        'leverage': np.divide(gross_exposure, portfolio_value, out=np.zeros_like(gross_exposure),
+                              where=portfolio_value != 0),
+        'gross_exposure': gross_exposure,
+        'net_exposure': long_exposure - short_exposure,
+        'long_exposure': long_exposure,
+        'short_exposure': short_exposure,
+        'long_count': books['long_count'][:, b],
+        'short_count': books['short_count'][:, b],
+        'longs': books['longs'][:, b],
+        'shorts': books['shorts'][:, b],
+    }, index=sessions_utc)
+
+    return results, returns, positions, transactions
+
+
+def run_vectorized(Setting, scores, assets, bundle_name='quandl_custom_bundle', aligned=False):
+    """
+    Simulate the Rebalance exit mode with array operations over a sessions x sids price matrix.
+
+    Mirrors the zipline run in main.py: equal-weight long/short baskets chosen at the close of
+    each month_start(days_offset) session, orders filled at the next bar's close with zero slippage,
+    PercentageCommissionModel(0.0005) charged on buys, and open orders cancelled at the next rebalance.
+    Returns (results, returns, positions, transactions) in the same layout as main.simulate.
+    """
+    from main import select_trades
+
+    market = _load_market(Setting, scores, assets, bundle_name, aligned)
+
+    def select_books(latest_scores):
+        top_longs, top_shorts = select_trades(latest_scores, Setting, Setting.N_LONGS, Setting.N_SHORTS)
+        short_idx = top_shorts.index.values if Setting.DoShort else np.array([], dtype=np.int64)
+        return [(top_longs.index.values, short_idx)]
+
+    books = _simulate_books(Setting, market, select_books, 1)
+    return _book_frames(Setting, market, books, assets, 0)
+
+
+def quantile_cutoffs(n_quantiles):
+    """
+    (up_cutoff, low_cutoff) pairs for each bucket, as used by becktest_Decile.create_backtest_settings.
+    """
+    return [[i / n_quantiles, i / n_quantiles + 1 / n_quantiles] for i in range(0, n_quantiles)]
+
+
+def run_quantiles(Setting, scores, assets, n_quantiles=10, bundle_name='quandl_custom_bundle'):
+    """
+    Simulate every long-only quantile bucket in a single pass.
+
+    The cross-section is ranked once per rebalance date and each bucket holds up to N_LONGS names
+    with ranks strictly between its cutoffs, matching a separate zipline run per bucket in
+    becktest_Decile.py. Returns a list of (cutoffs, results, returns, positions, transactions) per
+    bucket, lowest bucket first, and the top-minus-bottom long-short spread return series.
+    """
+    market = _load_market(Setting, scores, assets, bundle_name)
+    cutoffs = quantile_cutoffs(n_quantiles)
+    empty = np.array([], dtype=np.int64)
+
+    def select_books(latest_scores):
+        ranks = latest_scores.rank(pct=True)
+        return [(ranks[(ranks > up) & (ranks < low)].nlargest(Setting.N_LONGS).index.values, empty)
+                for up, low in cutoffs]
+
+    books = _simulate_books(Setting, market, select_books, n_quantiles)
+    buckets = [(cutoff, *_book_frames(Setting, market, books, assets, b)) for b, cutoff in enumerate(cutoffs)]
+
+    spread = buckets[-1][2] - buckets[0][2]
+    spread.name = 'spread'
+    return buckets, spread
+
+
+def _transaction_frame(txn_rows, trading_calendar, sessions, assets):
+    """
+    Fills in the layout of pyfolio's make_transaction_frame: sid and symbol both hold the asset,
+    commission is None as on zipline transactions (it is charged to cash separately), txn_dollars
+    is -amount * price and the index is the tz-naive UTC fill time.
+    """
+    columns = ['sid', 'symbol', 'price', 'order_id', 'amount', 'commission', 'dt', 'txn_dollars']
+    if not txn_rows:
+        return pd.DataFrame(columns=columns)
+
+    day_idx, asset_idx, amount, price, commission = (np.concatenate(parts) for parts in zip(*txn_rows))
+    closes = _naive([trading_calendar.session_close(session) for session in sessions]).tz_localize('UTC')
+    dt = closes[day_idx]
+    traded = [assets[j] for j in asset_idx]
+    fills = pd.DataFrame({
+        'sid': traded,
+        'symbol': traded,
+        'price': price,
+        'order_id': None,
+        'amount': amount.astype(np.int64),
+        'commission': None,
+        'dt': dt,
+        'txn_dollars': -amount * price,
+    }, columns=columns)
+    fills.index = dt.tz_convert(None)
+    return fills
+
+
+def compare_engines(Setting, scores, assets):
+    """
+    Run the zipline and vectorized engines on the same inputs and report the runtime of each
+    and the largest absolute difference in daily returns and ending portfolio value.
+    """
+    from main import simulate
+
+    stats = {}
+    outputs = {}
+    for engine in ['zipline', 'vectorized']:
+        start = time.perf_counter()
+        outputs[engine] = simulate(Setting, scores, assets, engine=engine)
+        stats[f'{engine}_seconds'] = time.perf_counter() - start
+
+    zipline_returns = outputs['zipline'][1]
+    vectorized_returns = outputs['vectorized'][1].reindex(zipline_returns.index)
+    stats['max_return_diff'] = float((zipline_returns - vectorized_returns).abs().max())
+    stats['final_value_diff'] = float(abs(outputs['zipline'][0]['portfolio_value'].iloc[-1]
+                                          - outputs['vectorized'][0]['portfolio_value'].iloc[-1]))
+    stats['speedup'] = stats['zipline_seconds'] / stats['vectorized_seconds']
+    return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized engine against zipline")
+    parser.add_argument("--start-date", type=str, default="2008-01-10")
+    parser.add_argument("--end-date", type=str, default="2022-12-31")
+    parser.add_argument("--primaryindex", type=str, nargs='+', default=["S&P 500", "Russell 2000"])
+    parser.add_argument("--source", type=str, choices=["10kq", "mdna", "call transcripts"], default="mdna")
+    parser.add_argument("--n-longs", type=int, default=1000)
+    parser.add_argument("--n-shorts", type=int, default=1000)
+    parser.add_argument("--do-short", action='store_true')
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="Maximum allowed daily return difference")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    from zipline.data import bundles
+    from zipline.utils.run_algo import load_extensions
+    from config import Backtest_Setting
+    from utils import load_score
+
+    load_extensions(default=True, extensions=[], strict=True, environ=None)
+    bundle_data = bundles.load('quandl_custom_bundle')
+
+    for primaryindex in args.primaryindex:
+        BacktestSetting = Backtest_Setting(start_date=args.start_date,
+                                           end_date=args.end_date,
+                                           source=args.source,
+                                           primaryindex=primaryindex,
+                                           N_LONGS=args.n_longs,
+                                           N_SHORTS=args.n_shorts,
+                                           DoShort=args.do_short)
+        scores, assets = load_score(bundle_data, BacktestSetting)
+        stats = compare_engines(BacktestSetting, scores, assets)
+
+        status = 'OK' if stats['max_return_diff'] <= args.tolerance else 'MISMATCH'
+        print(f"{primaryindex}: zipline {stats['zipline_seconds']:.1f}s, "
+              f"vectorized {stats['vectorized_seconds']:.2f}s, speedup {stats['speedup']:.0f}x, "
+              f"max return diff {stats['max_return_diff']:.2e} [{status}]")
@@ -0,0 +1,614 @@
+import os
+import glob
+import hmac
+import json
+import time
+import uuid
+import socket
+import ipaddress
+import argparse
+import threading
+import traceback
+import socketserver
+from tqdm import tqdm
+
+from run_catalog import catalog_path, pending_settings, settings_fields, settings_from_fields, settings_hash, \
+    record_row
+
+# Seconds a worker holds a job without a heartbeat before the job is handed to another worker
+default_lease_seconds = 120
+
+# Attempts, counting lease expiries, before a job is marked failed
+default_max_attempts = 3
+
+# Characters of a job's traceback kept in its record
+max_error_chars = 4000
+
+
+def make_job(Setting, engine='zipline', name=None, lease_seconds=default_lease_seconds,
+             max_attempts=default_max_attempts):
+    """
+    JSON job for a Backtest_Setting, keyed by its settings hash and engine.
+    """
+    job_id = f'{settings_hash(Setting)}-{engine}'
+    return {'job_id': job_id, 'name': name or job_id, 'settings': settings_fields(Setting), 'engine': engine,
+            'lease_seconds': lease_seconds, 'max_attempts': max_attempts, 'attempts': 0, 'errors': []}
+
+
+def _worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class FileQueue(object):
+    """
+    Job queue in a directory on a filesystem shared by all hosts, e.g. NFS.
+
+    A job is a JSON file that moves between the pending, leased, done and failed sub-directories.
+    Workers claim a job by renaming it into leased/ under their worker id, which only one of them can
+    do, and renew the lease by touching the file. A leased job whose file is older than its lease is
+    put back in pending/ by whichever coordinator or idle worker notices first. Every move is a rename,
+    so readers never see a partial file. Host clocks should agree to well within the lease.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        for name in ['pending', 'leased', 'done', 'failed', 'tmp']:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    def _path(self, state, job_id, worker=None):
+        name = f'{job_id}@{worker}.json' if worker else f'{job_id}.json'
+        return os.path.join(self.root, state, name)
+
+    def _write(self, path, record):
+        tmp_path = os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.rename(tmp_path, path)
+
+    def _read(self, path):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _take(self, path):
+        """
+        Move a file out of the queue into tmp/, returning its new path, or None if another process moved it first.
+        """
+        taken = os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+        try:
+            os.rename(path, taken)
+        except FileNotFoundError:
+            return None
+        return taken
+
+    def _leased(self):
+        return {name.split('@', 1)[0]: os.path.join(self.root, 'leased', name)
+                for name in os.listdir(os.path.join(self.root, 'leased')) if name.endswith('.json')}
+
+    def publish(self, jobs, rerun=False):
+        """
+        Add jobs to pending/, skipping those currently leased and, unless rerun is set, those already done.
+        """
+        leased = self._leased()
+        published = 0
+        for job in jobs:
+            done_path = self._path('done', job['job_id'])
+            if job['job_id'] in leased or (os.path.exists(done_path) and not rerun):
+                continue
+            for path in [done_path, self._path('failed', job['job_id'])]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._write(self._path('pending', job['job_id']), job)
+            published += 1
+        return published
+
+    def claim(self, worker):
+        """
+        Lease the next pending job to worker. Returns (job or None, whether nothing is pending or leased).
+        """
+        pending_dir = os.path.join(self.root, 'pending')
+        names = sorted(name for name in os.listdir(pending_dir) if name.endswith('.json'))
+        if not names:
+            self.reap()
+            names = sorted(name for name in os.listdir(pending_dir) if name.endswith('.json'))
+
+        for name in names:
+            source = os.path.join(pending_dir, name)
+            leased = self._path('leased', name[:-len('.json')], worker)
+            try:
+                # Rename keeps the modification time, so start the lease before the file moves
+                os.utime(source)
+                os.rename(source, leased)
+                return self._read(leased), False
+            except FileNotFoundError:
+                continue
+        return None, not self._leased()
+
+    def heartbeat(self, job_id, worker):
+        """
+        Renew the lease. Returns False when the job was taken back from this worker.
+        """
+        try:
+            os.utime(self._path('leased', job_id, worker))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, job_id, worker, result):
+        """
+        Record a job's result. A worker that lost its lease still records it, the first result wins.
+        """
+        if not os.path.exists(self._path('done', job_id)):
+            self._write(self._path('done', job_id), {'job_id': job_id, 'status': 'done', 'worker': worker,
+                                                     'finished_at': time.time(), 'result': result})
+        taken = self._take(self._path('leased', job_id, worker))
+        if taken:
+            os.remove(taken)
+
+    def _retry(self, taken, error):
+        """
+        Put a taken job back in pending/ with one more attempt, or in failed/ once it has used them all.
+        A job another worker already completed is dropped, so its done record stands.
+        """
+        job = self._read(taken)
+        if os.path.exists(self._path('done', job['job_id'])):
+            os.remove(taken)
+            return
+        job['attempts'] += 1
+        job['errors'].append(error[-max_error_chars:])
+        if job['attempts'] >= job['max_attempts']:
+            job['status'] = 'failed'
+            self._write(self._path('failed', job['job_id']), job)
+        else:
+            self._write(self._path('pending', job['job_id']), job)
+        os.remove(taken)
+
+    def fail(self, job_id, worker, error):
+        taken = self._take(self._path('leased', job_id, worker))
+        if taken:
+            self._retry(taken, error)
+
+    def reap(self):
+        """
+        Put jobs whose lease expired, e.g. because their worker died, back in pending/. Returns their ids.
+        """
+        expired = []
+        for job_id, path in self._leased().items():
+            try:
+                age = time.time() - os.stat(path).st_mtime
+                if age <= self._read(path)['lease_seconds']:
+                    continue
+            except (FileNotFoundError, ValueError):
+                continue
+            taken = self._take(path)
+            if taken is None:
+                continue
+            if time.time() - os.stat(taken).st_mtime <= self._read(taken)['lease_seconds']:
+                # Renewed between the check and the move
+                os.rename(taken, path)
+                continue
+            worker = os.path.basename(path)[len(job_id) + 1:-len('.json')]
+            self._retry(taken, f'Lease of worker {worker} expired')
+            expired.append(job_id)
+        return expired
+
+    def finished(self, job_ids):
+        """
+        Done and failed records of the given jobs.
+        """
+        records = {}
+        for job_id in job_ids:
+            for state in ['done', 'failed']:
+                try:
+                    records[job_id] = self._read(self._path(state, job_id))
+                    break
+                except (FileNotFoundError, ValueError):
+                    continue
+        return records
+
+    def counts(self):
+        return {state: len(glob.glob(os.path.join(self.root, state, '*.json')))
+                for state in ['pending', 'leased', 'done', 'failed']}
+
+
+class JobBoard(object):
+    """
+    In-memory job queue held by a coordinator and served to workers over TCP, with the same leasing
+    rules as FileQueue. Lease times use the coordinator's clock only.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # job_id -> job, in publish order
+        self.leases = {}  # job_id -> (worker, expiry, job)
+        self.records = {}  # job_id -> done or failed record
+
+    def publish(self, jobs, rerun=False):
+        with self.lock:
+            published = 0
+            for job in jobs:
+                done = self.records.get(job['job_id'], {}).get('status') == 'done'
+                if job['job_id'] in self.leases or (done and not rerun):
+                    continue
+                self.records.pop(job['job_id'], None)
+                self.pending[job['job_id']] = job
+                published += 1
+            return published
+
+    def claim(self, worker):
+        self.reap()
+        with self.lock:
+            if not self.pending:
+                return None, not self.leases
+            job_id = next(iter(self.pending))
+            job = self.pending.pop(job_id)
+            self.leases[job_id] = (worker, time.monotonic() + job['lease_seconds'], job)
+            return job, False
+
+    def heartbeat(self, job_id, worker):
+        with self.lock:
+            lease = self.leases.get(job_id)
+            if lease is None or lease[0] != worker:
+                return False
+            self.leases[job_id] = (worker, time.monotonic() + lease[2]['lease_seconds'], lease[2])
+            return True
+
+    def complete(self, job_id, worker, result):
+        with self.lock:
+            if self.records.get(job_id, {}).get('status') != 'done':
+                self.records[job_id] = {'job_id': job_id, 'status': 'done', 'worker': worker,
+                                        'finished_at': time.time(), 'result': result}
+            if self.leases.get(job_id, (None,))[0] == worker:
+                del self.leases[job_id]
+
+    def _retry(self, job, error):
+        # A job another worker already completed is dropped, so its done record stands
+        if self.records.get(job['job_id'], {}).get('status') == 'done':
+            return
+        job['attempts'] += 1
+        job['errors'].append(error[-max_error_chars:])
+        if job['attempts'] >= job['max_attempts']:
+            job['status'] = 'failed'
+            self.records[job['job_id']] = job
+        else:
+            self.pending[job['job_id']] = job
+
+    def fail(self, job_id, worker, error):
+        with self.lock:
+            if self.leases.get(job_id, (None,))[0] == worker:
+                self._retry(self.leases.pop(job_id)[2], error)
+
+    def reap(self):
+        with self.lock:
+            now = time.monotonic()
+            expired = [job_id for job_id, (_, expiry, _) in self.leases.items() if expiry < now]
+            for job_id in expired:
+                worker, _, job = self.leases.pop(job_id)
+                self._retry(job, f'Lease of worker {worker} expired')
+            return expired
+
+    def finished(self, job_ids):
+        with self.lock:
+            return {job_id: self.records[job_id] for job_id in job_ids if job_id in self.records}
+
+    def counts(self):
+        with self.lock:
+            statuses = [record['status'] for record in self.records.values()]
+            return {'pending': len(self.pending), 'leased': len(self.leases),
+                    'done': statuses.count('done'), 'failed': statuses.count('failed')}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """
+    Answer one JSON request per line with one JSON reply per line.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                reply = {'ok': True, 'value': self.server.dispatch(request)}
+            except Exception as e:
+                reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    operations = ['claim', 'heartbeat', 'complete', 'fail', 'counts']
+
+    def __init__(self, address, board, token=None):
+        super().__init__(address, _Handler)
+        self.board = board
+        self.token = token or ''
+
+    def dispatch(self, request):
+        if not hmac.compare_digest(str(request.get('token') or ''), self.token):
+            raise PermissionError('Invalid token')
+        if request.get('op') not in self.operations:
+            raise ValueError(f"Unknown operation {request.get('op')}")
+        return getattr(self.board, request['op'])(**request.get('args', {}))
+
+
+def _is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def serve(board, host, port, token=None):
+    """
+    Serve a JobBoard on host:port from a background thread. Returns the server; call shutdown() to stop it.
+    Workers report results that land in the catalog, so a host other than loopback requires a token.
+    """
+    if not token and not _is_loopback(host):
+        raise ValueError(f"Refusing to serve the job queue on {host or 'all interfaces'} without a token; "
+                         f"set --token or JOB_QUEUE_TOKEN")
+    server = _Server((host, port), board, token)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SocketQueue(object):
+    """
+    Worker-side client of a JobBoard served by a coordinator, with the FileQueue interface.
+    Network errors are raised as OSError so callers can retry.
+    """
+
+    def __init__(self, host, port, token=None, timeout=30):
+        self.address = (host, port)
+        self.token = token
+        self.timeout = timeout
+
+    def _call(self, op, **args):
+        with socket.create_connection(self.address, timeout=self.timeout) as connection:
+            connection.sendall((json.dumps({'op': op, 'args': args, 'token': self.token}) + '\n').encode())
+            line = connection.makefile('r').readline()
+        if not line:
+            raise ConnectionError('Coordinator closed the connection')
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise RuntimeError(reply['error'])
+        return reply['value']
+
+    def claim(self, worker):
+        job, drained = self._call('claim', worker=worker)
+        return job, drained
+
+    def heartbeat(self, job_id, worker):
+        return self._call('heartbeat', job_id=job_id, worker=worker)
+
+    def complete(self, job_id, worker, result):
+        self._call('complete', job_id=job_id, worker=worker, result=result)
+
+    def fail(self, job_id, worker, error):
+        self._call('fail', job_id=job_id, worker=worker, error=error)
+
+    def reap(self):
+        # The coordinator reaps its own board
+        return []
+
+    def counts(self):
+        return self._call('counts')
+
+
+def _tcp_address(address):
+    host, port = address[len('tcp://'):].rsplit(':', 1)
+    return host, int(port)
+
+
+def connect_queue(address, token=None):
+    """
+    Worker-side queue for an address: tcp://host:port for a coordinator's socket, else a shared directory.
+    """
+    if address.startswith('tcp://'):
+        return SocketQueue(*_tcp_address(address), token=token)
+    return FileQueue(address)
+
+
+def _retrying(function, timeout, *args):
+    """
+    Call function(*args), retrying on network errors for up to timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return function(*args)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(min(5, timeout))
+
+
+def _heartbeat(queue, job, worker, stop):
+    while not stop.wait(job['lease_seconds'] / 4):
+        try:
+            if not queue.heartbeat(job['job_id'], worker):
+                print(f"Lease of {job['name']} was lost, its result is still reported")
+        except OSError as e:
+            print(f"Heartbeat for {job['name']} failed: {e}")
+
+
+# Scores and assets of the last load_score call in this worker process
+_loaded_scores = {}
+
+
+def run_backtest_job(job):
+    """
+    Run a job's backtest with main.run and return its catalog row. Scores are reused across jobs
+    that agree on the fields load_score depends on.
+    """
+    from main import run
+    from utils import load_score
+    from score_cache import key_fields
+    from run_catalog import query_runs
+    from zipline.data import bundles
+    from zipline.utils.run_algo import load_extensions
+
+    Setting = settings_from_fields(job['settings'])
+    load_extensions(default=True, extensions=[], strict=True, environ=None)
+    key = tuple(getattr(Setting, field) for field in key_fields)
+    if key not in _loaded_scores:
+        _loaded_scores.clear()
+        _loaded_scores[key] = load_score(bundles.load('quandl_custom_bundle'), Setting)
+    scores, assets = _loaded_scores[key]
+
+    results_dir = run(Setting, scores, assets, engine=job['engine'])
+    row = query_runs({'run_id': os.path.basename(results_dir)}).iloc[0]
+    return {name: None if value != value else (value.item() if hasattr(value, 'item') else value)
+            for name, value in row.items()}
+
+
+def run_worker(address, execute=run_backtest_job, token=None, wait=False, poll_interval=5, connect_timeout=120):
+    """
+    Claim and run jobs from the queue at address until it is drained, renewing each lease from a
+    background thread while execute(job) runs. execute returns a JSON-serializable result, reported
+    with the job; an exception fails the attempt. With wait set, keep polling an empty queue. Gives
+    up when the queue is unreachable for connect_timeout seconds.
+    """
+    queue = connect_queue(address, token)
+    worker = _worker_id()
+    completed = 0
+    unreachable_since = None
+    while True:
+        try:
+            job, drained = queue.claim(worker)
+            unreachable_since = None
+        except OSError as e:
+            unreachable_since = unreachable_since or time.monotonic()
+            if time.monotonic() - unreachable_since > connect_timeout:
+                print(f"Worker {worker}: queue unreachable for {connect_timeout}s ({e}), stopping")
+                break
+            time.sleep(poll_interval)
+            continue
+
+        if job is None:
+            if drained and not wait:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(queue, job, worker, stop), daemon=True)
+        heartbeat.start()
+        start = time.perf_counter()
+        try:
+            result = execute(job)
+        except Exception:
+            error = traceback.format_exc()
+            print(f"Worker {worker}: job {job['name']} failed:\n{error}")
+            _retrying(queue.fail, connect_timeout, job['job_id'], worker, error)
+        else:
+            result = dict(result or {}, seconds=time.perf_counter() - start)
+            _retrying(queue.complete, connect_timeout, job['job_id'], worker, result)
+            completed += 1
+        finally:
+            stop.set()
+            heartbeat.join()
+    print(f"Worker {worker} finished {completed} jobs")
+    return completed
+
+
+def coordinate(address, settings_list, engine='zipline', names=None, rerun=False,
+               lease_seconds=default_lease_seconds, max_attempts=default_max_attempts, token=None,
+               poll_interval=2, path=catalog_path):
+    """
+    Publish a sweep for remote workers and wait for it. address is a shared directory, or tcp://host:port
+    to serve the queue from this process. Configs already completed in the catalog are skipped unless
+    rerun is set. Results reported by workers are recorded in this host's catalog, so later sweeps and
+    queries here see runs from every host. Returns the done or failed record of every job.
+    """
+    names = list(names) if names is not None else [None] * len(settings_list)
+    named = dict(zip((settings_hash(Setting) for Setting in settings_list), names))
+    settings_list = pending_settings(settings_list, rerun=rerun, engine=engine, path=path)
+    jobs = [make_job(Setting, engine, named[settings_hash(Setting)], lease_seconds, max_attempts)
+            for Setting in settings_list]
+    job_ids = [job['job_id'] for job in jobs]
+    named = {job['job_id']: job['name'] for job in jobs}
+
+    server = None
+    if address.startswith('tcp://'):
+        queue = JobBoard()
+        server = serve(queue, *_tcp_address(address), token=token)
+    else:
+        queue = FileQueue(address)
+    queue.publish(jobs, rerun=rerun)
+    print(f"Published {len(jobs)} jobs on {address}")
+
+    records = {}
+    progress = tqdm(total=len(jobs), desc='sweep')
+    try:
+        while len(records) < len(jobs):
+            for job_id in queue.reap():
+                tqdm.write(f"Lease of {named.get(job_id) or job_id} expired, job re-queued")
+            for job_id, record in queue.finished([job_id for job_id in job_ids if job_id not in records]).items():
+                records[job_id] = record
+                progress.update(1)
+                if record['status'] == 'done' and record['result'].get('run_id'):
+                    record_row(record['result'], path)
+                elif record['status'] == 'failed':
+                    tqdm.write(f"Job {record['name']} failed after {record['attempts']} attempts:\n"
+                               f"{record['errors'][-1]}")
+            progress.set_postfix(**queue.counts())
+            if len(records) < len(jobs):
+                time.sleep(poll_interval)
+        if server is not None:
+            # Let polling workers see the drained queue before the socket closes
+            time.sleep(poll_interval * 2)
+    finally:
+        progress.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    failed = [job['name'] for job in jobs if records.get(job['job_id'], {}).get('status') != 'done']
+    print(f"{len(jobs) - len(failed)} of {len(jobs)} jobs done" + (f", failed: {', '.join(failed)}" if failed else ''))
+    return records
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run or inspect sweep jobs published by a coordinator")
+    parser.add_argument("--queue", type=str, required=True,
+                        help="Shared queue directory, or tcp://host:port of the coordinator")
+    parser.add_argument("--token", type=str, default=os.environ.get('JOB_QUEUE_TOKEN'),
+                        help="Token shared with the coordinator (default: $JOB_QUEUE_TOKEN)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    worker_parser = subparsers.add_parser('worker', help="Run queued jobs on this host")
+    worker_parser.add_argument("--n-workers", type=int, default=1, help="Worker processes on this host")
+    worker_parser.add_argument("--wait", action='store_true', help="Keep polling an empty queue for new jobs")
+    worker_parser.add_argument("--poll-interval", type=float, default=5,
+                               help="Seconds between polls of an empty queue")
+    worker_parser.add_argument("--connect-timeout", type=float, default=120,
+                               help="Seconds the queue may be unreachable before a worker stops")
+    worker_parser.add_argument("--catalog", type=str, default=None,
+                               help="Host-local catalog for the runs of this host (sets BACKTEST_CATALOG)")
+    worker_parser.add_argument("--job-memory-mb", type=float, default=2048, help="Memory estimate per worker in MB")
+    worker_parser.add_argument("--memory-budget-mb", type=float, default=None,
+                               help="Memory all workers may reserve (default: 80%% of available memory)")
+    worker_parser.add_argument("--threads-per-job", type=int, default=1, help="Native threads per worker")
+
+    subparsers.add_parser('status', help="Count pending, leased, done and failed jobs")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == 'status':
+        print(connect_queue(args.queue, args.token).counts())
+    elif args.command == 'worker':
+        from sweep_scheduler import run_jobs
+
+        if args.catalog:
+            # Read by run_catalog when the spawned workers import it
+            os.environ['BACKTEST_CATALOG'] = args.catalog
+
+        # Each worker process pulls jobs until the queue drains, within this host's memory and thread limits
+        run_jobs(run_worker, [(args.queue, run_backtest_job, args.token, args.wait, args.poll_interval,
+                               args.connect_timeout)] * args.n_workers,
+                 n_workers=args.n_workers, job_memory_mb=args.job_memory_mb,
+                 memory_budget_mb=args.memory_budget_mb, thread_limit=args.threads_per_job,
+                 names=[f'worker {i}' for i in range(args.n_workers)])
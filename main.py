@@ -1,19 +1,24 @@
 import argparse
+import time
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from collections import defaultdict
 from datetime import datetime
 import os
+import uuid
 import logging
 import pyfolio as pf
 
 from config import Backtest_Setting
 from CustomFactors import ScoreFactor, IsFilingDateFactor
 from CustomCommission import PercentageCommissionModel
-from utils import save_backtest_setting, load_score
+from utils import save_backtest_setting, load_score, load_benchmark
+from portfolio_orders import cancel_open_orders, set_target_portfolio
+from results_store import write_results
+from run_catalog import record_run
 
 from zipline import run_algorithm
-from zipline.finance.order import ORDER_STATUS
 from zipline.api import (attach_pipeline,
                          pipeline_output,
                          date_rules,
@@ -24,22 +29,56 @@ from zipline.api import (attach_pipeline,
                          set_slippage,
                          set_commission,
                          order_target,
-                         order_target_percent,
-                         cancel_order,
-                         order_target_value)
+                         order_target_percent)
 from zipline.data import bundles
 from zipline.utils.run_algo import load_extensions
 from zipline.pipeline import Pipeline
 from zipline.utils.calendar_utils import get_calendar
 from zipline.pipeline.filters import StaticAssets
 
+# Only trade sids with a new filing on the rebalance date. IsFilingDateFactor is computed
+# and added to the pipeline only when this is set.
+filter_filing_dates = False
+
+
+def align_scores(scores, Setting, trading_calendar):
+    """
+    Lag the scores, align them to the trading calendar and forward fill up to the lookback window.
+    """
+    scores = scores.shift(Setting.lag)  # Apply signal lag
+    all_sessions = trading_calendar.sessions_in_range(start=scores.index.min().date(), end=scores.index.max().date())
+    all_sessions = all_sessions.tz_localize('UTC')
+    all_sessions_df = pd.DataFrame(index=all_sessions)
+    scores_ = pd.merge(all_sessions_df, scores, left_index=True, right_index=True, how='left')
+    return scores_.reindex(all_sessions).ffill(axis=0, limit=Setting.lookback).tz_convert('UTC')
+
+
+def select_trades(latest_scores, Setting, n_longs, n_shorts):
+    """
+    Rank the latest scores and pick the long and short baskets according to the cutoffs.
+    Returns the selected (top_longs, top_shorts) rank Series.
+    """
+    ranks = latest_scores.rank(pct=True)
+
+    if Setting.up_cutoff >= Setting.low_cutoff:
+        top_longs = ranks[ranks > Setting.up_cutoff].nlargest(n_longs)
+        top_shorts = ranks[ranks < Setting.low_cutoff].nsmallest(n_shorts)
+    else:
+        # Used in decile backtesting
+        top_longs = ranks[(ranks > Setting.up_cutoff) & (ranks < Setting.low_cutoff)].nlargest(n_longs)
+        top_shorts = ranks[(ranks > Setting.short_up_cutoff) & (ranks < Setting.short_low_cutoff)]
+
+    assert len(top_longs) <= n_longs
+    assert len(top_shorts) <= n_shorts
+    return top_longs, top_shorts
+
 
 def initialize(context):
     """
     Called once at the start of the algorithm to set up the initial context.
     """
     global BacktestSetting
-    global scores, assets
+    global scores, assets, score_values
 
     # Show progress through trading sessions
     trading_calendar = get_calendar('NYSE')
@@ -57,23 +96,29 @@ def initialize(context):
     context.shorts = 0
     context.n_to_open = 0
     context.n_to_close = 0
+    context.long_assets = []
+    context.short_assets = []
+    context.timings = defaultdict(lambda: [0, 0.0])  # name -> [calls, seconds]
     context.universe = assets
 
     # Set slippage and commission models
     set_slippage(slippage.FixedSlippage(spread=0.00))
     set_commission(PercentageCommissionModel(cost=0.0005))
 
-    # Adjust scores DataFrame to align with the trading calendar
-    scores = scores.shift(BacktestSetting.lag)  # Apply signal lag
-    all_sessions = trading_calendar.sessions_in_range(start=scores.index.min().date(), end=scores.index.max().date())
-    all_sessions = all_sessions.tz_localize('UTC')
-    all_sessions_df = pd.DataFrame(index=all_sessions)
-    scores_ = pd.merge(all_sessions_df, scores, left_index=True, right_index=True, how='left')
-    ScoreFactor.scores = scores_.reindex(all_sessions).ffill(axis=0, limit=BacktestSetting.lookback).tz_convert('UTC')
+    if score_values is None:
+        # Adjust scores DataFrame to align with the trading calendar
+        aligned_scores = align_scores(scores, BacktestSetting, trading_calendar)
+        ScoreFactor.set_scores(aligned_scores)
+    else:
+        # Aligned by the parent process: serve the shared memory map without a private copy
+        aligned_scores = scores
+        ScoreFactor.set_scores(aligned_scores, values=score_values)
 
     # Create and attach the pipeline with the score factor
-    score_factor = ScoreFactor()
-    # is_filing_date_factor = IsFilingDateFactor()
+    columns = {'score': ScoreFactor()}
+    if filter_filing_dates:
+        IsFilingDateFactor.set_scores(aligned_scores)
+        columns['isFilingDate'] = IsFilingDateFactor()
 
     # Exclude specific tickers if necessary
     tickers_to_remove = []  # Add tickers to remove if needed
@@ -81,10 +126,7 @@ def initialize(context):
 
     # Create the pipeline
     pipe = Pipeline(
-        columns={
-            'score': score_factor,
-            # 'isFilingDate': is_filing_date_factor,
-        },
+        columns=columns,
         screen=StaticAssets(context.universe)
     )
     attach_pipeline(pipe, 'score_pipeline')
@@ -94,10 +136,10 @@ def initialize(context):
                       date_rules.month_start(days_offset=BacktestSetting.days_offset),
                       time_rules.market_close())
 
-    # Optionally schedule a function to record variables each day
-    # schedule_function(record_vars,
-    #                   date_rules.every_day(),
-    #                   time_rules.market_close())
+    # Record exposure and leverage at the end of each day
+    schedule_function(record_vars,
+                      date_rules.every_day(),
+                      time_rules.market_close())
 
 
 def before_trading_start(context, data):
@@ -122,98 +164,60 @@ def my_function(context, data):
     """
     pipeline_data = pipeline_output('score_pipeline')
     latest_scores = pipeline_data['score']
-    # is_filing_date = pipeline_data['isFilingDate']
 
     # Uncomment and modify the code below to apply additional constraints
     # prices = data.history(context.universe, 'price', 1, '1d').iloc[-1]
     # volumes = data.history(context.universe, 'volume', 1, '1d').iloc[-1]
     # opens = data.history(context.universe, 'open', 1, '1d').iloc[-1]
-    # eligible_stocks = latest_scores[(volumes * opens >= BacktestSetting.initial_cash) & (prices >= 0.1) & (is_filing_date == 1)]
+    # eligible_stocks = latest_scores[(volumes * opens >= BacktestSetting.initial_cash) & (prices >= 0.1)]
 
     eligible_stocks = latest_scores
-    ranks = eligible_stocks.rank(pct=True)
-
-    if BacktestSetting.up_cutoff >= BacktestSetting.low_cutoff:
-        top_longs = ranks[ranks > BacktestSetting.up_cutoff].nlargest(context.n_longs)
-        top_shorts = ranks[ranks < BacktestSetting.low_cutoff].nsmallest(context.n_shorts)
-    else:
-        # Used in decile backtesting
-        top_longs = ranks[(ranks > BacktestSetting.up_cutoff) & (ranks < BacktestSetting.low_cutoff)].nlargest(
-            context.n_longs)
-        top_shorts = ranks[(ranks > BacktestSetting.short_up_cutoff) & (ranks < BacktestSetting.short_low_cutoff)]
-
-    assert len(top_longs) <= context.n_longs
-    assert len(top_shorts) <= context.n_shorts
+    if filter_filing_dates:
+        eligible_stocks = eligible_stocks[pipeline_data['isFilingDate'] == 1]
+    top_longs, top_shorts = select_trades(eligible_stocks, BacktestSetting, context.n_longs, context.n_shorts)
 
-    # Store the trades to be executed in the context
-    context.trades = {
-        asset: (1 if asset in top_longs.index else (-1 if asset in top_shorts.index else 0))
-        for asset in context.universe
-    }
+    # Store the baskets and the per-asset trade direction; longs take precedence over shorts
+    context.long_assets = list(top_longs.index)
+    long_set = set(context.long_assets)
+    context.short_assets = [asset for asset in top_shorts.index if asset not in long_set]
+    context.trades = dict.fromkeys(context.universe, 0)
+    context.trades.update(dict.fromkeys(context.short_assets, -1))
+    context.trades.update(dict.fromkeys(context.long_assets, 1))
 
 
 def rebalance(context, data):
     """
     Rebalance the portfolio based on the latest scores and context settings.
     """
+    rebalance_start = time.perf_counter()
     my_function(context, data)
 
     global BacktestSetting
 
-    # Cancel open orders that haven't been executed
-    for stock, orders in context.blotter.open_orders.items():
-        for order in orders:
-            if order.status in [ORDER_STATUS.OPEN, ORDER_STATUS.HELD]:
-                cancel_order(order.id)
-
-    trades = defaultdict(list)
     if BacktestSetting.ExitMode == 'Rebalance':
-        for stock, trade in context.trades.items():
-            if trade == 1:
-                trades[1].append(stock)
-            elif trade == -1 and BacktestSetting.DoShort:
-                trades[-1].append(stock)
-            elif trade == 0:
-                trades[0].append(stock)
-
-        context.longs = len(trades[1])
-        context.shorts = len(trades[-1]) if BacktestSetting.DoShort else 0
-
-        # Close all positions not in the current trade plan
-        close_count = 0
-        for stock in context.portfolio.positions:
-            if stock not in trades[1] and stock not in trades[-1]:
-                order_target_value(stock, 0)
-                close_count += 1
-
-        # Execute orders for long positions
-        open_count = 0
+        long_assets = context.long_assets
+        short_assets = context.short_assets if BacktestSetting.DoShort else []
+        context.longs = len(long_assets)
+        context.shorts = len(short_assets)
+
+        # Target value per asset: equal weight within each side
+        portfolio_value = context.portfolio.portfolio_value
+        targets = {}
         if context.longs > 0:
-            target_percent = 1 / context.longs
-            safe_pos_cash = 1
-            target_value = safe_pos_cash * target_percent * context.portfolio.portfolio_value
-            for stock in trades[1]:
-                if data.can_trade(stock):
-                    open_count += 1
-                    order_target_value(stock, int(target_value))
-
-        # Execute orders for short positions if shorting is enabled
-        if BacktestSetting.DoShort and context.shorts > 0:
-            target_percent = -1 / context.shorts
-            safe_pos_cash = 1
-            target_value = safe_pos_cash * target_percent * context.portfolio.portfolio_value
-            for stock in trades[-1]:
-                if data.can_trade(stock):
-                    open_count += 1
-                    order_target_value(stock, int(target_value))
-
-        context.n_to_open = open_count
-        context.n_to_close = close_count
+            targets.update(dict.fromkeys(long_assets, int(1 / context.longs * portfolio_value)))
+        if context.shorts > 0:
+            targets.update(dict.fromkeys(short_assets, int(-1 / context.shorts * portfolio_value)))
+
+        # Cancel stale orders, close positions outside the plan and submit net changes in one batch
+        context.n_to_open, context.n_to_close = set_target_portfolio(context, data, targets)
 
     elif BacktestSetting.ExitMode == 'EventBased':
         """
         Event-based exit logic (not fully implemented).
         """
+        # Cancel open orders that haven't been executed
+        cancel_open_orders(context)
+
         for stock in context.universe:
             pos = context.portfolio.positions[stock]
             if pos.amount != 0:  # If a position exists
@@ -231,67 +235,102 @@ def rebalance(context, data):
                 context.holding_period[stock] = 0  # Reset holding period for newly opened position
                 context.shorts += 1  # Increment shorts count
 
+    record_timing(context, 'rebalance', rebalance_start)
+
+
+def record_timing(context, name, start):
+    """
+    Accumulate the time elapsed since start under the given name.
+    """
+    elapsed = time.perf_counter() - start
+    timing = context.timings[name]
+    timing[0] += 1
+    timing[1] += elapsed
+    if BacktestSetting.do_log:
+        logging.info(f"{name.upper()} TIME: {elapsed * 1000:.2f} ms")
+
+
+def analyze(context, perf):
+    """
+    Called once at the end of the backtest. Reports the instrumented function timings.
+    """
+    for name, (calls, seconds) in context.timings.items():
+        print(f"{name}: {calls} calls, {seconds:.2f}s total, {seconds / calls * 1000:.2f} ms per call")
+
 
 def record_vars(context, data):
     """
     Record and log key variables at the end of each trading day.
     """
-    # Calculate leverage components
-    long_exposure = sum(
-        [pos.amount * data.current(asset, 'price') for asset, pos in context.portfolio.positions.items() if
-         pos.amount > 0])
-    short_exposure = sum(
-        [abs(pos.amount) * data.current(asset, 'price') for asset, pos in context.portfolio.positions.items() if
-         pos.amount < 0])
+    record_start = time.perf_counter()
+
+    # Value all positions with a single batched price lookup
+    positions = context.portfolio.positions
+    held_assets = list(positions)
+    if held_assets:
+        amounts = np.array([positions[asset].amount for asset in held_assets], dtype=float)
+        values = amounts * data.current(held_assets, 'price').values
+        long_exposure = values[amounts > 0].sum()
+        short_exposure = -values[amounts < 0].sum()
+        long_count = int((amounts > 0).sum())
+        short_count = int((amounts < 0).sum())
+    else:
+        long_exposure = short_exposure = 0.0
+        long_count = short_count = 0
+
     total_exposure = long_exposure + short_exposure
+    net_exposure = long_exposure - short_exposure
     portfolio_value = context.portfolio.portfolio_value
 
     leverage = total_exposure / portfolio_value if portfolio_value != 0 else 0
 
     # Record variables for plotting
     record(leverage=leverage,
+           gross_exposure=total_exposure,
+           net_exposure=net_exposure,
+           long_exposure=long_exposure,
+           short_exposure=short_exposure,
+           long_count=long_count,
+           short_count=short_count,
            longs=context.longs,
            shorts=context.shorts)
 
     if BacktestSetting.do_log:
         # Log detailed leverage and exposure information
         logging.info("-" * 20 + " AFTER TRADING TIME " + "-" * 20)
-        logging.info(f"OPENED POSITION NUM: {len(context.portfolio.positions)}")
+        logging.info(f"OPENED POSITION NUM: {len(positions)}")
         logging.info(f"PORTFOLIO VALUE: {context.portfolio.portfolio_value}")
         logging.info(f"CASH BALANCE: {context.portfolio.cash}")
         logging.info(f"LEVERAGE: {leverage:.2f}")
         logging.info(f"LONG EXPOSURE: {long_exposure:.2f}")
         logging.info(f"SHORT EXPOSURE: {short_exposure:.2f}")
         logging.info(f"TOTAL EXPOSURE: {total_exposure:.2f}")
+        logging.info(f"NET EXPOSURE: {net_exposure:.2f}")
 
+    record_timing(context, 'record_vars', record_start)
 
-def run(Setting, scores_, assets_):
+
+def simulate(Setting, scores_, assets_, engine='zipline', score_values_=None):
     """
-    Main function to run the backtest with the provided settings, scores, and assets.
+    Simulate the strategy and return (results, returns, positions, transactions).
+    engine='zipline' runs the full event loop; engine='vectorized' runs the array-based
+    engine in fast_engine.py, which only supports the Rebalance exit mode.
+    score_values_, from shared_scores.attach_score_values, marks scores_ as already aligned with
+    align_scores for Setting and holds its values followed by an all-NaN column.
     """
-    global BacktestSetting, assets, scores
+    global BacktestSetting, assets, scores, score_values
     BacktestSetting = Setting
     assets = assets_
     scores = scores_
+    score_values = score_values_
 
-    # Create a directory to save the results
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    results_dir = os.path.join('./plots/temp', timestamp)
-    os.makedirs(results_dir, exist_ok=True)
-    save_backtest_setting(BacktestSetting, results_dir)
-
-    if BacktestSetting.do_log:
-        # Set up logging if enabled
-        log_file_path = os.path.join(results_dir, 'record.log')
-        for handler in logging.root.handlers[:]:
-            logging.root.removeHandler(handler)
-
-        logging.basicConfig(
-            filename=log_file_path,  # Log file path
-            level=logging.INFO,  # Log level (INFO, DEBUG, WARNING, etc.)
-            format='%(asctime)s - %(levelname)s - %(message)s',  # Log format
-            datefmt='%Y-%m-%d %H:%M:%S'  # Date format
-        )
+    if engine == 'vectorized':
+        if not BacktestSetting.ExitMode == 'Rebalance':
+            raise ValueError(f"The vectorized engine does not support ExitMode={BacktestSetting.ExitMode}")
+        if filter_filing_dates:
+            raise ValueError("The vectorized engine does not support filter_filing_dates")
+        from fast_engine import run_vectorized
+        return run_vectorized(BacktestSetting, scores, assets, aligned=score_values is not None)
 
     # Run the algorithm
     start_date = pd.Timestamp(BacktestSetting.start_date)
@@ -300,6 +339,7 @@ def run(Setting, scores_, assets_):
                             end=end_date,
                             initialize=initialize,
                             before_trading_start=before_trading_start,
+                            analyze=analyze,
                             capital_base=BacktestSetting.initial_cash,
                             data_frequency='daily',
                             bundle='quandl_custom_bundle',
@@ -307,17 +347,77 @@ def run(Setting, scores_, assets_):
 
     # Extract performance metrics
     returns, positions, transactions = pf.utils.extract_rets_pos_txn_from_zipline(results)
+    return results, returns, positions, transactions
+
+
+def create_results_dir(Setting):
+    """
+    Create a uniquely named, timestamped results directory and save the settings into it.
+    The random suffix keeps runs started at the same moment in different workers apart.
+    """
+    run_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{uuid.uuid4().hex[:8]}"
+    results_dir = os.path.join('./plots/temp', run_id)
+    os.makedirs(results_dir)
+    save_backtest_setting(Setting, results_dir)
+    return results_dir
+
+
+def save_results(results_dir, results, returns, positions, transactions):
+    """
+    Save the simulation outputs as Parquet tables in the results directory and return their path.
+    """
+    return write_results(results_dir, results, returns, positions, transactions)
+
+
+def run(Setting, scores_, assets_, engine='zipline', score_values_=None):
+    """
+    Main function to run the backtest with the provided settings, scores, and assets.
+    score_values_ passes scores already aligned in a shared memory map, see simulate.
+    """
+    global BacktestSetting
+    BacktestSetting = Setting
+    run_start = time.perf_counter()
+
+    # Create a directory to save the results
+    results_dir = create_results_dir(BacktestSetting)
+
+    if BacktestSetting.do_log:
+        # Set up logging if enabled
+        log_file_path = os.path.join(results_dir, 'record.log')
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
+
+        logging.basicConfig(
+            filename=log_file_path,  # Log file path
+            level=logging.INFO,  # Log level (INFO, DEBUG, WARNING, etc.)
+            format='%(asctime)s - %(levelname)s - %(message)s',  # Log format
+            datefmt='%Y-%m-%d %H:%M:%S'  # Date format
+        )
 
-    # Save results to an HDF5 file
-    results_file_path = os.path.join(results_dir, 'results.h5')
-    with pd.HDFStore(results_file_path) as store:
-        store['results'] = results
-        store['returns'] = returns
-        store['positions'] = positions
-        store['transactions'] = transactions
+    # Run the simulation with the selected engine
+    results, returns, positions, transactions = simulate(Setting, scores_, assets_, engine=engine,
+                                                          score_values_=score_values_)
+
+    # Save results to the Parquet result store
+    results_file_path = save_results(results_dir, results, returns, positions, transactions)
+
+    # Score the run and index it in the catalog with its settings, runtime and metrics
+    try:
+        benchmark = load_benchmark(BacktestSetting.primaryindex, BacktestSetting.start_date,
+                                   BacktestSetting.end_date)
+    except Exception as e:
+        print(f"Benchmark for {BacktestSetting.primaryindex} unavailable, skipping beta and alpha: {e}")
+        benchmark = None
+    row = record_run(results_dir, BacktestSetting, returns, results, transactions,
+                     runtime_seconds=time.perf_counter() - run_start, engine=engine,
+                     positions=positions, benchmark=benchmark)
+    print(f"Sharpe {row['sharpe']}, Sortino {row['sortino']}, CAGR {row['annual_return']}, "
+          f"max drawdown {row['max_drawdown']}, turnover {row['turnover']}, hit rate {row['hit_rate']}, "
+          f"beta {row['beta']}, alpha {row['alpha']}")
 
     if BacktestSetting.do_log:
         logging.info(f"Results saved to {results_file_path}")
+    return results_dir
 
 
 def parse_args():
@@ -349,6 +449,8 @@ def parse_args():
     parser.add_argument("--do-short", action='store_true', help="Enable shorting in the strategy")
     parser.add_argument("--do-log", action='store_true', help="Enable logging during the backtest")
     parser.add_argument("--days-offset", type=int, default=10, help="Offset for the rebalancing schedule")
+    parser.add_argument("--engine", type=str, choices=["zipline", "vectorized"], default="zipline",
+                        help="Simulation engine (vectorized supports the Rebalance exit mode only)")
 
     args = parser.parse_args()
     return args
@@ -387,4 +489,4 @@ if __name__ == "__main__":
     scores, assets = load_score(bundle_data, BacktestSetting)
 
     # Run the backtest
-    run(BacktestSetting, scores, assets)
\ No newline at end of file
+    run(BacktestSetting, scores, assets, engine=args.engine)
\ No newline at end of file
@@ -0,0 +1,161 @@
+import os
+import glob
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+# Trading days per year used to annualize daily statistics
+periods_per_year = 252
+
+return_metrics = ['total_return', 'annual_return', 'annual_volatility', 'sharpe', 'sortino', 'max_drawdown',
+                  'hit_rate', 'beta', 'alpha', 'n_days']
+
+
+def _naive_dates(index):
+    index = pd.DatetimeIndex(index)
+    return (index.tz_convert(None) if index.tz is not None else index).normalize()
+
+
+def returns_matrix(returns, benchmark=None):
+    """
+    Align daily return series into a days x runs array, NaN where a run has no return.
+    returns is a list or a {name: Series} dict. Returns (dates, matrix, names, benchmark array or None).
+    """
+    series = returns if isinstance(returns, dict) else dict(enumerate(returns))
+    frame = pd.concat({name: pd.Series(r.values, index=_naive_dates(r.index)) for name, r in series.items()},
+                      axis=1).sort_index()
+    aligned = None
+    if benchmark is not None:
+        benchmark = pd.Series(benchmark.values, index=_naive_dates(benchmark.index))
+        aligned = benchmark[~benchmark.index.duplicated()].reindex(frame.index).values.astype(float)
+    return frame.index, frame.values.astype(float), list(frame.columns), aligned
+
+
+def batch_metrics(matrix, benchmark=None, periods=periods_per_year):
+    """
+    Compute return-based metrics for every column of a days x runs matrix of daily returns at once.
+    NaNs mark days outside a run. Returns a {metric: array over runs} dict:
+    total and annual (compound) return, annual volatility, Sharpe and Sortino ratios, maximum
+    drawdown, hit rate (share of positive days among days with a non-zero return) and, when a
+    benchmark array aligned to the rows is given, beta and annualized alpha against it.
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    if matrix.ndim == 1:
+        matrix = matrix[:, None]
+    valid = ~np.isnan(matrix)
+    filled = np.where(valid, matrix, 0.0)
+    n_days = valid.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = filled.sum(axis=0) / n_days
+        deviation = np.where(valid, matrix - mean, 0.0)
+        volatility = np.sqrt((deviation ** 2).sum(axis=0) / (n_days - 1))
+        downside = np.sqrt((np.minimum(filled, 0) ** 2).sum(axis=0) / n_days)
+
+        wealth = np.cumprod(1 + filled, axis=0)
+        final = wealth[-1]
+        peak = np.maximum.accumulate(np.maximum(wealth, 1), axis=0)
+
+        metrics = {
+            'total_return': final - 1,
+            'annual_return': np.where(final > 0, np.abs(final) ** (periods / n_days) - 1, -1.0),
+            'annual_volatility': volatility * np.sqrt(periods),
+            'sharpe': np.where(volatility > 0, mean / volatility * np.sqrt(periods), np.nan),
+            'sortino': np.where(downside > 0, mean * periods / (downside * np.sqrt(periods)), np.nan),
+            'max_drawdown': (wealth / peak - 1).min(axis=0),
+            'hit_rate': (filled > 0).sum(axis=0) / (filled != 0).sum(axis=0),
+            'beta': np.full(matrix.shape[1], np.nan),
+            'alpha': np.full(matrix.shape[1], np.nan),
+            'n_days': n_days.astype(float),
+        }
+
+        if benchmark is not None:
+            # Regress each run on the benchmark over the days both have a return
+            benchmark = np.asarray(benchmark, dtype=float)[:, None]
+            both = valid & ~np.isnan(benchmark)
+            count = both.sum(axis=0)
+            x = np.where(both, benchmark, 0.0)
+            y = np.where(both, matrix, 0.0)
+            x_mean = x.sum(axis=0) / count
+            y_mean = y.sum(axis=0) / count
+            x_dev = np.where(both, x - x_mean, 0.0)
+            y_dev = np.where(both, y - y_mean, 0.0)
+            variance = (x_dev ** 2).sum(axis=0)
+            beta = np.where(variance > 0, (x_dev * y_dev).sum(axis=0) / variance, np.nan)
+            metrics['beta'] = beta
+            metrics['alpha'] = (y_mean - beta * x_mean) * periods
+
+    return metrics
+
+
+def turnover(positions, transactions):
+    """
+    Average daily turnover: traded value over gross position value, averaged over days with positions.
+    """
+    if positions is None or transactions is None or not len(positions):
+        return np.nan
+    gross = positions.drop(columns='cash', errors='ignore').abs().sum(axis=1)
+    gross = pd.Series(gross.values, index=_naive_dates(gross.index))
+    if len(transactions):
+        traded = np.abs(transactions['amount'].values * transactions['price'].values)
+        traded = pd.Series(traded, index=_naive_dates(transactions.index)).groupby(level=0).sum()
+        traded = traded.reindex(gross.index, fill_value=0.0)
+    else:
+        traded = pd.Series(0.0, index=gross.index)
+    held = gross.values > 0
+    return float((traded.values[held] / gross.values[held]).mean()) if held.any() else np.nan
+
+
+def compute_metrics(returns, positions=None, transactions=None, benchmark=None):
+    """
+    Metrics of one run as a dict of floats, from its daily returns and optionally its positions,
+    transactions and benchmark returns.
+    """
+    _, matrix, _, aligned = returns_matrix([returns], benchmark)
+    metrics = {name: float(values[0]) for name, values in batch_metrics(matrix, aligned).items()}
+    metrics['turnover'] = turnover(positions, transactions)
+    return metrics
+
+
+def score_runs(results_dirs, benchmark=None):
+    """
+    Score many runs together: read their stored returns, stack them into one matrix and compute
+    the return-based metrics in one pass. Returns a DataFrame with one row per results directory.
+    """
+    from results_store import load_results
+
+    returns = {results_dir: load_results(results_dir, tables=['returns'])['returns'] for results_dir in results_dirs}
+    _, matrix, names, aligned = returns_matrix(returns, benchmark)
+    return pd.DataFrame(batch_metrics(matrix, aligned), index=pd.Index(names, name='results_dir'))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Score backtest runs from their stored returns")
+    parser.add_argument("--base-dir", type=str, default="./plots/temp", help="Directory of backtest runs")
+    parser.add_argument("--primaryindex", type=str, default=None,
+                        help="Only score runs on this primary index, against its benchmark")
+    parser.add_argument("--sort-by", type=str, default="sharpe", help="Metric to rank runs by")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    results_dirs = []
+    for settings_file in sorted(glob.glob(os.path.join(args.base_dir, '*', 'BacktestSetting.json'))):
+        with open(settings_file, 'r') as f:
+            primaryindex = json.load(f).get('primaryindex')
+        if args.primaryindex is None or primaryindex == args.primaryindex:
+            results_dirs.append(os.path.dirname(settings_file))
+
+    benchmark = None
+    if args.primaryindex is not None:
+        from utils import load_benchmark
+        benchmark = load_benchmark(args.primaryindex)
+
+    start = time.perf_counter()
+    scores = score_runs(results_dirs, benchmark)
+    print(scores.sort_values(args.sort_by, ascending=False).to_string())
+    print(f"Scored {len(scores)} runs in {time.perf_counter() - start:.2f}s")
@@ -1,34 +1,60 @@
 import os
 import json
-import pandas as pd
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import pyfolio as pf
 import warnings
-from utils import (
-    get_russell1000_data,
-    get_russell2000_data,
-    get_sp500_etf_data,
-)
+from results_store import has_results, load_results, legacy_name, store_name
+from utils import benchmark_loaders, load_benchmark
 
 warnings.filterwarnings("ignore")
 
+# Name of the tear sheet pyfolio writes into each results directory
+aggregated_filename = "full_tearsheet.html"
 
-def plotting(results, results_dir, benchmark, LIVE_DATE='2022-12-10'):
+
+def _input_paths(results_dir):
+    """
+    Files a report is built from: the settings and the stored results in either format.
+    """
+    paths = [os.path.join(results_dir, 'BacktestSetting.json'), os.path.join(results_dir, legacy_name)]
+    store_dir = os.path.join(results_dir, store_name)
+    if os.path.isdir(store_dir):
+        paths.extend(os.path.join(store_dir, name) for name in os.listdir(store_dir))
+    return [path for path in paths if os.path.exists(path)]
+
+
+def is_up_to_date(results_dir):
+    """
+    True when the tear sheet exists and is newer than the settings and results it was built from.
+    """
+    output_path = os.path.join(results_dir, aggregated_filename)
+    if not os.path.exists(output_path):
+        return False
+    inputs = _input_paths(results_dir)
+    return bool(inputs) and os.path.getmtime(output_path) >= max(os.path.getmtime(path) for path in inputs)
+
+
+def plotting(results, returns, positions, transactions, results_dir, benchmark, LIVE_DATE='2022-12-10',
+             rewrite=True, round_trips=True):
     """
     Plot various financial metrics and save results as a tear sheet.
 
     Parameters:
-        results (pd.DataFrame): The backtest results data.
+        results (pd.DataFrame): The backtest daily metrics, including ending_cash.
+        returns (pd.Series): Daily strategy returns.
+        positions (pd.DataFrame): Daily position values, including cash.
+        transactions (pd.DataFrame): Executed transactions.
         results_dir (str): Directory where results will be saved.
         benchmark (pd.Series): Benchmark returns to compare against.
         LIVE_DATE (str): Date when the live trading started.
+        rewrite (bool): Whether an existing tear sheet should be overwritten.
+        round_trips (bool): Whether to include the round trip analysis, the slowest part of the tear sheet.
     """
-    # Extract performance metrics from the backtest results
-    returns, positions, transactions = pf.utils.extract_rets_pos_txn_from_zipline(results)
-    rewrite = True  # Flag to determine if existing plots should be overwritten
-
-    # Define the filename for the aggregated full tear sheet
-    aggregated_filename = "full_tearsheet.html"
+    # Path of the aggregated full tear sheet
     aggregated_file_path = os.path.join(results_dir, aggregated_filename)
 
     # Check if the file already exists
@@ -52,25 +78,29 @@ def plotting(results, results_dir, benchmark, LIVE_DATE='2022-12-10'):
     ax.grid(True)
 
     fig.tight_layout()
-    plt.savefig(os.path.join("./plots/temp", 'ending_cash.png'), bbox_inches='tight')
+    plt.savefig(os.path.join(results_dir, 'ending_cash.png'), bbox_inches='tight')
+    plt.close(fig)
 
     # Generate and save a full tear sheet using pyfolio
     pf.create_full_tear_sheet(returns,
                               positions=positions,
                               transactions=transactions,
                               benchmark_rets=benchmark,
-                              round_trips=True,
+                              round_trips=round_trips,
                               results_dir=results_dir,
                               live_start_date=LIVE_DATE
                               )
+    plt.close('all')
 
 
-def process_backtest_results(results_dir):
+def process_backtest_results(results_dir, rewrite=True, round_trips=True):
     """
     Process backtest results from a given directory.
 
     Parameters:
         results_dir (str): Directory containing the backtest results and settings.
+        rewrite (bool): Whether an existing tear sheet should be overwritten.
+        round_trips (bool): Whether to include the round trip analysis.
     """
     # Load the backtest settings from the JSON file
     settings_file = os.path.join(results_dir, 'BacktestSetting.json')
@@ -82,42 +112,66 @@ def process_backtest_results(results_dir):
         BacktestSetting = json.load(f)
 
     # Determine the benchmark data based on the primary index in the settings
-    if BacktestSetting['primaryindex'] == "S&P 500":
-        benchmark = get_sp500_etf_data(BacktestSetting['start_date'], BacktestSetting['end_date'])
-    elif BacktestSetting['primaryindex'] == "Russell 2000":
-        benchmark = get_russell2000_data(BacktestSetting['start_date'], BacktestSetting['end_date'])
-    elif BacktestSetting['primaryindex'] == "Russell 1000":
-        benchmark = get_russell1000_data(BacktestSetting['start_date'], BacktestSetting['end_date'])
-    else:
+    if BacktestSetting['primaryindex'] not in benchmark_loaders:
         print(f"Unknown primary index {BacktestSetting['primaryindex']} in {results_dir}. Skipping...")
         return
+    benchmark = load_benchmark(BacktestSetting['primaryindex'], BacktestSetting['start_date'],
+                               BacktestSetting['end_date'])
 
-    # Load the results from the HDF5 file
-    results_file = os.path.join(results_dir, 'results.h5')
-    if not os.path.exists(results_file):
+    # Load the results from the Parquet store, or from results.h5 for runs saved before it
+    if not has_results(results_dir) and not os.path.exists(os.path.join(results_dir, legacy_name)):
         print(f"Results file not found in {results_dir}. Skipping...")
         return
 
-    results = pd.read_hdf(results_file, 'results')
+    # Returns, positions and transactions are stored by main.run for both simulation engines
+    tables = load_results(results_dir)
+    results = tables['metrics']
+    returns = tables['returns']
+    positions = tables['positions']
+    transactions = tables['transactions']
 
     # Generate and save the plots and tear sheet
     LIVE_DATE = '2022-12-10'
-    plotting(results, results_dir, benchmark, LIVE_DATE)
+    plotting(results, returns, positions, transactions, results_dir, benchmark, LIVE_DATE,
+             rewrite=rewrite, round_trips=round_trips)
 
 
-def main():
+def main(base_dir="./plots/temp", n_workers=None, rewrite=False, round_trips=True):
     """
-    Main function to process all backtest results in the specified base directory.
+    Build the tear sheets of all backtest results in the base directory on a process pool.
+    Runs whose tear sheet is newer than their settings and results are skipped unless rewrite is set,
+    and a failing run is reported without stopping the others.
     """
-    base_dir = "./plots/temp"
-
-    # Loop through all directories in the base directory
-    for dir_name in os.listdir(base_dir):
-        results_dir = os.path.join(base_dir, dir_name)
-        if os.path.isdir(results_dir):  # Process only directories
-            print(f"Processing backtest results in {results_dir}...")
-            process_backtest_results(results_dir)
+    # Process only directories that need a new report
+    results_dirs = [os.path.join(base_dir, dir_name) for dir_name in sorted(os.listdir(base_dir))]
+    results_dirs = [results_dir for results_dir in results_dirs if os.path.isdir(results_dir)]
+    pending = [results_dir for results_dir in results_dirs if rewrite or not is_up_to_date(results_dir)]
+    print(f"{len(pending)} of {len(results_dirs)} backtest results need a report")
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(process_backtest_results, results_dir, True, round_trips): results_dir
+                   for results_dir in pending}
+        for future in as_completed(futures):
+            results_dir = futures[future]
+            try:
+                future.result()
+                print(f"Processed backtest results in {results_dir}")
+            except Exception as e:
+                failed.append(results_dir)
+                print(f"Failed to process {results_dir}: {e}")
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build tear sheets for backtest results")
+    parser.add_argument("--base-dir", type=str, default="./plots/temp", help="Directory of backtest runs")
+    parser.add_argument("--n-workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--rewrite", action='store_true', help="Rebuild tear sheets that are up to date")
+    parser.add_argument("--no-round-trips", action='store_true', help="Skip the round trip analysis")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    main(args.base_dir, n_workers=args.n_workers, rewrite=args.rewrite, round_trips=not args.no_round_trips)
@@ -0,0 +1,127 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def round_order_amounts(amounts):
+    """
+    Vectorized zipline order rounding: snap to integers within 1e-4, then truncate toward zero.
+    """
+    rounded = np.round(amounts)
+    amounts = np.where(np.abs(amounts - rounded) <= 1e-4, rounded, amounts)
+    return np.trunc(amounts)
+
+
+def cancel_open_orders(context):
+    """
+    Cancel every open order, one blotter call per asset instead of one cancel_order call per order.
+    """
+    for asset in list(context.blotter.open_orders):
+        context.blotter.cancel_all_orders_for_asset(asset, warn=False)
+
+
+def set_target_portfolio(context, data, targets):
+    """
+    Move the portfolio to the given asset -> target value mapping in a single batch.
+
+    Stale open orders are cancelled first. Held assets missing from targets are closed, and only
+    non-zero share deltas are submitted through one batch_market_order call. batch_market_order
+    skips the per-order checks order() makes, so closes and targets are both filtered through
+    data.can_trade first: an asset that cannot trade today is left for the next rebalance.
+    Returns (n_opened, n_closed).
+    """
+    from zipline.api import batch_market_order
+
+    cancel_open_orders(context)
+    positions = context.portfolio.positions
+
+    # Close all positions not in the target portfolio
+    to_close = {stock: -position.amount for stock, position in positions.items()
+                if stock not in targets and position.amount != 0}
+    if to_close:
+        closable = data.can_trade(list(to_close))
+        to_close = {stock: amount for stock, amount in to_close.items() if closable[stock]}
+
+    # Diff target shares against current holdings
+    target_assets = list(targets)
+    to_open = {}
+    if target_assets:
+        tradable = data.can_trade(target_assets).values
+        prices = data.current(target_assets, 'price').values
+        held = np.array([positions[stock].amount if stock in positions else 0 for stock in target_assets])
+        target_values = np.fromiter(targets.values(), dtype=float, count=len(targets))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            deltas = round_order_amounts(target_values / prices - held)
+        to_order = tradable & np.isfinite(deltas) & (deltas != 0)
+        to_open = {target_assets[i]: int(deltas[i]) for i in np.flatnonzero(to_order)}
+
+    if to_close or to_open:
+        batch_market_order(pd.Series({**to_close, **to_open}))
+
+    return len(to_open), len(to_close)
+
+
+def benchmark_order_submission(name_counts=(100, 250, 500, 1000, 2000), start_date='2019-01-02',
+                               end_date='2019-03-29', bundle_name='quandl_custom_bundle'):
+    """
+    Measure per-rebalance latency of per-asset order_target_value calls against set_target_portfolio
+    as the number of names grows. Each session flips the whole book between two halves of the
+    universe so every rebalance closes and opens n names.
+    """
+    from zipline import run_algorithm
+    from zipline.api import cancel_order, order_target_value, schedule_function, date_rules, time_rules
+    from zipline.data import bundles
+
+    bundle = bundles.load(bundle_name)
+    as_of = pd.Timestamp(start_date)
+    equities = [asset for asset in bundle.asset_finder.retrieve_all(bundle.asset_finder.equities_sids)
+                if asset.start_date <= as_of and asset.end_date >= pd.Timestamp(end_date)]
+
+    rows = []
+    for n_names in name_counts:
+        universe = equities[:2 * n_names]
+        for method in ['order_target_value', 'set_target_portfolio']:
+            latencies = []
+
+            def initialize(context):
+                context.flip = 0
+                schedule_function(rebalance, date_rules.every_day(), time_rules.market_close())
+
+            def rebalance(context, data):
+                names = universe[context.flip::2]
+                context.flip = 1 - context.flip
+                target_value = int(context.portfolio.portfolio_value / len(names))
+                start = time.perf_counter()
+                if method == 'order_target_value':
+                    for order in [o for orders in context.blotter.open_orders.values() for o in orders]:
+                        cancel_order(order.id)
+                    for stock in context.portfolio.positions:
+                        if stock not in names:
+                            order_target_value(stock, 0)
+                    for stock in names:
+                        if data.can_trade(stock):
+                            order_target_value(stock, target_value)
+                else:
+                    set_target_portfolio(context, data, dict.fromkeys(names, target_value))
+                latencies.append(time.perf_counter() - start)
+
+            run_algorithm(start=pd.Timestamp(start_date), end=pd.Timestamp(end_date), initialize=initialize,
+                          capital_base=1e7, data_frequency='daily', bundle=bundle_name)
+            rows.append({'names': n_names, 'method': method, 'ms_per_rebalance': np.mean(latencies) * 1000})
+
+    table = pd.DataFrame(rows).pivot(index='names', columns='method', values='ms_per_rebalance')
+    table['speedup'] = table['order_target_value'] / table['set_target_portfolio']
+    print(table.round(2))
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched target-portfolio order submission")
+    parser.add_argument("--names", type=int, nargs='+', default=[100, 250, 500, 1000, 2000])
+    args = parser.parse_args()
+
+    from zipline.utils.run_algo import load_extensions
+    load_extensions(default=True, extensions=[], strict=True, environ=None)
+    benchmark_order_submission(args.names)
@@ -1,9 +1,14 @@
+import os
+import time
+import argparse
+import tempfile
+import multiprocessing as mp
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 from pathlib import Path
 import warnings
-from tqdm import tqdm
-from zipline.utils.calendar_utils import get_calendar
-from joblib import Parallel, delayed
+from benchmark_utils import measure_loader
 
 warnings.filterwarnings('ignore')
 
@@ -15,34 +20,117 @@ ticker_data_name = 'QUOTEMEDIA_TICKERS_6d75499fefd916e54334b292986eafcc.csv'
 idx = pd.IndexSlice
 
 
-def load_prices():
-    start_date = '2008-01-10'
-    end_date = '2022-12-31'
-
-    df = pd.read_csv(custom_data_path / hist_data_name)
-    print(len(df.ticker.unique()))
+# Columns of the QuoteMedia price file used to build the bundle
+price_fields = ['adj_open', 'adj_high', 'adj_low', 'adj_close', 'adj_volume']
+price_dtypes = {'adj_open': 'float32', 'adj_high': 'float32', 'adj_low': 'float32', 'adj_close': 'float32',
+                'adj_volume': 'float64'}
+
+# Column types of the prices frame in quandl.h5
+store_dtypes = {'adj_open': 'float32', 'adj_high': 'float32', 'adj_low': 'float32', 'adj_close': 'float32',
+                'adj_volume': 'int32'}
+
+
+def _ffill(values):
+    """
+    Forward-fill NaNs down each column of a sessions x tickers array.
+    """
+    rows = np.where(np.isnan(values), 0, np.arange(len(values))[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return values[rows, np.arange(values.shape[1])]
+
+
+def _fill_leading(values):
+    """
+    Fill sessions before each ticker's first price the way the frame-wide ffill/bfill over the
+    ticker-major frame always has: with the previous ticker's last value, and with the first
+    value of the frame for the leading tickers.
+    """
+    missing = np.isnan(values)
+    if not missing.any():
+        return values
+    carry = np.empty(values.shape[1], dtype=values.dtype)
+    carry[0] = np.nan
+    carry[1:] = pd.Series(values[-1]).ffill().values[:-1]
+
+    has_value = np.flatnonzero(~missing.all(axis=0))
+    if len(has_value):
+        first = has_value[0]
+        carry = np.where(np.isnan(carry), values[np.argmax(~missing[:, first]), first], carry)
+    return np.where(missing, carry[None, :], values)
+
+
+def nyse_sessions(start_date, end_date):
+    """
+    Tz-naive NYSE sessions between start_date and end_date. zipline is imported here so the
+    array helpers in this module can be used without it.
+    """
+    from zipline.utils.calendar_utils import get_calendar
+    sessions = get_calendar('NYSE').sessions_in_range(start=start_date, end=end_date)
+    return pd.DatetimeIndex(sessions).tz_localize(None)
+
+
+def read_prices(path, trading_days, chunksize=1_000_000):
+    """
+    Read the price file in chunks with explicit columns and dtypes, keeping only trading days.
+    Returns categorical tickers, session positions and one value array per field.
+    """
+    tickers, positions, values = [], [], {field: [] for field in price_fields}
+    for chunk in pd.read_csv(path, usecols=['ticker', 'date'] + price_fields,
+                             dtype={'ticker': 'category', **price_dtypes}, chunksize=chunksize):
+        session_pos = trading_days.get_indexer(pd.to_datetime(chunk['date'], format='%Y-%m-%d'))
+        keep = session_pos >= 0
+        tickers.append(chunk['ticker'].values[keep])
+        positions.append(session_pos[keep])
+        for field in price_fields:
+            values[field].append(chunk[field].values[keep])
+
+    tickers = union_categoricals(tickers, sort_categories=True).remove_unused_categories()
+    return (tickers, np.concatenate(positions),
+            {field: np.concatenate(chunks) for field, chunks in values.items()})
+
+
+def load_prices(path=custom_data_path / hist_data_name, start_date='2008-01-10', end_date='2022-12-31'):
+    """
+    Build the (ticker, date) price frame on NYSE sessions, forward-filled within each ticker.
+    All tickers are scattered into one sessions x tickers array per field, so reindexing and
+    filling are single array operations instead of a per-ticker groupby apply.
+    """
+    trading_days = nyse_sessions(start_date, end_date)
+
+    tickers, session_pos, values = read_prices(path, trading_days)
+    ticker_pos = tickers.codes
+    n_sessions, n_tickers = len(trading_days), len(tickers.categories)
+    print(n_tickers)
+
+    # Session-major rows with tickers sorted inside each session, as the unstack/stack round trip produced
+    columns = {}
+    for field in price_fields:
+        panel = np.full((n_sessions, n_tickers), np.nan, dtype=values[field].dtype)
+        panel[session_pos, ticker_pos] = values[field]
+        columns[field] = _fill_leading(_ffill(panel)).ravel()
+
+    index = pd.MultiIndex(levels=[pd.Index(tickers.categories, dtype=object), trading_days.tz_localize('UTC')],
+                          codes=[np.tile(np.arange(n_tickers), n_sessions), np.repeat(np.arange(n_sessions), n_tickers)],
+                          names=['ticker', 'date'])
+    return pd.DataFrame(columns, index=index)
+
+
+def _load_prices_groupby(path=custom_data_path / hist_data_name, start_date='2008-01-10', end_date='2022-12-31'):
+    # Previous implementation, kept for benchmark_load_prices
+    df = pd.read_csv(path)
     df.date = pd.to_datetime(df.date)
     df = df.set_index(['ticker', 'date']).sort_index(level=0)
 
-    nyse_calendar = get_calendar('NYSE')
-    trading_days = nyse_calendar.sessions_in_range(start=start_date, end=end_date)
+    trading_days = nyse_sessions(start_date, end_date)
     df = df[df.index.get_level_values('date').isin(trading_days)]
 
-    def reindex_trading_days(df, trading_days):
-        def reindex_group(group):
-            group = group.droplevel('ticker')
-            return group.reindex(trading_days, method='ffill')
-        new_df = df.groupby(level='ticker').apply(reindex_group)
-
-        return new_df
+    def reindex_group(group):
+        group = group.droplevel('ticker')
+        return group.reindex(trading_days, method='ffill')
 
-    # Apply the reindexing function
-    df = reindex_trading_days(df, trading_days)
+    df = df.groupby(level='ticker').apply(reindex_group)
     df.index.set_names(['ticker', 'date'], inplace=True)
-
-    # Fill the remaining NaN values
-    df = df.fillna(method='ffill').fillna(method='bfill')
-    print(len(df.index.get_level_values('ticker').unique()))
+    df = df.ffill().bfill()
 
     return (df.loc[idx[:, start_date:end_date], :]
             .unstack('ticker')
@@ -52,6 +140,58 @@ def load_prices():
             .swaplevel())
 
 
+def write_synthetic_prices(path, n_tickers=2000, start_date='2007-06-01', end_date='2022-12-31', seed=0):
+    """
+    Write a QuoteMedia-shaped price file with staggered listings, delistings and missing days.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(start_date, end_date)
+    columns = ['ticker', 'date', 'open', 'high', 'low', 'close', 'volume', 'dividend', 'split'] + price_fields
+    with open(path, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for i in range(n_tickers):
+            first, last = np.sort(rng.integers(0, len(dates), 2))
+            days = dates[first:last + 1]
+            days = days[rng.random(len(days)) > 0.02]
+            prices = np.round(np.exp(np.cumsum(rng.normal(0, 0.02, len(days)))) * 50, 4)
+            volume = rng.integers(1000, 10_000_000, len(days))
+            frame = pd.DataFrame({'ticker': f'T{i:05d}', 'date': days.strftime('%Y-%m-%d'),
+                                  'open': prices, 'high': prices, 'low': prices, 'close': prices, 'volume': volume,
+                                  'dividend': 0.0, 'split': 1.0, 'adj_open': prices, 'adj_high': prices,
+                                  'adj_low': prices, 'adj_close': prices, 'adj_volume': volume})
+            frame.to_csv(f, header=False, index=False)
+    return os.path.getsize(path)
+
+
+def benchmark_load_prices(n_tickers=2000):
+    """
+    Compare wall time and peak RSS of the groupby/apply load_prices against the vectorized one
+    on a synthetic price file, each in a fresh process, and check both give the same frame.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir, 'prices.csv')
+        size = write_synthetic_prices(path, n_tickers)
+        print(f'Synthetic price file: {size / 2 ** 20:.0f} MB, {n_tickers} tickers')
+
+        ctx = mp.get_context('spawn')
+        stats = {}
+        for name, loader in [('groupby', _load_prices_groupby), ('vectorized', load_prices)]:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=measure_loader, args=(loader, (path,), queue))
+            proc.start()
+            stats[name] = queue.get()
+            proc.join()
+
+        expected = _load_prices_groupby(path)[price_fields]
+        result = load_prices(path)
+        assert expected.index.equals(result.index)
+        assert np.allclose(expected.values, result.values, rtol=1e-6, equal_nan=True)
+
+    for name, (elapsed, rss, rows) in stats.items():
+        print(f'{name:>10}: {elapsed:.2f}s, peak RSS {rss:.0f} MB, {rows} rows')
+    return stats
+
+
 def load_symbols(tickers):
     df = pd.read_csv(custom_data_path / ticker_data_name)
     return (df[df.ticker.isin(tickers)]
@@ -82,52 +222,117 @@ def create_dividend_table(data):
         store.put('dividends', df[['sid', 'ex_date', 'record_date', 'declared_date', 'pay_date', 'amount']], format='t')
 """
 
-if __name__ == '__main__':
-    prices = load_prices()
-    print(prices.info(null_counts=True))
-    tickers = prices.index.unique('ticker')
-
-    symbols = load_symbols(tickers)
-    print(symbols.info(null_counts=True))
-    print(">>> storing equities")
-
-    symbols.to_hdf(custom_data_path / 'quandl.h5', 'equities', format='t')
-
-    dates = prices.index.unique('date')
-    start_date = dates.min()
-    end_date = dates.max()
 
-    sid_map = symbols[['ticker', 'sid']].set_index('ticker')['sid'].to_dict()
-    temp = prices.reset_index()
-    prices['sid'] = temp['ticker'].map(sid_map).values
-
-    print(">>> storing prices")
-    # Ensure custom_data_path is defined
-
-    def save_prices_to_hdf(sid, symbol, prices, custom_data_path):
+def build_price_store(prices, symbols):
+    """
+    Partition the (ticker, date) price frame by ticker with one stable sort.
+    Returns the ticker-sorted rows and the (start, stop) row range of every sid; sids that share
+    a ticker share its rows.
+    """
+    codes, tickers = pd.factorize(prices.index.get_level_values('ticker'), sort=True)
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(tickers))
+    stops = np.cumsum(counts)
+    starts = stops - counts
+
+    # Dates are stored as naive UTC, as the per-sid frames were
+    frame = pd.DataFrame({'date': prices.index.get_level_values('date').values[order]})
+    for field, dtype in store_dtypes.items():
+        frame[field] = prices[field].values[order].astype(dtype)
+
+    positions = pd.Index(tickers).get_indexer(symbols.ticker)
+    offsets = pd.DataFrame({'start': starts[positions], 'stop': stops[positions]},
+                           index=pd.Index(symbols.sid.values, name='sid'))
+    return frame, offsets
+
+
+def write_price_store(prices, symbols, path=custom_data_path / 'quandl.h5'):
+    """
+    Write equities, the sid-sorted prices and the per-sid row ranges in bulk to a temporary file,
+    then replace path in one step so a failed build never leaves a partial quandl.h5.
+    """
+    start = time.perf_counter()
+    frame, offsets = build_price_store(prices, symbols)
+    tmp_path = Path(f'{path}.{os.getpid()}.tmp')
+    with pd.HDFStore(tmp_path, mode='w') as store:
+        store.put('equities', symbols, format='t')
+        store.put('prices', frame, format='fixed')
+        store.put('price_offsets', offsets, format='fixed')
+    os.replace(tmp_path, path)
+    print(f'Wrote {len(offsets)} sids, {len(frame)} rows in {time.perf_counter() - start:.1f}s')
+    return offsets
+
+
+def _write_prices_per_sid(prices, symbols, path):
+    # Previous layout, one table-format node per sid, kept for benchmark_price_writer
+    symbols.to_hdf(path, key='equities', format='t')
+    for sid, symbol in symbols.set_index('sid').ticker.items():
         p = prices.loc[symbol, ['adj_open', 'adj_high', 'adj_low', 'adj_close', 'adj_volume']]
         p.index = p.index.values
-
-        # Optimize data types
-        p = p.astype({
-            'adj_open': 'float32',
-            'adj_high': 'float32',
-            'adj_low': 'float32',
-            'adj_close': 'float32',
-            'adj_volume': 'int32'
-        })
-
-        # Save to HDF5
-        p.to_hdf(custom_data_path / 'quandl.h5', 'prices/{}'.format(sid), format='t')
+        p = p.astype(store_dtypes)
+        p.to_hdf(path, key='prices/{}'.format(sid), format='t')
+
+
+def benchmark_price_writer(n_tickers=2000, n_sessions=3750):
+    """
+    Time the per-sid writer against write_price_store on a synthetic (ticker, date) frame laid out
+    like load_prices output, and check a few sids read back the same from both layouts.
+    """
+    rng = np.random.default_rng(0)
+    tickers = pd.Index([f'T{i:05d}' for i in range(n_tickers)])
+    dates = pd.bdate_range('2008-01-10', periods=n_sessions, tz='UTC')
+    index = pd.MultiIndex(levels=[tickers, dates],
+                          codes=[np.tile(np.arange(n_tickers), n_sessions), np.repeat(np.arange(n_sessions), n_tickers)],
+                          names=['ticker', 'date'])
+    values = rng.random((len(index), 4)).astype('float32') * 100
+    prices = pd.DataFrame(values, index=index, columns=price_fields[:4])
+    prices['adj_volume'] = rng.integers(0, 10_000_000, len(index)).astype('float64')
+    symbols = pd.DataFrame({'sid': np.arange(n_tickers), 'ticker': tickers})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_path, bulk_path = Path(tmp_dir, 'legacy.h5'), Path(tmp_dir, 'bulk.h5')
+        start = time.perf_counter()
+        _write_prices_per_sid(prices, symbols, legacy_path)
+        legacy_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        write_price_store(prices, symbols, bulk_path)
+        bulk_seconds = time.perf_counter() - start
+
+        frame = pd.read_hdf(bulk_path, 'prices')
+        offsets = pd.read_hdf(bulk_path, 'price_offsets')
+        for sid in rng.choice(n_tickers, 5, replace=False):
+            expected = pd.read_hdf(legacy_path, f'prices/{sid}')
+            start_row, stop_row = offsets.loc[sid]
+            result = frame.iloc[start_row:stop_row].set_index('date')
+            assert np.array_equal(expected.index.values, result.index.values)
+            assert np.array_equal(expected.values, result.values)
+
+    print(f'{n_tickers} tickers x {n_sessions} sessions: per-sid {legacy_seconds:.1f}s, '
+          f'bulk {bulk_seconds:.1f}s, speedup {legacy_seconds / bulk_seconds:.0f}x')
+    return legacy_seconds, bulk_seconds
 
 
-    # Parallel processing
-    for sid, symbol in tqdm(symbols.set_index('sid').ticker.items(),
-                            total=len(symbols),
-                            bar_format='{l_bar}{bar} | {n_fmt}/{total_fmt}'):
-        save_prices_to_hdf(sid, symbol, prices, custom_data_path)
-
-
-    # Display the HDF5 file structure
-    with pd.HDFStore(custom_data_path / 'quandl.h5') as store:
-        print(store.info())
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build quandl.h5 from the QuoteMedia files")
+    parser.add_argument("--benchmark", action='store_true',
+                        help="Benchmark load_prices and the quandl.h5 writer on synthetic data")
+    parser.add_argument("--tickers", type=int, default=2000)
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_load_prices(args.tickers)
+        benchmark_price_writer(args.tickers)
+    else:
+        prices = load_prices()
+        print(prices.info(null_counts=True))
+        tickers = prices.index.unique('ticker')
+
+        symbols = load_symbols(tickers)
+        print(symbols.info(null_counts=True))
+
+        print(">>> storing equities and prices")
+        write_price_store(prices, symbols)
+
+        # Display the HDF5 file structure
+        with pd.HDFStore(custom_data_path / 'quandl.h5') as store:
+            print(store.info())
@@ -0,0 +1,256 @@
+import os
+import re
+import glob
+import time
+import shutil
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Sub-directory of a results directory holding one Parquet file per table
+store_name = 'results'
+legacy_name = 'results.h5'
+tables = ['returns', 'positions', 'transactions', 'metrics']
+
+compression = 'zstd'
+
+# Sid and symbol under which the cash column of the positions frame is stored
+cash_sid = -1
+
+# Assets that were written out as their repr, e.g. 'Equity(12 [AAPL])'
+asset_repr = re.compile(r'^\w+\((\d+) \[(.*)\]\)$')
+
+
+def _path(results_dir, table):
+    return os.path.join(results_dir, store_name, f'{table}.parquet')
+
+
+def _sid(asset):
+    if hasattr(asset, 'sid'):
+        return int(asset.sid)
+    match = asset_repr.match(str(asset))
+    return int(match.group(1)) if match else int(asset)
+
+
+def _symbol(asset):
+    if hasattr(asset, 'symbol'):
+        return str(asset.symbol)
+    match = asset_repr.match(str(asset))
+    return match.group(2) if match else str(asset)
+
+
+def _metrics_frame(results):
+    """
+    Keep the scalar daily columns of the zipline results frame. The object columns hold per-day
+    lists of orders, transactions and positions, which the other tables already cover.
+    """
+    return results[[name for name in results.columns if not results[name].dtype == object]]
+
+
+def _positions_frame(positions):
+    """
+    Stack the wide positions frame into (date, sid, symbol, value) rows, keeping only held positions.
+    """
+    assets = [asset for asset in positions.columns if not asset == 'cash']
+    held = positions[assets].stack()
+    held = held[held != 0]
+    frame = pd.DataFrame({'date': held.index.get_level_values(0),
+                          'sid': [_sid(asset) for asset in held.index.get_level_values(1)],
+                          'symbol': [_symbol(asset) for asset in held.index.get_level_values(1)],
+                          'value': held.values})
+    if 'cash' in positions.columns:
+        cash = pd.DataFrame({'date': positions.index, 'sid': cash_sid, 'symbol': 'cash',
+                             'value': positions['cash'].values})
+        frame = pd.concat([frame, cash], ignore_index=True)
+    frame['symbol'] = frame['symbol'].astype('category')
+    return frame
+
+
+def _transactions_frame(transactions):
+    frame = transactions.reset_index(drop=True)
+    frame['sid'] = [_sid(asset) for asset in frame['sid']]
+    frame['symbol'] = pd.Categorical([_symbol(asset) for asset in frame['symbol']])
+    frame['order_id'] = frame['order_id'].astype(str)
+    return frame
+
+
+def write_tables(root, frames, indexed=None):
+    """
+    Write {table: DataFrame} as compressed Parquet files in root and return root. The tables are
+    written to a temporary directory and renamed in one step. indexed lists the tables whose index
+    is stored, by default all of them.
+    """
+    tmp_root = f'{root}.{os.getpid()}.tmp'
+    os.makedirs(tmp_root, exist_ok=True)
+    for table, frame in frames.items():
+        pq.write_table(pa.Table.from_pandas(frame, preserve_index=indexed is None or table in indexed),
+                       os.path.join(tmp_root, f'{table}.parquet'), compression=compression)
+
+    shutil.rmtree(root, ignore_errors=True)
+    os.rename(tmp_root, root)
+    return root
+
+
+def write_results(results_dir, results, returns, positions, transactions):
+    """
+    Write the simulation outputs as compressed Parquet tables under results_dir/results and return
+    that directory.
+    """
+    frames = {
+        'returns': returns.rename('returns').to_frame(),
+        'positions': _positions_frame(positions),
+        'transactions': _transactions_frame(transactions),
+        'metrics': _metrics_frame(results),
+    }
+    return write_tables(os.path.join(results_dir, store_name), frames, indexed=['returns', 'metrics'])
+
+
+def has_results(results_dir):
+    return os.path.exists(_path(results_dir, 'metrics'))
+
+
+def load_returns(results_dir):
+    return pd.read_parquet(_path(results_dir, 'returns'))['returns']
+
+
+def load_metrics(results_dir, columns=None):
+    """
+    Read the scalar daily metrics, optionally only the given columns.
+    """
+    return pd.read_parquet(_path(results_dir, 'metrics'), columns=columns)
+
+
+def load_positions(results_dir):
+    """
+    Read the positions in pyfolio layout: one column per symbol held at any point, plus cash.
+    A symbol held under several sids, e.g. a reused ticker, is labelled 'symbol (sid)' so the
+    columns stay unique.
+    """
+    frame = pd.read_parquet(_path(results_dir, 'positions'))
+    wide = frame.pivot_table(index='date', columns='sid', values='value', aggfunc='sum', fill_value=0.0)
+    symbols = frame.drop_duplicates('sid').set_index('sid')['symbol'].astype(str)
+    # Cash goes last, as in the frame pyfolio extracts from zipline
+    wide = wide[sorted(wide.columns, key=lambda sid: sid == cash_sid)]
+    labels = symbols.reindex(wide.columns)
+    reused = labels.duplicated(keep=False)
+    labels[reused] = [f'{symbol} ({sid})' for sid, symbol in labels[reused].items()]
+    wide.columns = labels.values
+    wide.index.name = None
+    wide.columns.name = None
+    return wide
+
+
+def load_transactions(results_dir):
+    frame = pd.read_parquet(_path(results_dir, 'transactions'))
+    frame['symbol'] = frame['symbol'].astype(str)
+    frame.index = pd.DatetimeIndex(frame['dt'])
+    frame.index.name = None
+    return frame
+
+
+def load_results(results_dir, tables=tables):
+    """
+    Read the requested tables from results_dir, from the Parquet store when it exists and from a
+    legacy results.h5 otherwise. Returns a dict of table name to frame.
+    """
+    if has_results(results_dir):
+        loaders = {'returns': load_returns, 'positions': load_positions,
+                   'transactions': load_transactions, 'metrics': load_metrics}
+        return {table: loaders[table](results_dir) for table in tables}
+
+    # The legacy file stores the whole zipline frame under 'results'
+    keys = {'metrics': 'results'}
+    with pd.HDFStore(os.path.join(results_dir, legacy_name), mode='r') as store:
+        return {table: store[keys.get(table, table)] for table in tables}
+
+
+def convert_results(results_dir, remove=False):
+    """
+    Convert a legacy results.h5 in results_dir to the Parquet store, optionally removing the HDF5 file.
+    """
+    legacy_path = os.path.join(results_dir, legacy_name)
+    with pd.HDFStore(legacy_path, mode='r') as store:
+        results = store['results']
+        returns = store['returns']
+        positions = store['positions']
+        transactions = store['transactions']
+    root = write_results(results_dir, results, returns, positions, transactions)
+    if remove:
+        os.remove(legacy_path)
+    return root
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def compare_formats(results_dir):
+    """
+    Compare on-disk size and load time of results.h5 against the Parquet store for one run, for a
+    full load and for the returns plus ending cash read by plotting.
+    """
+    legacy_path = os.path.join(results_dir, legacy_name)
+    stats = {'hdf5_mb': os.path.getsize(legacy_path) / 2 ** 20,
+             'parquet_mb': _directory_size(os.path.join(results_dir, store_name)) / 2 ** 20}
+
+    start = time.perf_counter()
+    with pd.HDFStore(legacy_path, mode='r') as store:
+        for key in ['results', 'returns', 'positions', 'transactions']:
+            store[key]
+    stats['hdf5_full_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with pd.HDFStore(legacy_path, mode='r') as store:
+        store['results']['ending_cash']
+        store['returns']
+    stats['hdf5_plotting_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load_results(results_dir)
+    stats['parquet_full_seconds'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load_returns(results_dir)
+    load_metrics(results_dir, columns=['ending_cash'])
+    stats['parquet_plotting_seconds'] = time.perf_counter() - start
+    return stats
+
+
+def convert_all(base_dir='./plots/temp', remove=False, compare=False):
+    """
+    Convert every results.h5 under base_dir and optionally report size and load time per run.
+    Unreadable files are reported and skipped.
+    """
+    stats, converted = {}, []
+    for legacy_path in sorted(glob.glob(os.path.join(base_dir, '*', legacy_name))):
+        results_dir = os.path.dirname(legacy_path)
+        try:
+            convert_results(results_dir)
+        except Exception as e:
+            print(f'Skipping {results_dir}: {e}')
+            continue
+        converted.append(results_dir)
+        if compare:
+            stats[results_dir] = compare_formats(results_dir)
+            s = stats[results_dir]
+            print(f"{results_dir}: {s['hdf5_mb']:.1f} MB -> {s['parquet_mb']:.1f} MB, "
+                  f"full load {s['hdf5_full_seconds']:.2f}s -> {s['parquet_full_seconds']:.2f}s, "
+                  f"plotting load {s['hdf5_plotting_seconds']:.2f}s -> {s['parquet_plotting_seconds']:.3f}s")
+        if remove:
+            os.remove(legacy_path)
+    print(f'Converted {len(converted)} result directories in {base_dir}')
+    return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert backtest results.h5 files to the Parquet result store")
+    parser.add_argument("--base-dir", type=str, default="./plots/temp", help="Directory of backtest runs")
+    parser.add_argument("--compare", action='store_true', help="Report size and load time of both formats")
+    parser.add_argument("--remove", action='store_true', help="Remove each results.h5 after converting it")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    convert_all(args.base_dir, remove=args.remove, compare=args.compare)
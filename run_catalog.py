@@ -0,0 +1,338 @@
+import os
+import json
+import glob
+import sqlite3
+import hashlib
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from config import Backtest_Setting
+from metrics import compute_metrics, return_metrics
+
+# SQLite catalog of every finished backtest run. BACKTEST_CATALOG points workers on hosts sharing a
+# network filesystem at a local file, since SQLite must not be written from several hosts.
+catalog_path = os.environ.get('BACKTEST_CATALOG', "./plots/catalog.sqlite")
+
+# One column per Backtest_Setting field, typed from its default value
+setting_fields = sorted(vars(Backtest_Setting()))
+
+# Fields that do not change a run's results and so are left out of its settings hash
+unhashed_fields = {'do_log'}
+
+run_columns = {
+    'run_id': 'TEXT PRIMARY KEY',
+    'results_dir': 'TEXT',
+    'settings_hash': 'TEXT',
+    'created_at': 'TEXT',
+    'runtime_seconds': 'REAL',
+    'engine': 'TEXT',
+    'status': 'TEXT',
+}
+
+summary_columns = return_metrics + ['turnover', 'final_value', 'n_transactions']
+
+index_columns = ['settings_hash', 'primaryindex', 'source', 'score', 'sharpe']
+
+
+def _sql_type(value):
+    if isinstance(value, (bool, int)):
+        return 'INTEGER'
+    if isinstance(value, float):
+        return 'REAL'
+    return 'TEXT'
+
+
+def _columns():
+    columns = dict(run_columns)
+    defaults = vars(Backtest_Setting())
+    columns.update({field: _sql_type(defaults[field]) for field in setting_fields})
+    columns.update({name: 'REAL' for name in summary_columns})
+    return columns
+
+
+def settings_fields(Setting):
+    """
+    Return the Backtest_Setting fields as a plain dict, as saved to BacktestSetting.json.
+    """
+    return {field: getattr(Setting, field) for field in setting_fields}
+
+
+def settings_from_fields(fields):
+    """
+    Rebuild a Backtest_Setting from its field dict, e.g. one loaded from BacktestSetting.json.
+    """
+    Setting = Backtest_Setting()
+    for field in setting_fields:
+        if field in fields:
+            setattr(Setting, field, fields[field])
+    return Setting
+
+
+def settings_hash(Setting):
+    """
+    Stable hash of the Backtest_Setting fields that affect results. Accepts a Backtest_Setting or
+    its field dict. Integral floats hash like ints, so 1000000 and 1000000.0 give the same hash.
+    """
+    fields = Setting if isinstance(Setting, dict) else settings_fields(Setting)
+    values = {}
+    for field in setting_fields:
+        if field in unhashed_fields:
+            continue
+        value = fields.get(field)
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        values[field] = value
+    payload = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def connect(path=catalog_path):
+    """
+    Open the catalog, creating the table and adding columns for new Backtest_Setting fields.
+    WAL mode lets parallel workers record runs while others query.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+
+    columns = _columns()
+    conn.execute(f"CREATE TABLE IF NOT EXISTS runs "
+                 f"({', '.join(f'{name} {sql_type}' for name, sql_type in columns.items())})")
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(runs)')}
+    for name, sql_type in columns.items():
+        if name not in existing:
+            conn.execute(f'ALTER TABLE runs ADD COLUMN {name} {sql_type}')
+    for name in index_columns:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS runs_{name} ON runs ({name})')
+    conn.commit()
+    return conn
+
+
+def summary_stats(returns, results=None, positions=None, transactions=None, benchmark=None):
+    """
+    Metrics of a run (see metrics.compute_metrics), plus the ending portfolio value and the number
+    of transactions when the results and transactions frames are given.
+    """
+    stats = compute_metrics(returns, positions, transactions, benchmark)
+    stats['final_value'] = None
+    stats['n_transactions'] = None
+    if results is not None and 'portfolio_value' in results and len(results):
+        stats['final_value'] = results['portfolio_value'].iloc[-1]
+    if transactions is not None:
+        stats['n_transactions'] = len(transactions)
+    # NaN metrics, e.g. beta without a benchmark, are stored as NULL
+    return {name: None if value is None or np.isnan(value) else float(value) for name, value in stats.items()}
+
+
+def record_run(results_dir, Setting, returns, results=None, transactions=None, runtime_seconds=None,
+               engine=None, status='completed', positions=None, benchmark=None, path=catalog_path):
+    """
+    Insert or replace the catalog row of a run. The run id is the name of its results directory.
+    Setting may be a Backtest_Setting or its field dict. Returns the stored row.
+    """
+    fields = Setting if isinstance(Setting, dict) else settings_fields(Setting)
+    row = {
+        'run_id': os.path.basename(os.path.normpath(results_dir)),
+        'results_dir': os.path.abspath(results_dir),
+        'settings_hash': settings_hash(fields),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'runtime_seconds': runtime_seconds,
+        'engine': engine,
+        'status': status,
+    }
+    row.update({field: fields.get(field) for field in setting_fields})
+    row.update(summary_stats(returns, results, positions, transactions, benchmark))
+    return record_row(row, path)
+
+
+def record_row(row, path=catalog_path):
+    """
+    Insert or replace a catalog row as returned by record_run, e.g. one reported by a remote worker.
+    """
+    row = {name: value for name, value in row.items() if name in _columns()}
+    conn = connect(path)
+    try:
+        with conn:
+            conn.execute(f"INSERT OR REPLACE INTO runs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                         list(row.values()))
+    finally:
+        conn.close()
+    return row
+
+
+def _checked(conn, names):
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(runs)')}
+    unknown = [name for name in names if name not in columns]
+    if unknown:
+        raise ValueError(f"Unknown catalog columns: {unknown}")
+
+
+def query_runs(filters=None, order_by=None, limit=None, columns=None, path=catalog_path):
+    """
+    Return catalog rows as a DataFrame.
+    filters maps column names to a value or a list of values, order_by is a column name or a list
+    of them, each prefixed with '-' for descending order, e.g.
+    query_runs({'primaryindex': 'Russell 2000', 'source': 'mdna'}, order_by='-sharpe', limit=10).
+    """
+    filters = filters or {}
+    order_by = [order_by] if isinstance(order_by, str) else list(order_by or [])
+    conn = connect(path)
+    try:
+        _checked(conn, list(filters) + [name.lstrip('-') for name in order_by] + list(columns or []))
+        clauses, params = [], []
+        for name, value in filters.items():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            clauses.append(f"{name} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+
+        sql = f"SELECT {', '.join(columns) if columns else '*'} FROM runs"
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        if order_by:
+            sql += ' ORDER BY ' + ', '.join(f"{name.lstrip('-')} {'DESC' if name.startswith('-') else 'ASC'}"
+                                            for name in order_by)
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
+
+def best_by(group_by, metric='sharpe', filters=None, ascending=False, path=catalog_path):
+    """
+    Aggregate the metric over the runs matching filters for each value of the group_by column(s),
+    ranked best first: mean, best and count per group. For example, the best lookback for
+    Russell 2000 mdna is best_by('lookback', 'sharpe', {'primaryindex': 'Russell 2000', 'source': 'mdna'}).
+    """
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+    runs = query_runs(filters, columns=group_by + [metric], path=path)
+    stats = runs.groupby(group_by)[metric].agg(['mean', 'min' if ascending else 'max', 'count'])
+    stats.columns = [f'mean_{metric}', f'best_{metric}', 'runs']
+    return stats.sort_values(f'mean_{metric}', ascending=ascending)
+
+
+def completed_hashes(engine=None, path=catalog_path):
+    """
+    Settings hashes of all completed runs in the catalog, only those run with engine when it is given.
+    """
+    sql = "SELECT DISTINCT settings_hash FROM runs WHERE status = 'completed'"
+    params = []
+    if engine is not None:
+        sql += " AND engine = ?"
+        params.append(engine)
+    conn = connect(path)
+    try:
+        return {row[0] for row in conn.execute(sql, params)}
+    finally:
+        conn.close()
+
+
+def pending_settings(settings_list, rerun=False, engine=None, path=catalog_path):
+    """
+    Collapse settings with the same hash into one and, unless rerun is set, drop those the catalog
+    already holds a completed run for, with engine when it is given: the engines do not give
+    identical results, so a vectorized run does not stand in for a zipline one. Configs without
+    such a run are kept, in their order.
+    """
+    done = set() if rerun else completed_hashes(engine, path)
+    pending, seen = [], set()
+    for Setting in settings_list:
+        key = settings_hash(Setting)
+        if key in seen or key in done:
+            continue
+        seen.add(key)
+        pending.append(Setting)
+    skipped_done = sum(settings_hash(Setting) in done for Setting in settings_list)
+    print(f"{len(settings_list)} configs: {len(settings_list) - len(pending) - skipped_done} duplicates, "
+          f"{skipped_done} already completed, {len(pending)} to run")
+    return pending
+
+
+def index_results(base_dir='./plots/temp', path=catalog_path):
+    """
+    Add every run directory under base_dir that has settings and results to the catalog, with its
+    metrics against the benchmark of its primary index. Run times of backfilled runs are unknown.
+    Runs already in the catalog keep their engine; the others predate the catalog, which every
+    vectorized run is recorded in, and so are zipline runs.
+    """
+    from results_store import load_results
+    from utils import benchmark_loaders, load_benchmark
+
+    conn = connect(path)
+    try:
+        engines = dict(conn.execute("SELECT run_id, engine FROM runs"))
+    finally:
+        conn.close()
+
+    indexed = 0
+    for settings_file in sorted(glob.glob(os.path.join(base_dir, '*', 'BacktestSetting.json'))):
+        results_dir = os.path.dirname(settings_file)
+        with open(settings_file, 'r') as f:
+            fields = json.load(f)
+        try:
+            tables = load_results(results_dir)
+        except Exception as e:
+            print(f"Skipping {results_dir}: {e}")
+            continue
+        benchmark = (load_benchmark(fields['primaryindex']) if fields.get('primaryindex') in benchmark_loaders
+                     else None)
+        engine = engines.get(os.path.basename(os.path.normpath(results_dir))) or 'zipline'
+        record_run(results_dir, fields, tables['returns'], tables['metrics'], tables['transactions'],
+                   engine=engine, positions=tables['positions'], benchmark=benchmark, path=path)
+        indexed += 1
+    print(f"Indexed {indexed} runs from {base_dir} into {path}")
+    return indexed
+
+
+def _parse_filters(pairs):
+    """
+    Parse KEY=VALUE pairs, reading values as JSON where possible so numbers and booleans match.
+    """
+    filters = {}
+    for pair in pairs or []:
+        name, value = pair.split('=', 1)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        filters.setdefault(name, []).append(value)
+    return filters
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query the catalog of backtest runs")
+    parser.add_argument("--catalog", type=str, default=catalog_path, help="Path of the catalog database")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help="Add existing result directories to the catalog")
+    index_parser.add_argument("--base-dir", type=str, default="./plots/temp")
+
+    query_parser = subparsers.add_parser('query', help="List runs matching filters")
+    query_parser.add_argument("--where", type=str, nargs='+', default=[], help="Filters as KEY=VALUE")
+    query_parser.add_argument("--order-by", type=str, nargs='+', default=['-sharpe'],
+                              help="Columns to sort by, prefix with - for descending")
+    query_parser.add_argument("--columns", type=str, nargs='+', default=None)
+    query_parser.add_argument("--limit", type=int, default=20)
+
+    best_parser = subparsers.add_parser('best', help="Rank the values of a setting by a metric")
+    best_parser.add_argument("--by", type=str, nargs='+', required=True, help="Setting columns to group by")
+    best_parser.add_argument("--metric", type=str, default='sharpe')
+    best_parser.add_argument("--where", type=str, nargs='+', default=[], help="Filters as KEY=VALUE")
+    best_parser.add_argument("--ascending", action='store_true', help="Lower metric values are better")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 20)
+    if args.command == 'index':
+        index_results(args.base_dir, path=args.catalog)
+    elif args.command == 'query':
+        print(query_runs(_parse_filters(args.where), order_by=args.order_by, limit=args.limit,
+                         columns=args.columns, path=args.catalog).to_string(index=False))
+    elif args.command == 'best':
+        print(best_by(args.by, args.metric, _parse_filters(args.where), ascending=args.ascending,
+                      path=args.catalog).to_string())
@@ -0,0 +1,127 @@
+import os
+import json
+import shutil
+import hashlib
+import uuid
+import pandas as pd
+from zipline.data import bundles
+
+# Directory holding one sub-directory per cached score matrix
+cache_dir = "./D&T/score_cache"
+
+# Evict least recently used entries once the cache grows beyond this size
+max_cache_bytes = 2 * 1024 ** 3
+
+# Backtest_Setting fields that determine the output of utils.load_score
+key_fields = ['source', 'score', 'primaryindex', 'fiscal_start_year', 'fiscal_end_year', 'start_date']
+
+
+def bundle_ingestion(bundle_name):
+    """
+    Return the timestamp of the most recent ingestion of the given bundle as a string.
+    """
+    ingestions = bundles.ingestions_for_bundle(bundle_name)
+    return str(ingestions[0]) if ingestions else ''
+
+
+def settings_key(BacktestSetting, ingestion):
+    """
+    Hash the fields that affect load_score together with the bundle ingestion timestamp.
+    """
+    fields = {field: getattr(BacktestSetting, field) for field in key_fields}
+    fields['ingestion'] = ingestion
+    payload = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def load_cached_score(bundle, BacktestSetting, ingestion, root=cache_dir):
+    """
+    Return (scores, assets) from the cache, or None on a miss.
+    """
+    entry = os.path.join(root, settings_key(BacktestSetting, ingestion))
+    meta_path = os.path.join(entry, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+
+    scores = pd.read_parquet(os.path.join(entry, 'scores.parquet'))
+    scores.columns = pd.Index(scores.columns.astype(int), name=meta['columns_name'])
+    assets = bundle.asset_finder.retrieve_all(meta['sids'])
+
+    # Mark the entry as recently used for LRU eviction
+    os.utime(meta_path)
+    return scores, assets
+
+
+def save_cached_score(scores, assets, BacktestSetting, ingestion, root=cache_dir):
+    """
+    Store the sid-column score matrix and the found assets, then enforce the eviction policy.
+    The entry is written to a temporary directory and renamed so concurrent workers never see
+    a partial entry.
+    """
+    key = settings_key(BacktestSetting, ingestion)
+    entry = os.path.join(root, key)
+    tmp_entry = os.path.join(root, f'.{key}.{uuid.uuid4().hex}')
+    os.makedirs(tmp_entry, exist_ok=True)
+
+    frame = scores.copy()
+    frame.columns = frame.columns.astype(str)
+    frame.to_parquet(os.path.join(tmp_entry, 'scores.parquet'))
+
+    meta = {field: getattr(BacktestSetting, field) for field in key_fields}
+    meta['ingestion'] = ingestion
+    meta['columns_name'] = scores.columns.name
+    meta['sids'] = [int(asset.sid) for asset in assets]
+    with open(os.path.join(tmp_entry, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4, default=str)
+
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Another worker stored the same entry first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    evict(ingestion, root=root)
+
+
+def evict(ingestion=None, max_bytes=max_cache_bytes, root=cache_dir):
+    """
+    Apply the cache eviction policy:
+    1. drop entries built from a bundle ingestion other than the current one;
+    2. drop least recently used entries until the cache fits within max_bytes.
+    """
+    if not os.path.isdir(root):
+        return
+
+    entries = []
+    for name in os.listdir(root):
+        meta_path = os.path.join(root, name, 'meta.json')
+        if name.startswith('.') or not os.path.exists(meta_path):
+            continue
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        path = os.path.join(root, name)
+        if ingestion is not None and meta['ingestion'] != ingestion:
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        entries.append((os.path.getmtime(meta_path), _entry_size(path), path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def clear_cache(root=cache_dir):
+    """
+    Remove every cached score matrix.
+    """
+    shutil.rmtree(root, ignore_errors=True)
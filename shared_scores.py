@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+def _shared_memory_root():
+    """
+    Prefer a RAM-backed filesystem so memory-mapped pages are shared without touching disk.
+    """
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def alignment_key(Setting):
+    """
+    The Backtest_Setting fields main.align_scores depends on.
+    """
+    return Setting.lag, Setting.lookback
+
+
+def publish_scores(scores, directory=None):
+    """
+    Write the score matrix to memory-mapped .npy files and return a small, picklable handle.
+    The values are stored followed by an all-NaN column, the layout ScoreFactor serves from, so
+    every worker that attaches to the handle maps the same physical pages instead of holding its own copy.
+    """
+    directory = directory or tempfile.mkdtemp(prefix='scores_', dir=_shared_memory_root())
+    os.makedirs(directory, exist_ok=True)
+
+    n_rows, n_columns = scores.shape
+    values = np.lib.format.open_memmap(os.path.join(directory, 'values.npy'), mode='w+', dtype=np.float64,
+                                       shape=(n_rows, n_columns + 1))
+    values[:, :-1] = scores.values
+    values[:, -1] = np.nan
+    values.flush()
+    del values
+    np.save(os.path.join(directory, 'index.npy'), scores.index.tz_convert('UTC').values)
+    np.save(os.path.join(directory, 'columns.npy'), np.asarray(scores.columns, dtype=np.int64))
+
+    return {
+        'directory': directory,
+        'index_name': scores.index.name,
+        'columns_name': scores.columns.name,
+    }
+
+
+def publish_aligned_scores(scores, settings_list, align):
+    """
+    Align the scores once per distinct lag and lookback among settings_list with align(scores, Setting),
+    e.g. main.align_scores for a trading calendar, and publish each result.
+    Returns {alignment_key: handle}.
+    """
+    handles = {}
+    for Setting in settings_list:
+        key = alignment_key(Setting)
+        if key not in handles:
+            handles[key] = publish_scores(align(scores, Setting))
+    return handles
+
+
+def attach_score_values(handle):
+    """
+    Map the published values, followed by their all-NaN column, read-only.
+    """
+    return np.load(os.path.join(handle['directory'], 'values.npy'), mmap_mode='r')
+
+
+def attach_scores(handle):
+    """
+    Rebuild the score DataFrame on top of the read-only memory map described by handle.
+    """
+    directory = handle['directory']
+    values = attach_score_values(handle)[:, :-1]
+    index = pd.DatetimeIndex(np.load(os.path.join(directory, 'index.npy')), name=handle['index_name'])
+    columns = pd.Index(np.load(os.path.join(directory, 'columns.npy')), name=handle['columns_name'])
+    return pd.DataFrame(values, index=index.tz_localize('UTC'), columns=columns, copy=False)
+
+
+def release_scores(handle):
+    """
+    Remove the files backing a published score matrix, or every matrix in a dict of handles.
+    """
+    handles = handle.values() if 'directory' not in handle else [handle]
+    for handle in handles:
+        shutil.rmtree(handle['directory'], ignore_errors=True)
@@ -0,0 +1,148 @@
+import os
+import time
+import traceback
+import multiprocessing as mp
+from queue import Empty
+from tqdm import tqdm
+
+# Environment variables read by the native thread pools of NumPy's BLAS, OpenMP and numexpr
+thread_env_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'BLIS_NUM_THREADS']
+
+# Share of the available memory the scheduler reserves by default
+default_budget_fraction = 0.8
+
+
+def available_memory_mb():
+    """
+    Memory available to new processes in MB, from /proc/meminfo where it exists.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') / 2 ** 20
+
+
+def _run_job(function, args, index, thread_limit, queue):
+    """
+    Job process entry point: cap native thread pools, run function(*args) and report the outcome.
+    """
+    start = time.perf_counter()
+    try:
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(thread_limit)
+        except ImportError:
+            # The environment set by the scheduler caps pools created after this point
+            pass
+        function(*args)
+        queue.put((index, 'done', time.perf_counter() - start, None))
+    except BaseException:
+        queue.put((index, 'failed', time.perf_counter() - start, traceback.format_exc()))
+
+
+def run_jobs(function, jobs, n_workers=None, job_memory_mb=2048, memory_budget_mb=None, thread_limit=1,
+             timeout=None, names=None, poll_interval=0.5):
+    """
+    Run function(*args) for every args tuple in jobs, each in its own process.
+
+    A job starts only when fewer than n_workers jobs run, the memory reserved by running jobs plus
+    job_memory_mb (a number, or a list with one estimate per job) fits within memory_budget_mb, and
+    the system still has that much memory available. The budget defaults to 80% of the memory
+    available at start. Native thread pools in each job are capped at thread_limit threads.
+    A job running longer than timeout seconds is terminated. Failed, crashed and timed-out jobs are
+    reported and the remaining jobs keep running.
+    Returns one {'name', 'status', 'seconds', 'error'} dict per job, in job order.
+    """
+    jobs = list(jobs)
+    n_workers = n_workers or os.cpu_count()
+    names = list(names) if names is not None else [str(i) for i in range(len(jobs))]
+    estimates = job_memory_mb if isinstance(job_memory_mb, (list, tuple)) else [job_memory_mb] * len(jobs)
+    memory_budget_mb = memory_budget_mb or available_memory_mb() * default_budget_fraction
+
+    outcomes = [{'name': name, 'status': 'pending', 'seconds': None, 'error': None} for name in names]
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    pending = list(range(len(jobs)))
+    running = {}  # index -> (process, start time)
+
+    # Spawned job processes inherit these before any native library starts its pools
+    saved_env = {name: os.environ.get(name) for name in thread_env_vars}
+    os.environ.update({name: str(thread_limit) for name in thread_env_vars})
+
+    progress = tqdm(total=len(jobs), desc='sweep')
+
+    def finish(index, status, seconds, error=None):
+        process, _ = running.pop(index)
+        process.join(timeout=5)
+        outcomes[index].update(status=status, seconds=seconds, error=error)
+        progress.update(1)
+        if status != 'done':
+            tqdm.write(f"Job {names[index]} {status}" + (f":\n{error}" if error else ''))
+
+    try:
+        while pending or running:
+            # Start jobs while a worker slot and enough memory are free
+            reserved = sum(estimates[index] for index in running)
+            while pending and len(running) < n_workers:
+                index = pending[0]
+                fits = reserved + estimates[index] <= memory_budget_mb
+                if running and not (fits and available_memory_mb() >= estimates[index]):
+                    break
+                # A single job larger than the budget still runs, alone
+                pending.pop(0)
+                process = ctx.Process(target=_run_job, args=(function, jobs[index], index, thread_limit, queue))
+                process.start()
+                running[index] = (process, time.perf_counter())
+                reserved += estimates[index]
+
+            try:
+                index, status, seconds, error = queue.get(timeout=poll_interval)
+                if index in running:
+                    finish(index, status, seconds, error)
+            except Empty:
+                pass
+
+            now = time.perf_counter()
+            for index, (process, started) in list(running.items()):
+                if timeout is not None and now - started > timeout:
+                    process.terminate()
+                    finish(index, 'timeout', now - started)
+                elif not process.is_alive() and queue.empty():
+                    # Exited without reporting, e.g. killed by the OOM killer
+                    finish(index, 'crashed', now - started, f'exit code {process.exitcode}')
+
+            progress.set_postfix(running=len(running), failed=sum(o['status'] not in ('done', 'pending')
+                                                                  for o in outcomes),
+                                 reserved_mb=int(sum(estimates[index] for index in running)))
+    finally:
+        for process, _ in running.values():
+            process.terminate()
+        progress.close()
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    failed = [outcome for outcome in outcomes if outcome['status'] != 'done']
+    print(f"{len(jobs) - len(failed)} of {len(jobs)} jobs done" +
+          (f", failed: {', '.join(outcome['name'] for outcome in failed)}" if failed else ''))
+    return outcomes
+
+
+def add_scheduler_args(parser):
+    """
+    Add the scheduler options shared by the sweep scripts to an argparse parser.
+    """
+    parser.add_argument("--n-jobs", type=int, default=None, help="Number of parallel workers (default: CPU count)")
+    parser.add_argument("--job-memory-mb", type=float, default=2048, help="Memory estimate per backtest in MB")
+    parser.add_argument("--memory-budget-mb", type=float, default=None,
+                        help="Memory all running backtests may reserve (default: 80%% of available memory)")
+    parser.add_argument("--threads-per-job", type=int, default=1, help="Native threads per backtest")
+    parser.add_argument("--job-timeout", type=float, default=None, help="Seconds before a backtest is terminated")
+    return parser
@@ -0,0 +1,77 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('bcolz')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Custom_bundle_example'))
+import quandl_custom_bundle
+
+day = 86400
+# sid: (first day, last day) of the stored block, listed in table order rather than sid order
+blocks = {2: (0, 3), 0: (0, 4), 1: (2, 4)}
+sids = np.array([0, 1, 2])
+new_days = np.array([4, 5, 6, 7])
+
+
+def bar(sid, d, new=False):
+    # Distinct close and volume for every (sid, day), and different again for re-sent days
+    return 1000 * sid + 10 * d + 5 * new, 100 * sid + d + 50 * new
+
+
+def sid_major_table(bars):
+    """
+    Daily bar columns built from scratch: {sid: {day: (close, volume)}} in blocks order, each sid
+    running from its first bar to its last with gaps forward-filled, as the full build writes them.
+    """
+    columns = {'close': [], 'volume': [], 'day': [], 'id': []}
+    first_row, last_row = {}, {}
+    for sid in blocks:
+        days = sorted(bars[sid])
+        first_row[sid] = len(columns['day'])
+        held = None
+        for d in range(days[0], days[-1] + 1):
+            held = bars[sid].get(d, held)
+            columns['close'].append(held[0])
+            columns['volume'].append(held[1])
+            columns['day'].append(d * day)
+            columns['id'].append(sid)
+        last_row[sid] = len(columns['day']) - 1
+    columns = {name: np.array(values, np.uint32) for name, values in columns.items()}
+    return columns, np.array([first_row[s] for s in sids]), np.array([last_row[s] for s in sids])
+
+
+def test_append_bars_matches_full_rebuild():
+    stored = {sid: {d: bar(sid, d) for d in range(first, last + 1)} for sid, (first, last) in blocks.items()}
+    columns, first_row, last_row = sid_major_table(stored)
+
+    # Sid 0 already holds day 4, gets a re-sent bar for it and misses day 5; sid 1 has nothing new; sid 2 has gaps
+    present = np.array([[True, False, True, True],
+                        [False, False, False, False],
+                        [True, False, True, False]])
+    new_bars = {'close': np.zeros(present.shape, np.uint32), 'volume': np.zeros(present.shape, np.uint32)}
+    for i, sid in enumerate(sids):
+        for j, d in enumerate(new_days):
+            if present[i, j]:
+                new_bars['close'][i, j], new_bars['volume'][i, j] = bar(sid, d, new=True)
+
+    appended, new_first, new_last = quandl_custom_bundle.append_bars(columns, first_row, last_row,
+                                                                      new_days * day, new_bars, present)
+
+    # The full rebuild sees the same bars, keeps the stored bar of a day already held and runs every sid
+    # to the last new session
+    rebuilt = {sid: dict(stored[sid]) for sid in blocks}
+    for i, sid in enumerate(sids):
+        for j, d in enumerate(new_days):
+            if present[i, j] and d > blocks[sid][1]:
+                rebuilt[sid][d] = bar(sid, d, new=True)
+        rebuilt[sid].setdefault(new_days[-1], rebuilt[sid][max(rebuilt[sid])])
+    expected, expected_first, expected_last = sid_major_table(rebuilt)
+
+    assert list(appended) == list(expected)
+    for name in expected:
+        assert appended[name].dtype == expected[name].dtype
+        np.testing.assert_array_equal(appended[name], expected[name], err_msg=name)
+    np.testing.assert_array_equal(new_first, expected_first)
+    np.testing.assert_array_equal(new_last, expected_last)
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+zipline = pytest.importorskip('zipline')
+from zipline.data import bundles
+
+from config import Backtest_Setting
+
+bundle_name = 'quandl_custom_bundle'
+bundle_start, bundle_end = pd.Timestamp('2019-01-02'), pd.Timestamp('2019-12-31')
+n_sids = 24
+
+# Daily returns must agree to this absolute tolerance
+tolerance = 1e-6
+
+
+def synthetic_ingest(environ, asset_db_writer, minute_bar_writer, daily_bar_writer, adjustment_writer, calendar,
+                     start_session, end_session, cache, show_progress, output_dir):
+    """
+    Random-walk bars for n_sids equities. Sid 0 lists in April, so the fixture covers the first
+    sessions of an asset's life, which the pipeline universe excludes.
+    """
+    rng = np.random.default_rng(7)
+    sessions = calendar.sessions_in_range(start_session, end_session)
+    first_rows = [60] + [0] * (n_sids - 1)
+
+    frames, rows = [], []
+    for sid, first in enumerate(first_rows):
+        days = sessions[first:]
+        close = 20 * np.exp(np.cumsum(rng.normal(0, 0.02, len(days))))
+        frames.append((sid, pd.DataFrame({'open': close, 'high': close * 1.01, 'low': close * 0.99,
+                                          'close': close, 'volume': 1e6}, index=days)))
+        rows.append({'symbol': f'S{sid:02d}', 'asset_name': f'Company {sid}', 'start_date': days[0],
+                     'end_date': days[-1], 'first_traded': days[0], 'auto_close_date': days[-1] + pd.Timedelta(days=1),
+                     'exchange': 'NYSE'})
+
+    daily_bar_writer.write(frames, show_progress=False)
+    asset_db_writer.write(equities=pd.DataFrame(rows), exchanges=pd.DataFrame(
+        {'exchange': 'NYSE', 'canonical_name': 'NYSE', 'country_code': 'US'}, index=[0]))
+    adjustment_writer.write()
+
+
+@pytest.fixture(scope='module')
+def synthetic_bundle(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('zipline_root'))
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('ZIPLINE_ROOT', root)
+        bundles.register(bundle_name, synthetic_ingest, calendar_name='NYSE', start_session=bundle_start,
+                         end_session=bundle_end)
+        try:
+            bundles.ingest(bundle_name, show_progress=False)
+            yield bundles.load(bundle_name)
+        finally:
+            bundles.unregister(bundle_name)
+
+
+def synthetic_scores(bundle_data):
+    """
+    Sparse scores, as filings arrive: a new value for about one sid in ten on each session.
+    """
+    rng = np.random.default_rng(11)
+    sessions = bundle_data.equity_daily_bar_reader.sessions
+    values = np.where(rng.random((len(sessions), n_sids)) < 0.1, rng.normal(size=(len(sessions), n_sids)), np.nan)
+    index = pd.DatetimeIndex(sessions)
+    index = index.tz_localize('UTC') if index.tz is None else index.tz_convert('UTC')
+    return pd.DataFrame(values, index=index, columns=pd.Index(np.arange(n_sids), dtype=np.int64))
+
+
+@pytest.mark.parametrize('do_short', [False, True])
+def test_vectorized_engine_matches_zipline(synthetic_bundle, do_short):
+    from main import simulate
+
+    Setting = Backtest_Setting(start_date='2019-02-01', end_date='2019-12-31', lookback=20, N_LONGS=5,
+                               N_SHORTS=5, DoShort=do_short, days_offset=3)
+    scores = synthetic_scores(synthetic_bundle)
+    assets = synthetic_bundle.asset_finder.retrieve_all(list(range(n_sids)))
+
+    zipline_outputs = simulate(Setting, scores, assets, engine='zipline')
+    vectorized_outputs = simulate(Setting, scores, assets, engine='vectorized')
+
+    zipline_returns = zipline_outputs[1]
+    vectorized_returns = vectorized_outputs[1].reindex(zipline_returns.index)
+    assert not vectorized_returns.isna().any()
+    np.testing.assert_allclose(vectorized_returns.values, zipline_returns.values, rtol=0, atol=tolerance)
+
+    # Same fills, in pyfolio's transactions layout
+    zipline_transactions, vectorized_transactions = zipline_outputs[3], vectorized_outputs[3]
+    assert list(vectorized_transactions.columns) == list(zipline_transactions.columns)
+    assert len(vectorized_transactions) == len(zipline_transactions)
+    np.testing.assert_allclose(vectorized_transactions['txn_dollars'].sum(),
+                               zipline_transactions['txn_dollars'].sum(), rtol=1e-9)
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import fast_engine
+
+
+class Setting:
+    initial_cash = 1000
+
+
+class Calendar:
+    """
+    Stand-in for the NYSE calendar: every session closes at 21:00 UTC.
+    """
+
+    @staticmethod
+    def session_close(session):
+        return pd.Timestamp(session) + pd.Timedelta(hours=21)
+
+
+def small_market():
+    """
+    Two assets over four sessions, rebalanced on the first and third. The first rebalance goes
+    long A and short B, the second closes A and flips B to long.
+    """
+    sessions = pd.date_range('2020-01-06', periods=4, freq='B')
+    close = np.array([[10.0, 20.0],
+                      [11.0, 18.0],
+                      [12.0, 20.0],
+                      [12.0, 21.0]])
+    listed = np.ones(close.shape, bool)
+    return {
+        'trading_calendar': Calendar(),
+        'sessions': sessions,
+        'sessions_utc': sessions.tz_localize('UTC'),
+        'close': close,
+        'has_bar': listed,
+        'price': close,
+        'alive': listed,
+        'tradable': listed,
+        'score_matrix': np.zeros(close.shape),
+        'is_rebalance': np.array([True, False, True, False]),
+    }
+
+
+def select_books(plans):
+    plans = iter(plans)
+
+    def select(latest_scores):
+        long_idx, short_idx = next(plans)
+        return [(np.array(long_idx, dtype=np.int64), np.array(short_idx, dtype=np.int64))]
+    return select
+
+
+def test_simulate_books_by_hand():
+    market = small_market()
+    books = fast_engine._simulate_books(Setting, market, select_books([([0], [1]), ([1], [])]), 1)
+    results, returns, positions, transactions = fast_engine._book_frames(Setting, market, books, ['A', 'B'], 0)
+
+    # Session 0 targets +1000 in A and -1000 in B: 100 A at 10 and -50 B at 20, filled at session 1's close.
+    # Buys pay 0.05% commission: 100 * 11 * 0.0005 = 0.55; sells pay none.
+    # Session 2 targets int(999.45) = 999 in B: close 100 A and buy trunc(999 / 20 + 50) = 99 B at 21,
+    # paying 99 * 21 * 0.0005 = 1.0395.
+    cash = [1000, 1000 - 1100 - 0.55 + 900, 799.45, 799.45 + 1200 - 2079 - 1.0395]
+    portfolio_value = [1000, 799.45 + 1100 - 900, 799.45 + 1200 - 1000, cash[3] + 49 * 21]
+    np.testing.assert_allclose(results['ending_cash'], cash)
+    np.testing.assert_allclose(results['portfolio_value'], portfolio_value)
+    np.testing.assert_allclose(returns, [0, 999.45 / 1000 - 1, 0, portfolio_value[3] / 999.45 - 1])
+
+    # Weights of the end-of-day positions
+    weights = positions.drop(columns='cash').div(results['portfolio_value'], axis=0)
+    np.testing.assert_allclose(weights.values, [[0, 0],
+                                                [1100 / 999.45, -900 / 999.45],
+                                                [1200 / 999.45, -1000 / 999.45],
+                                                [0, 1029 / portfolio_value[3]]])
+    assert list(positions.columns) == ['A', 'B', 'cash']
+    assert results['longs'].tolist() == [1, 1, 1, 1] and results['shorts'].tolist() == [1, 1, 0, 0]
+
+    # Fills and commission as charged, and daily turnover in traded dollars
+    commission = np.concatenate([rows[-1] for rows in books['txn_rows']])
+    np.testing.assert_allclose(commission, [0.55, 0, 0, 1.0395])
+    assert transactions['amount'].tolist() == [100, -50, -100, 99]
+    np.testing.assert_allclose(transactions['price'], [11, 18, 12, 21])
+    turnover = transactions['txn_dollars'].abs().groupby(transactions.index.normalize()).sum()
+    assert turnover.to_dict() == {market['sessions'][1]: 2000, market['sessions'][3]: 3279}
+
+
+def test_transaction_frame_layout():
+    sessions = pd.date_range('2020-01-06', periods=3, freq='B')
+    txn_rows = [(np.array([1, 1]), np.array([0, 1]), np.array([10.0, -5.0]), np.array([2.5, 4.0]),
+                 np.array([0.0125, 0.0]))]
+    transactions = fast_engine._transaction_frame(txn_rows, Calendar(), sessions, ['A', 'B'])
+
+    assert list(transactions.columns) == ['sid', 'symbol', 'price', 'order_id', 'amount', 'commission', 'dt',
+                                          'txn_dollars']
+    assert transactions['sid'].tolist() == ['A', 'B'] and transactions['symbol'].tolist() == ['A', 'B']
+    assert transactions['amount'].dtype == np.int64
+    assert transactions['txn_dollars'].tolist() == [-25.0, 20.0]
+    # Commission is charged to cash, not carried on the transaction, as in zipline
+    assert transactions['commission'].isna().all()
+    close = pd.Timestamp('2020-01-07 21:00')
+    assert (transactions.index == close).all()
+    assert (transactions['dt'] == close.tz_localize('UTC')).all()
+
+    empty = fast_engine._transaction_frame([], Calendar(), sessions, ['A', 'B'])
+    assert empty.empty and list(empty.columns) == list(transactions.columns)
@@ -0,0 +1,147 @@
+import os
+import time
+import signal
+import threading
+import multiprocessing as mp
+
+import pytest
+
+from config import Backtest_Setting
+import job_queue
+
+token = 'test-token'
+
+
+def succeed(job):
+    return {'lookback': job['settings']['lookback']}
+
+
+def hang(job):
+    time.sleep(60)
+
+
+def always_fail(job):
+    raise RuntimeError('backtest failed')
+
+
+def make_jobs(lookbacks, lease_seconds=1, max_attempts=3):
+    return [job_queue.make_job(Backtest_Setting(lookback=lookback), 'vectorized', f'lookback={lookback}',
+                               lease_seconds, max_attempts)
+            for lookback in lookbacks]
+
+
+@pytest.fixture(params=['file', 'tcp'])
+def queue(request, tmp_path):
+    """
+    (coordinator-side queue, address workers connect to): a FileQueue directory, or a JobBoard
+    served on loopback.
+    """
+    if request.param == 'file':
+        yield job_queue.FileQueue(str(tmp_path / 'queue')), str(tmp_path / 'queue')
+        return
+    board = job_queue.JobBoard()
+    server = job_queue.serve(board, '127.0.0.1', 0, token=token)
+    try:
+        yield board, f'tcp://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_local_workers(address, execute, n_workers=3):
+    threads = [threading.Thread(target=job_queue.run_worker, args=(address, execute, token),
+                                kwargs={'poll_interval': 0.05, 'connect_timeout': 5})
+               for _ in range(n_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+
+def test_local_workers_run_every_job(queue):
+    board, address = queue
+    jobs = make_jobs([20, 40, 60, 90, 120])
+    assert board.publish(jobs) == 5
+
+    run_local_workers(address, succeed)
+
+    records = board.finished([job['job_id'] for job in jobs])
+    assert sorted(record['result']['lookback'] for record in records.values()) == [20, 40, 60, 90, 120]
+    assert board.counts() == {'pending': 0, 'leased': 0, 'done': 5, 'failed': 0}
+    # Done jobs are not published again unless rerun is set
+    assert board.publish(jobs) == 0
+    assert board.publish(jobs, rerun=True) == 5
+
+
+def test_killed_worker_job_is_requeued(queue):
+    board, address = queue
+    jobs = make_jobs([20])
+    board.publish(jobs)
+
+    worker = mp.get_context('fork').Process(target=job_queue.run_worker, args=(address, hang, token),
+                                            kwargs={'poll_interval': 0.05})
+    worker.start()
+    deadline = time.monotonic() + 10
+    while board.counts()['leased'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert board.counts()['leased'] == 1
+    os.kill(worker.pid, signal.SIGKILL)
+    worker.join()
+
+    # Without heartbeats the lease runs out and the job goes back to pending
+    time.sleep(1.5)
+    assert board.reap() == [jobs[0]['job_id']]
+    assert board.counts()['pending'] == 1
+
+    run_local_workers(address, succeed, n_workers=1)
+    record = board.finished([jobs[0]['job_id']])[jobs[0]['job_id']]
+    assert record['status'] == 'done'
+
+
+def test_failing_job_is_marked_failed_after_max_attempts(queue):
+    board, address = queue
+    jobs = make_jobs([20], max_attempts=2)
+    board.publish(jobs)
+
+    run_local_workers(address, always_fail, n_workers=1)
+
+    record = board.finished([jobs[0]['job_id']])[jobs[0]['job_id']]
+    assert record['status'] == 'failed'
+    assert record['attempts'] == 2
+    assert 'backtest failed' in record['errors'][-1]
+
+
+@pytest.mark.parametrize('backend', ['file', 'board'])
+def test_late_failure_does_not_overwrite_done(tmp_path, backend):
+    board = job_queue.FileQueue(str(tmp_path / 'queue')) if backend == 'file' else job_queue.JobBoard()
+    job = make_jobs([20], lease_seconds=0.5)[0]
+    board.publish([job])
+
+    # The first worker stalls past its lease, the job is handed to a second worker, and the first
+    # one still finishes it; the second worker's later failure must leave the done record alone
+    assert board.claim('first')[0]['job_id'] == job['job_id']
+    time.sleep(1)
+    assert board.reap() == [job['job_id']]
+    assert board.claim('second')[0]['job_id'] == job['job_id']
+    board.complete(job['job_id'], 'first', {'lookback': 20})
+    board.fail(job['job_id'], 'second', 'error after the job was done')
+
+    assert board.finished([job['job_id']])[job['job_id']]['status'] == 'done'
+    assert board.counts() == {'pending': 0, 'leased': 0, 'done': 1, 'failed': 0}
+
+
+def test_serve_requires_token_off_loopback():
+    with pytest.raises(ValueError):
+        job_queue.serve(job_queue.JobBoard(), '0.0.0.0', 0)
+
+
+def test_wrong_token_is_rejected():
+    board = job_queue.JobBoard()
+    server = job_queue.serve(board, '127.0.0.1', 0, token=token)
+    try:
+        client = job_queue.SocketQueue('127.0.0.1', server.server_address[1], token='wrong')
+        with pytest.raises(RuntimeError, match='Invalid token'):
+            client.counts()
+    finally:
+        server.shutdown()
+        server.server_close()
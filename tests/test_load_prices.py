@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import quandl_preprocessing
+
+
+@pytest.fixture
+def business_day_sessions(monkeypatch):
+    # Business days stand in for the NYSE calendar, so the test does not need zipline
+    monkeypatch.setattr(quandl_preprocessing, 'nyse_sessions', lambda start_date, end_date: pd.bdate_range(start_date, end_date))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_load_prices_matches_groupby(tmp_path, business_day_sessions, seed):
+    """
+    The array-based load_prices gives the same frame as the previous groupby/apply implementation,
+    including tickers that list after the start date and days missing from the file.
+    """
+    path = tmp_path / 'prices.csv'
+    quandl_preprocessing.write_synthetic_prices(path, n_tickers=25, start_date='2019-01-01', end_date='2020-06-30',
+                                                seed=seed)
+
+    expected = quandl_preprocessing._load_prices_groupby(path, '2019-03-01', '2020-06-30')[quandl_preprocessing.price_fields]
+    result = quandl_preprocessing.load_prices(path, '2019-03-01', '2020-06-30')
+
+    assert expected.index.equals(result.index)
+    assert list(result.columns) == quandl_preprocessing.price_fields
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-6)
+
+
+def test_ffill_fills_down_each_column():
+    values = np.array([[np.nan, 1.0], [2.0, np.nan], [np.nan, np.nan], [3.0, 4.0]])
+    expected = pd.DataFrame(values).ffill().values
+    np.testing.assert_array_equal(quandl_preprocessing._ffill(values), expected)
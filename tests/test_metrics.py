@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import metrics
+
+
+def reference_metrics(returns, benchmark):
+    """
+    The same metrics computed one run at a time with pandas, over the days the run has a return.
+    """
+    returns = returns.dropna()
+    wealth = (1 + returns).cumprod()
+    both = pd.concat([returns, benchmark], axis=1, join='inner').dropna()
+    beta = np.cov(both.iloc[:, 0], both.iloc[:, 1], ddof=0)[0, 1] / both.iloc[:, 1].var(ddof=0)
+    return {
+        'total_return': wealth.iloc[-1] - 1,
+        'annual_return': wealth.iloc[-1] ** (252 / len(returns)) - 1,
+        'annual_volatility': returns.std() * np.sqrt(252),
+        'sharpe': returns.mean() / returns.std() * np.sqrt(252),
+        'sortino': returns.mean() * 252 / (np.sqrt((returns.clip(upper=0) ** 2).mean()) * np.sqrt(252)),
+        'max_drawdown': (wealth / wealth.cummax().clip(lower=1) - 1).min(),
+        'hit_rate': (returns > 0).sum() / (returns != 0).sum(),
+        'beta': beta,
+        'alpha': (both.iloc[:, 0].mean() - beta * both.iloc[:, 1].mean()) * 252,
+        'n_days': len(returns),
+    }
+
+
+def test_batch_metrics_matches_per_run_pandas():
+    rng = np.random.default_rng(3)
+    n_days, n_runs = 500, 6
+    dates = pd.bdate_range('2015-01-01', periods=n_days)
+    matrix = rng.normal(0.0005, 0.01, (n_days, n_runs))
+    matrix[rng.random((n_days, n_runs)) < 0.05] = 0.0
+    # Runs over different date ranges share the matrix, with NaN outside each run
+    matrix[:100, 1] = np.nan
+    matrix[-50:, 2] = np.nan
+    benchmark = pd.Series(rng.normal(0.0003, 0.008, n_days), index=dates)
+    benchmark.iloc[10:20] = np.nan
+
+    result = metrics.batch_metrics(matrix, benchmark.values)
+
+    for run in range(n_runs):
+        expected = reference_metrics(pd.Series(matrix[:, run], index=dates), benchmark)
+        for name, value in expected.items():
+            assert result[name][run] == pytest.approx(value, rel=1e-9), (run, name)
+
+
+def test_compute_metrics_aligns_timezones():
+    dates = pd.bdate_range('2020-01-01', periods=30)
+    returns = pd.Series(np.linspace(-0.01, 0.02, 30), index=dates.tz_localize('UTC'))
+    benchmark = pd.Series(np.linspace(0.01, -0.005, 30), index=dates)
+
+    result = metrics.compute_metrics(returns, benchmark=benchmark)
+
+    assert result['n_days'] == 30
+    assert np.isfinite(result['beta'])
+    assert np.isnan(result['turnover'])
+
+
+def test_batch_metrics_without_benchmark_leaves_beta_nan():
+    result = metrics.batch_metrics(np.array([0.01, -0.02, 0.0, 0.03]))
+    assert result['total_return'][0] == pytest.approx(1.01 * 0.98 * 1.03 - 1)
+    assert result['hit_rate'][0] == pytest.approx(2 / 3)
+    assert np.isnan(result['beta'][0]) and np.isnan(result['alpha'][0])
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+import results_store
+
+
+def synthetic_run(n_days=5):
+    """
+    Outputs of a small run, with assets written as their repr the way results.h5 holds them.
+    AAA is a reused ticker: it is held under sid 1 and later under sid 7.
+    """
+    dates = pd.date_range('2020-01-02', periods=n_days, tz='UTC')
+    assets = ['Equity(1 [AAA])', 'Equity(2 [BBB])', 'Equity(7 [AAA])']
+    positions = pd.DataFrame({assets[0]: [100.0, 110.0, 0.0, 0.0, 0.0],
+                              assets[1]: [0.0, -50.0, -55.0, -60.0, 0.0],
+                              assets[2]: [0.0, 0.0, 0.0, 120.0, 125.0],
+                              'cash': [900.0, 940.0, 1055.0, 940.0, 875.0]}, index=dates)
+    returns = pd.Series(np.linspace(-0.01, 0.01, n_days), index=dates)
+    results = pd.DataFrame({'ending_cash': positions['cash'].values, 'portfolio_value': 1000.0 + np.arange(n_days),
+                            'orders': [[] for _ in range(n_days)]}, index=dates)
+    transactions = pd.DataFrame({'sid': [assets[0], assets[1], assets[2]], 'symbol': [assets[0], assets[1], assets[2]],
+                                 'price': [10.0, 5.0, 12.0], 'order_id': ['a', 'b', 'c'], 'amount': [10, -10, 10],
+                                 'commission': [None, None, None], 'dt': dates[[0, 1, 3]],
+                                 'txn_dollars': [-100.0, 50.0, -120.0]}, index=dates[[0, 1, 3]].tz_convert(None))
+    return results, returns, positions, transactions
+
+
+def test_parquet_round_trip(tmp_path):
+    results, returns, positions, transactions = synthetic_run()
+    results_store.write_results(str(tmp_path), results, returns, positions, transactions)
+    assert results_store.has_results(str(tmp_path))
+
+    loaded = results_store.load_results(str(tmp_path))
+
+    pd.testing.assert_series_equal(loaded['returns'], returns.rename('returns'), check_freq=False)
+    # Object columns such as the per-day order lists are not stored
+    pd.testing.assert_frame_equal(loaded['metrics'], results[['ending_cash', 'portfolio_value']], check_freq=False)
+
+    # The reused ticker keeps one column per sid, and cash stays last
+    loaded_positions = loaded['positions']
+    assert loaded_positions.columns.is_unique
+    assert list(loaded_positions.columns) == ['AAA (1)', 'BBB', 'AAA (7)', 'cash']
+    np.testing.assert_allclose(loaded_positions.values, positions.values)
+
+    loaded_transactions = loaded['transactions']
+    assert list(loaded_transactions['sid']) == [1, 2, 7]
+    assert list(loaded_transactions['symbol']) == ['AAA', 'BBB', 'AAA']
+    np.testing.assert_allclose(loaded_transactions['txn_dollars'], transactions['txn_dollars'])
+
+
+def test_write_tables_replaces_previous_tables(tmp_path):
+    root = str(tmp_path / results_store.store_name)
+    results_store.write_tables(root, {'old': pd.DataFrame({'a': [1]})})
+    results_store.write_tables(root, {'new': pd.DataFrame({'a': [2]})})
+    assert sorted(p.name for p in (tmp_path / results_store.store_name).iterdir()) == ['new.parquet']
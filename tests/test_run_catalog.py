@@ -0,0 +1,38 @@
+import pandas as pd
+
+from config import Backtest_Setting
+import run_catalog
+
+
+def test_settings_hash_normalization():
+    Setting = Backtest_Setting(initial_cash=1000000, lookback=40)
+
+    # Integral floats hash like ints, and do_log does not change results
+    assert run_catalog.settings_hash(Backtest_Setting(initial_cash=1000000.0, lookback=40)) == \
+        run_catalog.settings_hash(Setting)
+    assert run_catalog.settings_hash(Backtest_Setting(initial_cash=1000000, lookback=40, DoLog=True)) == \
+        run_catalog.settings_hash(Setting)
+
+    # The field dict saved to BacktestSetting.json hashes like the setting itself
+    fields = run_catalog.settings_fields(Setting)
+    assert run_catalog.settings_hash(fields) == run_catalog.settings_hash(Setting)
+    assert run_catalog.settings_hash(run_catalog.settings_from_fields(fields)) == run_catalog.settings_hash(Setting)
+
+    assert run_catalog.settings_hash(Backtest_Setting(initial_cash=1000000.5, lookback=40)) != \
+        run_catalog.settings_hash(Setting)
+    assert run_catalog.settings_hash(Backtest_Setting(initial_cash=1000000, lookback=60)) != \
+        run_catalog.settings_hash(Setting)
+
+
+def test_pending_settings_matches_completed_runs_by_engine(tmp_path):
+    path = str(tmp_path / 'catalog.sqlite')
+    done, failed, new = (Backtest_Setting(lookback=lookback) for lookback in [20, 40, 60])
+    returns = pd.Series([0.01, -0.005, 0.002], index=pd.bdate_range('2020-01-01', periods=3))
+    run_catalog.record_run(str(tmp_path / 'run_a'), done, returns, engine='vectorized', path=path)
+    run_catalog.record_run(str(tmp_path / 'run_b'), failed, returns, engine='vectorized', status='failed', path=path)
+
+    settings = [done, failed, new, Backtest_Setting(lookback=60)]
+    assert run_catalog.pending_settings(settings, engine='vectorized', path=path) == [failed, new]
+    # A vectorized run does not stand in for a zipline one
+    assert run_catalog.pending_settings(settings, engine='zipline', path=path) == [done, failed, new]
+    assert run_catalog.pending_settings(settings, rerun=True, engine='vectorized', path=path) == [done, failed, new]
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+import truth_deception_store as store
+
+
+def write_source(root, source, tickers, **columns):
+    # Streamed responses are written per source with only the columns the response had
+    df = pd.DataFrame({'ticker': tickers, 'fiscalperiod': 'Q1_2020',
+                       'filingdate': '2020-05-01', 'date': '2020-05-02', **columns})
+    store.write_partition(store._to_table(df), 'Q1_2020', source, root=root)
+
+
+def test_read_sources_with_different_columns(tmp_path):
+    root = str(tmp_path)
+    # Call transcripts sort first and carry neither primaryindex, scorepublisheddate nor the score
+    write_source(root, 'call transcripts', ['AAA', 'BBB'], otherscore=[0.1, 0.2])
+    write_source(root, 'mdna', ['AAA', 'BBB', 'CCC'], primaryindex=['Russell 2000', 'S&P 500', 'Russell 2000'],
+                 scorepublisheddate='2020-05-03', datascore=[0.5, 0.6, 0.7])
+
+    df = store.read_truth_deception_data('mdna', 'Russell 2000', 2020, 2020, 'datascore', root=root)
+    assert sorted(df.ticker.astype(str)) == ['AAA', 'CCC']
+    assert set(df.columns) == set(store.base_columns + ['datascore', 'source'])
+    assert df.datascore.tolist() == pytest.approx([0.5, 0.7])
+    assert (df.scorepublisheddate == pd.Timestamp('2020-05-03')).all()
+
+    # Columns a source never had come back as nulls rather than being dropped
+    df = store.read_truth_deception_data('call transcripts', 'Russell 2000', 2020, 2020, 'datascore', root=root)
+    assert len(df) == 2
+    assert df.datascore.isna().all() and df.scorepublisheddate.isna().all()
+
+
+def test_missing_years_are_migrated_from_pickles_first(tmp_path, monkeypatch):
+    pytest.importorskip('zipline')
+    pytest.importorskip('yfinance')
+    import utils
+
+    # The store and the pickles live under ./D&T
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'D&T').mkdir()
+    year = {f'Q{n}_2020': pd.DataFrame({'ticker': ['AAA', 'BBB'], 'source': 'mdna', 'primaryindex': 'Russell 2000',
+                                        'fiscalperiod': f'Q{n}_2020', 'filingdate': '2021-02-01',
+                                        'date': f'2021-02-0{n}', 'scorepublisheddate': '2021-02-10',
+                                        'datascore': [0.1 * n, 0.2 * n]})
+            for n in [1, 2, 3, 4]}
+    pd.to_pickle(year, store.pickle_glob.replace('*', '2020'))
+
+    fetched = []
+    monkeypatch.setattr(utils, 'fetch_years_to_store', lambda years, datasets: fetched.append(years))
+
+    class BacktestSetting:
+        source, primaryindex, score = 'mdna', 'Russell 2000', 'datascore'
+        fiscal_start_year, fiscal_end_year = 2020, 2021
+
+    scores = utils.filter_truth_deception_data(BacktestSetting)
+    # Only the year without a pickle goes to the unifier API
+    assert fetched == [[2021]]
+    assert store.stored_years(['mdna']) == {2020}
+    assert scores.shape == (4, 2)
+    assert scores['BBB'].tolist() == pytest.approx([0.2, 0.4, 0.6, 0.8])
@@ -0,0 +1,129 @@
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+requests = pytest.importorskip('requests')
+from unifier import unifier
+
+
+class StandIn(ThreadingHTTPServer):
+    """
+    Local stand-in for the unifier API. Answers the first `failures` requests with 503, then
+    {"value": [<request number>]}, so a test can tell a fresh response from a cached one.
+    """
+    daemon_threads = True
+
+    def __init__(self, failures=0):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.failures = failures
+        self.requests = []
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.requests.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        if len(self.server.requests) <= self.server.failures:
+            self.send_response(503)
+            self.end_headers()
+            return
+        body = json.dumps({'value': [len(self.server.requests)]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    def start(failures=0):
+        server = StandIn(failures)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        monkeypatch.setattr(unifier, 'url', f'http://127.0.0.1:{server.server_address[1]}/unifier')
+        return server
+
+    servers = []
+    monkeypatch.setattr(unifier, 'cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(unifier, 'backoff_factor', 0)
+    monkeypatch.setattr(unifier, '_session', None)
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_query_retries_server_errors(stand_in):
+    server = stand_in(failures=2)
+    assert unifier.query('dataset', key='Q1_2020', use_cache=False) == {'value': [3]}
+    assert len(server.requests) == 3
+
+
+def test_query_gives_up_after_retries(stand_in, monkeypatch):
+    monkeypatch.setattr(unifier, 'retries', 1)
+    server = stand_in(failures=5)
+    with pytest.raises(requests.exceptions.RequestException):
+        unifier.query('dataset', key='Q1_2020')
+    assert len(server.requests) == 2
+    assert not os.path.exists(unifier.cache_dir) or not os.listdir(unifier.cache_dir)
+
+
+def test_pinned_responses_are_cached(stand_in):
+    server = stand_in()
+    assert unifier.query('dataset', key='Q1_2020', as_of='2024-01-02') == {'value': [1]}
+    assert unifier.query('dataset', key='Q1_2020', as_of='2024-01-02') == {'value': [1]}
+    # A pinned response never expires, however old the file
+    path = unifier.cache_path('dataset', 'Q1_2020', '2024-01-02')
+    os.utime(path, (0, 0))
+    assert unifier.query('dataset', key='Q1_2020', as_of='2024-01-02') == {'value': [1]}
+    assert len(server.requests) == 1
+
+
+def test_unpinned_responses_expire(stand_in):
+    server = stand_in()
+    assert unifier.query('dataset', key='Q1_2020') == {'value': [1]}
+    assert unifier.query('dataset', key='Q1_2020') == {'value': [1]}
+
+    path = unifier.cache_path('dataset', 'Q1_2020')
+    os.utime(path, (0, 0))
+    assert unifier.query('dataset', key='Q1_2020') == {'value': [2]}
+    assert len(server.requests) == 2
+
+
+def test_use_cache_false_bypasses_the_cache(stand_in):
+    server = stand_in()
+    assert unifier.query('dataset', key='Q1_2020') == {'value': [1]}
+    assert unifier.query('dataset', key='Q1_2020', use_cache=False) == {'value': [2]}
+    # The bypassing request does not replace the cached response
+    assert unifier.query('dataset', key='Q1_2020') == {'value': [1]}
+
+    with unifier.stream('dataset', key='Q2_2020', as_of='2024-01-02', use_cache=False) as fp:
+        assert json.loads(fp.read()) == {'value': [3]}
+    assert not os.path.exists(unifier.cache_path('dataset', 'Q2_2020', '2024-01-02'))
+    assert len(server.requests) == 3
+
+
+def test_stream_caches_the_body(stand_in):
+    server = stand_in()
+    for _ in range(2):
+        with unifier.stream('dataset', key='Q1_2020', as_of='2024-01-02') as fp:
+            assert json.loads(fp.read()) == {'value': [1]}
+    assert len(server.requests) == 1
+
+
+def test_refresh_leaves_no_cached_responses(stand_in, tmp_path):
+    pytest.importorskip('ijson')
+    pytest.importorskip('pyarrow')
+    from unifier_stream import refresh_store
+
+    server = stand_in()
+    root = str(tmp_path / 'store')
+    assert refresh_store({'source': 'dataset'}, today='2008-02-01', start_year=2008, root=root) == 1
+    assert len(server.requests) == 1
+    assert not os.path.exists(unifier.cache_dir) or not os.listdir(unifier.cache_dir)
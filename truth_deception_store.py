@@ -0,0 +1,294 @@
+import os
+import glob
+import json
+import pickle
+import argparse
+import multiprocessing as mp
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from benchmark_utils import measure_loader
+
+# Root of the partitioned Truth & Deception store (year / quarter / source)
+store_path = "./D&T/store"
+pickle_glob = "./D&T/concatenated_data_on_quater_*.pkl"
+
+# Per (source, quarter) fetch record; the leading underscore keeps it out of dataset scans
+manifest_name = "_manifest.json"
+
+partition_schema = pa.schema([
+    ('year', pa.int32()),
+    ('quarter', pa.string()),
+    ('source', pa.string()),
+])
+
+# Columns needed by utils.filter_truth_deception_data besides the selected score
+base_columns = ['ticker', 'primaryindex', 'fiscalperiod', 'filingdate', 'date', 'scorepublisheddate']
+
+# Column typing shared by every writer so all fragments in the store have one schema.
+# Other string columns are dictionary encoded and other numeric columns are stored as float32.
+categorical_columns = {'ticker', 'primaryindex', 'cikcode', 'company', 'documenttype', 'fiscalperiod'}
+datetime_columns = {'date', 'filingdate', 'scorepublisheddate', 'timestamp'}
+float64_columns = {'muts', 'filingdateunixtimestamp', 'scorepublisheddateunixtimestamp'}
+
+dictionary_type = pa.dictionary(pa.int32(), pa.string())
+
+
+def column_type(name, is_string):
+    """
+    Arrow type for a column, given whether its values are strings.
+    """
+    if name in datetime_columns:
+        return pa.timestamp('ns')
+    if name in categorical_columns or (is_string and name not in float64_columns):
+        return dictionary_type
+    if name in float64_columns:
+        return pa.float64()
+    return pa.float32()
+
+
+def _to_table(df):
+    """
+    Convert a quarterly DataFrame to an Arrow table using the store's column types.
+    """
+    arrays, names = [], []
+    for name in df.columns:
+        values = df[name].reset_index(drop=True)
+        is_string = values.dtype == object and values.notna().any()
+        arrow_type = column_type(name, is_string)
+        if pa.types.is_timestamp(arrow_type):
+            values = pd.to_datetime(values)
+        elif pa.types.is_dictionary(arrow_type):
+            values = values.astype('string')
+        else:
+            values = pd.to_numeric(values, errors='coerce')
+        array = pa.array(values)
+        arrays.append(array.dictionary_encode() if pa.types.is_dictionary(arrow_type) else array.cast(arrow_type))
+        names.append(name)
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def write_quarter(df, key, root=store_path):
+    """
+    Write one quarter of concatenated data (all sources) into the store.
+    The key follows the unifier convention, e.g. 'Q1_2007'. Existing partitions
+    for the same year/quarter/source are replaced.
+    Returns the number of rows written per source.
+    """
+    if df is None or len(df) == 0:
+        return {}
+
+    rows = {}
+    for source, source_df in df.groupby('source'):
+        write_partition(_to_table(source_df.drop(columns=['source'])), key, source, root=root)
+        rows[source] = len(source_df)
+    return rows
+
+
+def write_partition(table, key, source, root=store_path):
+    """
+    Write an Arrow table holding one source for one quarter key, e.g. 'Q1_2007'.
+    """
+    quarter, year = key.split('_')
+    n_rows = table.num_rows
+    table = (table.append_column('year', pa.array([int(year)] * n_rows, pa.int32()))
+                  .append_column('quarter', pa.array([quarter] * n_rows))
+                  .append_column('source', pa.array([source] * n_rows)))
+
+    pq.write_to_dataset(table,
+                        root,
+                        partition_cols=['year', 'quarter', 'source'],
+                        basename_template='part-{i}.parquet',
+                        existing_data_behavior='delete_matching')
+
+
+def write_year(concat_dict, root=store_path):
+    """
+    Write a {'Qn_YYYY': DataFrame} dict, as held in the legacy per-year pickles, into the store.
+    Returns the number of rows written per manifest key.
+    """
+    rows = {}
+    for key, df in concat_dict.items():
+        for source, n_rows in write_quarter(df, key, root=root).items():
+            rows[manifest_key(source, key)] = n_rows
+    return rows
+
+
+def manifest_key(source, key):
+    return f'{source}/{key}'
+
+
+def manifest_entry(dataset, rows, sha256, fetched_at, updated_at=None, error=None):
+    """
+    Manifest record for one (source, quarter): the unifier dataset, the row count, the sha256 of
+    the raw response (None when unknown), when it was last fetched and when its content last changed.
+    error is the message of a failed fetch, which marks the (source, quarter) incomplete.
+    """
+    return {'dataset': dataset, 'rows': rows, 'sha256': sha256,
+            'fetched_at': str(fetched_at), 'updated_at': str(updated_at or fetched_at),
+            'complete': error is None, 'error': error}
+
+
+def is_complete(entry):
+    """
+    Whether a manifest entry records a complete fetch. Entries written before fetch failures were
+    recorded have no 'complete' field and only exist for complete fetches.
+    """
+    return entry is not None and entry.get('complete', True)
+
+
+def load_manifest(root=store_path):
+    path = os.path.join(root, manifest_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def update_manifest(entries, root=store_path):
+    """
+    Merge {manifest_key: entry} into the manifest, replacing it atomically.
+    """
+    manifest = load_manifest(root)
+    manifest.update(entries)
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, manifest_name)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def store_version(root=store_path):
+    """
+    Time of the most recent content change in the store, '' when there is no manifest.
+    """
+    return max((entry['updated_at'] for entry in load_manifest(root).values()), default='')
+
+
+def stored_years(sources, root=store_path):
+    """
+    Return the set of fiscal years whose four quarters the manifest records as completely fetched
+    for every one of sources. A year=* directory alone is not enough: a fetch that failed part way
+    leaves some of its quarters or sources missing.
+    """
+    manifest = load_manifest(root)
+    years = {int(key.rsplit('_', 1)[1]) for key in manifest}
+    return {year for year in years
+            if all(is_complete(manifest.get(manifest_key(source, f'Q{n}_{year}')))
+                   for source in sources for n in [1, 2, 3, 4])}
+
+
+def migrate_pickles(pattern=pickle_glob, root=store_path):
+    """
+    One-shot migration of the existing per-year pickle files into the partitioned store.
+    Unreadable or empty pickles are reported and skipped.
+    """
+    print(">>> Migrating truth and deception pickles ......")
+    migrated = []
+    for filepath in sorted(glob.glob(pattern)):
+        try:
+            with open(filepath, "rb") as f:
+                concat_dict = pickle.load(f)
+        except Exception as e:
+            print(f"Skipping {filepath}: {e}")
+            continue
+
+        # Pickles carry no response hash, so the next refresh of these quarters always rewrites them
+        fetched_at = pd.Timestamp(os.path.getmtime(filepath), unit='s', tz='UTC')
+        rows = write_year(concat_dict, root=root)
+        update_manifest({key: manifest_entry(None, n_rows, None, fetched_at) for key, n_rows in rows.items()},
+                        root=root)
+        migrated.append(filepath)
+    print(f'Migrated {len(migrated)} pickle files into {root}')
+    return migrated
+
+
+def read_truth_deception_data(source, primaryindex, start_year, end_year, score, root=store_path):
+    """
+    Read Truth & Deception rows from the store, pushing the source, primary index,
+    fiscal-year range and column selection down into the Parquet scan.
+    The primary index filter is not applied to call transcripts, matching the pickle path.
+    Columns missing from a source's fragments are read as nulls.
+    """
+    # Without an explicit schema the dataset takes the first fragment's columns, and sources
+    # with fewer columns (e.g. call transcripts) would hide the others
+    columns = list(dict.fromkeys(base_columns + [score]))
+    schema = pa.schema([(c, column_type(c, False)) for c in columns] + list(partition_schema))
+    dataset = ds.dataset(root, schema=schema, format='parquet',
+                         partitioning=ds.partitioning(partition_schema, flavor='hive'))
+
+    predicate = ((ds.field('source') == source) &
+                 (ds.field('year') >= start_year) &
+                 (ds.field('year') <= end_year))
+    if not source == 'call transcripts':
+        predicate = predicate & (ds.field('primaryindex') == primaryindex)
+
+    return dataset.to_table(columns=columns + ['source'], filter=predicate).to_pandas()
+
+
+def _load_from_pickles(source, primaryindex, start_year, end_year, score):
+    frames = []
+    for curr_year in range(start_year, end_year + 1):
+        filepath = pickle_glob.replace('*', str(curr_year))
+        if not os.path.exists(filepath):
+            continue
+        with open(filepath, "rb") as f:
+            frames.extend(pickle.load(f).values())
+    df = pd.concat(frames, axis=0)
+    df = df[df.source == source]
+    if not source == 'call transcripts':
+        df = df[df.primaryindex == primaryindex]
+    return df
+
+
+def compare_load_paths(source="mdna", primaryindex="Russell 2000", start_year=2007, end_year=2022,
+                       score="datascore"):
+    """
+    Compare load time and peak RSS of the pickle path against the Parquet store.
+    Each path runs in a fresh process so peak RSS is not shared between them.
+    """
+    args = (source, primaryindex, start_year, end_year, score)
+    ctx = mp.get_context('spawn')
+    stats = {}
+    for name, loader in [('pickle', _load_from_pickles), ('parquet', read_truth_deception_data)]:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=measure_loader, args=(loader, args, queue))
+        proc.start()
+        stats[name] = queue.get()
+        proc.join()
+
+    for name, (elapsed, rss, rows) in stats.items():
+        print(f'{name:>8}: {elapsed:.3f}s, peak RSS {rss:.1f} MB, {rows} rows')
+    return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage the partitioned Truth & Deception store")
+    parser.add_argument("--migrate", action='store_true', help="Migrate ./D&T/*.pkl into the store")
+    parser.add_argument("--compare", action='store_true', help="Compare pickle and store load paths")
+    parser.add_argument("--refresh", action='store_true',
+                        help="Fetch new quarters and re-check quarters that may still be revised")
+    parser.add_argument("--settle-days", type=int, default=180,
+                        help="Days after quarter end during which a quarter may still be revised")
+    parser.add_argument("--source", type=str, choices=["10kq", "mdna", "call transcripts"], default="mdna")
+    parser.add_argument("--primaryindex", type=str, default="Russell 2000")
+    parser.add_argument("--score", type=str, default="datascore")
+    parser.add_argument("--fiscal-start-year", type=int, default=2007)
+    parser.add_argument("--fiscal-end-year", type=int, default=2022)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.migrate:
+        migrate_pickles()
+    if args.refresh:
+        from utils import truth_deception_datasets
+        from unifier_stream import refresh_store
+        refresh_store(truth_deception_datasets, settle_days=args.settle_days)
+    if args.compare:
+        compare_load_paths(args.source, args.primaryindex, args.fiscal_start_year, args.fiscal_end_year,
+                           args.score)
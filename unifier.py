@@ -1,6 +1,13 @@
+import os
+import time
+import hashlib
+import threading
 import requests
 import pandas as pd
 import json
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class unifier:
@@ -8,11 +15,65 @@ class unifier:
     user = ''
     token = ''
 
+    # Connection pooling, timeout and retry policy
+    timeout = 60
+    retries = 5
+    backoff_factor = 1
+    max_workers = 8
+    _session = None
+
+    # Raw responses are cached here, keyed by (name, key, as_of, back_to); None disables the cache
+    cache_dir = './D&T/unifier_cache'
+
+    # Seconds a response requested without as_of is served from the cache; None keeps it forever.
+    # Responses pinned with as_of are snapshots and do not expire.
+    cache_ttl = 24 * 60 * 60
+
     @classmethod
-    def query(cls, name, user=None, token=None, key=None, as_of=None, back_to=None):
-        headers = {
-            'Content-Type': 'application/json'
-        }
+    def session(cls):
+        """
+        Shared session with a connection pool sized for max_workers and exponential-backoff retries.
+        """
+        if cls._session is None:
+            retry = Retry(total=cls.retries,
+                          backoff_factor=cls.backoff_factor,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=None)
+            adapter = HTTPAdapter(pool_connections=cls.max_workers, pool_maxsize=cls.max_workers, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            cls._session = session
+        return cls._session
+
+    @classmethod
+    def cache_path(cls, name, key=None, as_of=None, back_to=None):
+        payload = json.dumps([name, key, as_of, back_to])
+        return os.path.join(cls.cache_dir, hashlib.sha256(payload.encode()).hexdigest() + '.json')
+
+    @classmethod
+    def cached_path(cls, name, key=None, as_of=None, back_to=None, use_cache=True):
+        """
+        Cache file of a request, or None when the cache is disabled or bypassed with use_cache=False.
+        """
+        if not cls.cache_dir or not use_cache:
+            return None
+        return cls.cache_path(name, key, as_of, back_to)
+
+    @classmethod
+    def is_fresh(cls, cache_path, as_of=None):
+        """
+        Whether cache_path holds a response that can be served: any pinned one, or an unpinned one
+        younger than cache_ttl.
+        """
+        try:
+            age = time.time() - os.path.getmtime(cache_path)
+        except OSError:
+            return False
+        return as_of is not None or cls.cache_ttl is None or age <= cls.cache_ttl
+
+    @classmethod
+    def payload(cls, name, user=None, token=None, key=None, as_of=None, back_to=None):
         payload = {
             'name': name,
             'user': cls.user,
@@ -28,15 +89,76 @@ class unifier:
             payload['token'] = token
         if user is not None:
             payload['user'] = user
+        return payload
 
-        response = requests.post(cls.url, headers=headers, json=payload)
+    @classmethod
+    def query(cls, name, user=None, token=None, key=None, as_of=None, back_to=None, use_cache=True):
+        cache_path = cls.cached_path(name, key, as_of, back_to, use_cache)
+        if cache_path and cls.is_fresh(cache_path, as_of):
+            with open(cache_path, 'rb') as f:
+                return json.loads(f.read())
+
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        payload = cls.payload(name, user, token, key, as_of, back_to)
+        response = cls.session().post(cls.url, headers=headers, json=payload, timeout=cls.timeout)
         response_data = response.json()
         if 'error' in response_data:
             print("error:", response_data['error'])
             return {}
+
+        if cache_path:
+            # Write to a temporary file first so concurrent readers never see a partial response
+            os.makedirs(cls.cache_dir, exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(response.content)
+            os.replace(tmp_path, cache_path)
         return response_data
 
     @classmethod
-    def get_dataframe(cls, name, user=None, token=None, key=None, as_of=None, back_to=None):
-        json_result = cls.query(name, user, token, key, as_of, back_to)
+    def get_dataframe(cls, name, user=None, token=None, key=None, as_of=None, back_to=None, use_cache=True):
+        json_result = cls.query(name, user, token, key, as_of, back_to, use_cache)
         return pd.DataFrame.from_dict(json_result)
+
+    @classmethod
+    @contextmanager
+    def stream(cls, name, user=None, token=None, key=None, as_of=None, back_to=None, chunk_size=1 << 20,
+               use_cache=True):
+        """
+        Yield the raw response body as a binary file object without reading it into memory.
+        With the cache enabled the body is downloaded in chunks into the cache and read back from
+        disk; otherwise, or with use_cache=False, the undecoded socket stream is yielded directly.
+        """
+        cache_path = cls.cached_path(name, key, as_of, back_to, use_cache)
+        if cache_path and cls.is_fresh(cache_path, as_of):
+            with open(cache_path, 'rb') as f:
+                yield f
+            return
+
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        payload = cls.payload(name, user, token, key, as_of, back_to)
+        with cls.session().post(cls.url, headers=headers, json=payload, timeout=cls.timeout,
+                                stream=True) as response:
+            if not cache_path:
+                response.raw.decode_content = True
+                yield response.raw
+                return
+
+            os.makedirs(cls.cache_dir, exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+
+        try:
+            with open(tmp_path, 'rb') as f:
+                yield f
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        # Only keep responses that decoded cleanly
+        os.replace(tmp_path, cache_path)
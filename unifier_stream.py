@@ -0,0 +1,384 @@
+import io
+import os
+import json
+import hashlib
+import argparse
+import tempfile
+import multiprocessing as mp
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import ijson
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from unifier import unifier
+from benchmark_utils import measure_loader
+from truth_deception_store import (_to_table, column_type, is_complete, load_manifest, manifest_entry, manifest_key,
+                                   store_path, update_manifest, write_partition)
+
+
+class ColumnBuffer:
+    """
+    Typed buffer for one column of a streamed response. Values are collected in small chunks and
+    converted with numpy: strings become dictionary codes and numbers go into a flat float64 array,
+    so no per-row Python objects outlive a chunk.
+    """
+    chunk_size = 1 << 16
+
+    def __init__(self, name, n_nulls=0):
+        self.name = name
+        self.kind = None
+        self.n_nulls = n_nulls  # nulls seen before the first value fixes the kind
+        self.pending = []
+        self.codes = array('i')
+        self.lookup = {}
+        self.numbers = array('d')
+
+    def __len__(self):
+        return self.n_nulls + len(self.codes) + len(self.numbers) + len(self.pending)
+
+    def append(self, value):
+        self.pending.append(value)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Convert the pending chunk into the typed buffers.
+        """
+        values = self.pending
+        if self.kind is None:
+            first = next((v for v in values if v is not None), None)
+            if first is None:
+                self.n_nulls += len(values)
+                values.clear()
+                return
+            self.kind = str if isinstance(first, str) else float
+            if self.kind is str:
+                self.codes.extend([-1] * self.n_nulls)
+            else:
+                self.numbers.extend([np.nan] * self.n_nulls)
+            self.n_nulls = 0
+
+        if self.kind is str:
+            # Factorize the chunk, then map its few uniques onto the column-wide dictionary
+            codes, uniques = pd.factorize(np.array(values, dtype=object))
+            lookup = self.lookup
+            mapping = np.array([lookup.setdefault(str(u), len(lookup)) for u in uniques] + [-1], dtype=np.int32)
+            self.codes.frombytes(mapping[codes].tobytes())
+        else:
+            try:
+                numbers = np.array(values, dtype=np.float64)
+            except (TypeError, ValueError):
+                numbers = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').values.astype(np.float64)
+            self.numbers.frombytes(numbers.tobytes())
+        values.clear()
+
+    def to_arrow(self):
+        """
+        Convert the buffer to an Arrow array typed by truth_deception_store.column_type.
+        """
+        self.flush()
+        arrow_type = column_type(self.name, self.kind is str)
+        if self.kind is None:
+            return pa.nulls(self.n_nulls, arrow_type)
+
+        if self.kind is str:
+            codes = np.frombuffer(self.codes, dtype=np.int32)
+            dictionary = pd.Index(list(self.lookup), dtype=object)
+        else:
+            # Numbers headed for a string or timestamp column are coded through their unique values
+            numbers = np.frombuffer(self.numbers, dtype=np.float64)
+            if not pa.types.is_dictionary(arrow_type) and not pa.types.is_timestamp(arrow_type):
+                return pa.array(numbers, from_pandas=True).cast(arrow_type)
+            uniques, codes = np.unique(numbers, return_inverse=True)
+            codes = np.where(np.isnan(numbers), -1, codes).astype(np.int32)
+            if pa.types.is_timestamp(arrow_type):
+                # pandas serialises datetimes as epoch milliseconds
+                dictionary = pd.to_datetime(uniques, unit='ms')
+            else:
+                dictionary = pd.Index([str(int(v)) if v.is_integer() else str(v) for v in uniques], dtype=object)
+
+        mask = codes < 0
+        if pa.types.is_dictionary(arrow_type):
+            return pa.DictionaryArray.from_arrays(pa.array(codes, mask=mask),
+                                                  pa.array(dictionary.astype(str), pa.string()))
+
+        # Timestamps and numbers are converted once per unique value, then gathered by code
+        if pa.types.is_timestamp(arrow_type):
+            converted = pd.to_datetime(dictionary).values.astype('datetime64[ns]')
+        else:
+            converted = pd.to_numeric(dictionary, errors='coerce').values.astype(np.float64)
+        values = converted[np.where(mask, 0, codes)] if len(converted) else np.empty(len(codes), converted.dtype)
+        return pa.array(values, mask=mask).cast(arrow_type)
+
+
+def _decode_columns(fp, columns):
+    # {"col": [v, ...]} or {"col": {"0": v, ...}}, as produced by DataFrame.to_dict / to_json.
+    # Only one column's values are held as Python objects at a time.
+    for name, values in ijson.kvitems(fp, '', use_float=True):
+        if isinstance(values, dict):
+            values = list(values.values())
+        elif not isinstance(values, list):
+            if name == 'error':
+                raise ValueError(values)
+            raise ValueError(f'Unexpected value for column {name}')
+
+        buffer = columns[name] = ColumnBuffer(name)
+        for start in range(0, len(values), buffer.chunk_size):
+            buffer.pending.extend(values[start:start + buffer.chunk_size])
+            buffer.flush()
+        del values
+
+
+def _decode_records(fp, columns):
+    # [{"col": v, ...}, ...]
+    n_rows = 0
+    for record in ijson.items(fp, 'item', use_float=True):
+        for name, value in record.items():
+            buffer = columns.get(name)
+            if buffer is None:
+                buffer = columns[name] = ColumnBuffer(name, n_nulls=n_rows)
+            buffer.append(value)
+        n_rows += 1
+        # Fill columns this record did not mention
+        for buffer in columns.values():
+            if len(buffer) < n_rows:
+                buffer.append(None)
+
+
+def decode_stream(fp):
+    """
+    Incrementally parse a unifier JSON response from a binary file object into an Arrow table
+    with the store's column types. Raises ValueError for {"error": ...} responses.
+    """
+    if not hasattr(fp, 'peek'):
+        fp = io.BufferedReader(fp)
+    head = fp.peek(64).lstrip()[:1]
+
+    columns = {}
+    if head == b'{':
+        _decode_columns(fp, columns)
+    elif head == b'[':
+        _decode_records(fp, columns)
+    elif head:
+        raise ValueError('Unexpected unifier response')
+
+    lengths = {len(buffer) for buffer in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError(f'Columns have different lengths: {sorted(lengths)}')
+    return pa.Table.from_arrays([buffer.to_arrow() for buffer in columns.values()], names=list(columns))
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Read-through wrapper that hashes the raw response bytes as the decoder consumes them.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.raw.readinto(b)
+        if n:
+            self.sha256.update(memoryview(b)[:n])
+        return n
+
+
+def stream_to_store(name, key, source, root=store_path, as_of=None, known_sha256=None, use_cache=True):
+    """
+    Stream one unifier dataset/quarter straight into the store partition for source.
+    The partition is left untouched when the response hashes to known_sha256.
+    With use_cache=False the response is neither read from nor written to the unifier cache.
+    Returns (rows, sha256, written).
+    """
+    with unifier.stream(name=name, key=key, as_of=as_of, use_cache=use_cache) as fp:
+        reader = HashingReader(fp)
+        table = decode_stream(io.BufferedReader(reader))
+    sha256 = reader.sha256.hexdigest()
+    if 'source' in table.column_names:
+        table = table.drop(['source'])
+
+    written = table.num_rows > 0 and sha256 != known_sha256
+    if written:
+        write_partition(table, key, source, root=root)
+    return table.num_rows, sha256, written
+
+
+def fetch_quarters_to_store(jobs, root=store_path, as_of=None, max_workers=None, use_cache=True):
+    """
+    Stream (key, source, dataset name) jobs into the store several responses at a time and record
+    them in the manifest. Quarters whose response hash matches the manifest are not rewritten.
+    A job that fails (bad response, truncated JSON, network or disk error) is recorded as incomplete
+    and the rest carry on; the manifest is written even if the run is interrupted.
+    Returns the number of rows written.
+    """
+    manifest = load_manifest(root)
+    print(f">>> Streaming {len(jobs)} unifier responses into the store ......")
+
+    def fetch(job):
+        key, source, name = job
+        entry = manifest.get(manifest_key(source, key), {})
+        try:
+            return job, stream_to_store(name, key, source, root=root, as_of=as_of,
+                                        known_sha256=entry.get('sha256'), use_cache=use_cache), None
+        except Exception as e:
+            print("error:", key, source, repr(e))
+            return job, None, repr(e)
+
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or unifier.max_workers) as executor:
+            results.extend(executor.map(fetch, jobs))
+    finally:
+        # The manifest is only written from this thread
+        fetched_at = pd.Timestamp.now(tz='UTC')
+        entries, n_rows, n_changed = {}, 0, 0
+        for (key, source, name), result, error in results:
+            previous = manifest.get(manifest_key(source, key), {})
+            if error is not None:
+                # The partition may be partly rewritten, so forget its hash and flag a content change
+                entries[manifest_key(source, key)] = manifest_entry(name, previous.get('rows'), None, fetched_at,
+                                                                    error=error)
+                continue
+            rows, sha256, written = result
+            updated_at = fetched_at if written else previous.get('updated_at')
+            entries[manifest_key(source, key)] = manifest_entry(name, rows, sha256, fetched_at, updated_at)
+            n_rows += rows if written else 0
+            n_changed += written
+        update_manifest(entries, root=root)
+        n_failed = sum(error is not None for _, _, error in results)
+        print(f'Wrote {n_rows} rows, {n_changed} of {len(jobs)} quarters changed, {n_failed} failed')
+    return n_rows
+
+
+def fetch_years_to_store(years, datasets, root=store_path, max_workers=None):
+    """
+    Stream every quarter of the given years for each {source: unifier dataset name} into the store.
+    """
+    jobs = [(f"Q{n}_{curr_year}", source, name)
+            for curr_year in years
+            for n in [1, 2, 3, 4]
+            for source, name in datasets.items()]
+    return fetch_quarters_to_store(jobs, root=root, max_workers=max_workers)
+
+
+def refresh_jobs(datasets, manifest, today, settle_days=180, start_year=2007):
+    """
+    Quarters to request in an incremental refresh: those missing from the manifest, and those
+    last fetched before they settled, i.e. less than settle_days after the quarter ended, when
+    late filings and revisions can still change them, and those whose last fetch failed.
+    Quarters that have not started are skipped.
+    """
+    settle = pd.Timedelta(days=settle_days)
+    jobs = []
+    for curr_year in range(start_year, today.year + 1):
+        for n in [1, 2, 3, 4]:
+            period = pd.Period(f'{curr_year}Q{n}', freq='Q')
+            if period.start_time > today:
+                continue
+            key = f"Q{n}_{curr_year}"
+            for source, name in datasets.items():
+                entry = manifest.get(manifest_key(source, key))
+                fetched_at = pd.Timestamp(entry['fetched_at']).tz_localize(None) if entry else None
+                if not is_complete(entry) or fetched_at < period.end_time + settle:
+                    jobs.append((key, source, name))
+    return jobs
+
+
+def refresh_store(datasets, today=None, settle_days=180, start_year=2007, root=store_path, max_workers=None):
+    """
+    Incrementally refresh the store: fetch new quarters and re-check quarters that may still be
+    revised. Responses are pinned with as_of=today and bypass the unifier cache: the manifest
+    hash already detects unchanged quarters, and a cached snapshot per day would never be read again.
+    """
+    today = pd.Timestamp(today or pd.Timestamp.now()).normalize()
+    jobs = refresh_jobs(datasets, load_manifest(root), today, settle_days, start_year)
+    if not jobs:
+        print('Store is up to date')
+        return 0
+    return fetch_quarters_to_store(jobs, root=root, as_of=today.strftime('%Y-%m-%d'), max_workers=max_workers,
+                                   use_cache=False)
+
+
+def write_synthetic_response(path, n_rows=1_000_000, n_scores=16, chunk_rows=100_000, seed=0):
+    """
+    Write a dict-of-lists response shaped like a Truth & Deception quarter, in chunks.
+    """
+    rng = np.random.default_rng(seed)
+    tickers = np.array([f'T{i:04d}' for i in range(3000)])
+    dates = pd.date_range('2008-01-01', periods=4000).strftime('%Y-%m-%d').values
+    generators = {
+        'ticker': lambda n: tickers[rng.integers(0, len(tickers), n)].tolist(),
+        'primaryindex': lambda n: np.array(['Russell 2000', 'S&P 500', 'Russell 1000'])[rng.integers(0, 3, n)].tolist(),
+        'cikcode': lambda n: rng.integers(1000, 2000000, n).tolist(),
+        'documenttype': lambda n: np.array(['10-K', '10-Q'])[rng.integers(0, 2, n)].tolist(),
+        'fiscalperiod': lambda n: np.array([f'Q{q}_{y}' for q in range(1, 5) for y in range(2007, 2023)])[rng.integers(0, 64, n)].tolist(),
+        'date': lambda n: dates[rng.integers(0, len(dates), n)].tolist(),
+        'filingdate': lambda n: dates[rng.integers(0, len(dates), n)].tolist(),
+        'scorepublisheddate': lambda n: dates[rng.integers(0, len(dates), n)].tolist(),
+        'muts': lambda n: rng.integers(1_200_000_000_000, 1_700_000_000_000, n).tolist(),
+    }
+    for i in range(n_scores):
+        generators['datascore' if i == 0 else f'score{i}'] = lambda n: np.round(rng.random(n), 6).tolist()
+
+    with open(path, 'w') as f:
+        f.write('{')
+        for i, (name, generate) in enumerate(generators.items()):
+            f.write(('' if i == 0 else ',') + json.dumps(name) + ':[')
+            for start in range(0, n_rows, chunk_rows):
+                values = json.dumps(generate(min(chunk_rows, n_rows - start)))[1:-1]
+                f.write(('' if start == 0 else ',') + values)
+            f.write(']')
+        f.write('}')
+    return os.path.getsize(path)
+
+
+def _decode_with_json(path):
+    # Previous path: whole body, then the Python dict of lists, then the DataFrame, then store types
+    with open(path, 'rb') as f:
+        return _to_table(pd.DataFrame.from_dict(json.loads(f.read())))
+
+
+def _decode_with_stream(path):
+    with open(path, 'rb') as f:
+        return decode_stream(f)
+
+
+def benchmark_decode(n_rows=1_000_000, n_scores=16):
+    """
+    Compare decode time and peak RSS of json.loads + DataFrame.from_dict + store typing against decode_stream
+    on a synthetic response. Each path runs in a fresh process so peak RSS is not shared.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'response.json')
+        size = write_synthetic_response(path, n_rows, n_scores)
+        print(f'Synthetic response: {size / 2 ** 20:.0f} MB, {n_rows} rows')
+
+        ctx = mp.get_context('spawn')
+        stats = {}
+        for name, loader in [('json', _decode_with_json), ('stream', _decode_with_stream)]:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=measure_loader, args=(loader, (path,), queue))
+            proc.start()
+            stats[name] = queue.get()
+            proc.join()
+
+    for name, (elapsed, rss, rows) in stats.items():
+        print(f'{name:>8}: {elapsed:.2f}s, peak RSS {rss:.0f} MB, {rows} rows')
+    (json_s, json_rss, _), (stream_s, stream_rss, _) = stats['json'], stats['stream']
+    print(f'decode time x{json_s / stream_s:.2f}, peak RSS -{100 * (1 - stream_rss / json_rss):.0f}%')
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark streaming decode of unifier responses")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--scores", type=int, default=16)
+    args = parser.parse_args()
+
+    benchmark_decode(args.rows, args.scores)
@@ -1,11 +1,12 @@
 import os
-import pickle
 import json
 import pandas as pd
-from tqdm import tqdm
 import yfinance as yf
 from unifier import unifier
 from zipline.errors import SymbolNotFound
+from truth_deception_store import migrate_pickles, pickle_glob, read_truth_deception_data, store_version, stored_years
+from unifier_stream import fetch_years_to_store
+from score_cache import bundle_ingestion, load_cached_score, save_cached_score
 
 # Set up environment variables for the unifier API
 unifier.user = "qrt"
@@ -13,63 +14,12 @@ unifier.token = "wLeSyZXo/amHh1THUE1ZV/loYeK7qutQXOsV674DGiI="
 os.environ["UNIFIER_USER"] = unifier.user
 os.environ["UNIFIER_TOKEN"] = unifier.token
 
-# Define base file path for truth & deception data
-base_truth_deception_filepath = "./D&T/concatenated_data_on_quater"
-
-
-def get_truth_deception_data(start_year, end_year):
-    """
-    Load Truth & Deception data for the specified year range using the unifier API.
-    The data is stored in ./D&T/ as pickle files.
-    """
-    concat_dict = dict()
-
-    for curr_year in tqdm(range(start_year, end_year + 1)):
-        truth_deception_filepath = base_truth_deception_filepath + f"_{curr_year}.pkl"
-        if os.path.exists(truth_deception_filepath):
-            # Load existing data if available
-            with open(truth_deception_filepath, "rb") as f:
-                curr_concat_dict = pickle.load(f)
-        else:
-            # Fetch new data from the unifier API
-            kq_dict, mdna_dict, t_dict = dict(), dict(), dict()
-
-            Quarters = [f"Q{n}" for n in [1, 2, 3, 4]]
-            quarters = [f"{quarter}_{curr_year}" for quarter in Quarters]
-
-            for q in quarters:
-                # Load 10-K/Q data
-                df_10 = unifier.get_dataframe(name="deception_and_truth_10kq_quarterly", key=q)
-                df_10["source"] = "10kq"
-                kq_dict[q] = df_10
-
-                # Load MD&A data
-                df_md = unifier.get_dataframe(name="deception_and_truth_mdna_quarterly", key=q)
-                df_md["source"] = "mdna"
-                mdna_dict[q] = df_md
-
-                # Load call transcripts data
-                df_t = unifier.get_dataframe(name="deception_and_truth_call_transcripts_quarterly", key=q)
-                df_t["source"] = "call transcripts"
-                t_dict[q] = df_t
-
-            # Concatenate the data for each quarter
-            curr_concat_dict = {}
-            for key in kq_dict.keys():
-                if key in mdna_dict:
-                    curr_concat_dict[key] = pd.concat(
-                        [kq_dict[key], mdna_dict[key], t_dict[key]], axis=0
-                    )
-
-            # Save the concatenated data to a pickle file
-            with open(truth_deception_filepath, "wb") as f:
-                pickle.dump(curr_concat_dict, f)
-
-        # Update the main dictionary with the current year's data
-        for key in curr_concat_dict:
-            concat_dict[key] = curr_concat_dict[key]
-
-    return concat_dict
+# Unifier datasets for each Truth & Deception source, in concatenation order
+truth_deception_datasets = {
+    "10kq": "deception_and_truth_10kq_quarterly",
+    "mdna": "deception_and_truth_mdna_quarterly",
+    "call transcripts": "deception_and_truth_call_transcripts_quarterly",
+}
 
 
 def filter_truth_deception_data(BacktestSetting):
@@ -78,24 +28,33 @@ def filter_truth_deception_data(BacktestSetting):
     """
     print(">>> Filtering truth and deception data ......")
 
-    # Load the data for the specified fiscal years
-    truth_deception_data = get_truth_deception_data(
-        BacktestSetting.fiscal_start_year, BacktestSetting.fiscal_end_year
+    # Migrate legacy pickles of fiscal years the partitioned store does not hold yet, then stream
+    # the years that are still missing straight into it
+    fiscal_years = set(range(BacktestSetting.fiscal_start_year, BacktestSetting.fiscal_end_year + 1))
+    for curr_year in sorted(fiscal_years - stored_years([BacktestSetting.source])):
+        filepath = pickle_glob.replace('*', str(curr_year))
+        if os.path.exists(filepath):
+            migrate_pickles(filepath)
+    missing_years = sorted(fiscal_years - stored_years([BacktestSetting.source]))
+    if missing_years:
+        fetch_years_to_store(missing_years, truth_deception_datasets)
+
+    # Read only the requested source, primary index, years and score column
+    df = read_truth_deception_data(
+        BacktestSetting.source, BacktestSetting.primaryindex,
+        BacktestSetting.fiscal_start_year, BacktestSetting.fiscal_end_year,
+        BacktestSetting.score
     )
 
-    # Combine data from all quarters into a single DataFrame
-    df = pd.concat(list(truth_deception_data.values()), axis=0)
-    df = df[df.source == BacktestSetting.source]
-
     # Extract Fiscal Year and Filing Year from the data
-    df['FiscalYear'] = df['fiscalperiod'].apply(lambda x: int(x.split('_')[1]))
+    df['FiscalYear'] = df['fiscalperiod'].astype(str).str.split('_').str[1].astype(int)
     df['FilingYear'] = pd.to_datetime(df['filingdate']).dt.year
 
     # Step 1: Exclude all records for any Fiscal Year prior to 2008
     if BacktestSetting.source == 'call transcripts':
-        df['scorepublishedyear'] = df['date'].apply(lambda x: int(x.split('-')[0]))
+        df['scorepublishedyear'] = pd.to_datetime(df['date']).dt.year
     else:
-        df['scorepublishedyear'] = df['scorepublisheddate'].apply(lambda x: int(x.split('-')[0]))
+        df['scorepublishedyear'] = pd.to_datetime(df['scorepublisheddate']).dt.year
     df = df[df['scorepublishedyear'] >= 2008]
     df = df[df['FiscalYear'] >= 2007]
 
@@ -113,6 +72,7 @@ def filter_truth_deception_data(BacktestSetting):
 
     # Pivot the data to have tickers as columns and dates as the index
     truth_deception_df.date = pd.to_datetime(truth_deception_df.date)
+    truth_deception_df.ticker = truth_deception_df.ticker.astype(str)
     truth_deception_df = truth_deception_df.pivot_table(
         index="date", columns="ticker", values=[BacktestSetting.score], aggfunc="mean"
     )
@@ -121,10 +81,18 @@ def filter_truth_deception_data(BacktestSetting):
     return truth_deception_df
 
 
-def load_score(bundle, BacktestSetting):
+def load_score(bundle, BacktestSetting, bundle_name='quandl_custom_bundle'):
     """
     Filter scores by tickers that have complete OHLCV data in the specified bundle.
+    Results are cached on disk, keyed by the relevant settings, the bundle ingestion timestamp and
+    the last content change of the Truth & Deception store.
     """
+    ingestion = f'{bundle_ingestion(bundle_name)}|{store_version()}'
+    cached = load_cached_score(bundle, BacktestSetting, ingestion)
+    if cached is not None:
+        print('>>> Loaded scores from cache')
+        return cached
+
     scores = filter_truth_deception_data(BacktestSetting)
     tickers = scores.columns.unique().tolist()
     print(f'Total number of tickers for {BacktestSetting.primaryindex} is {len(tickers)}')
@@ -154,7 +122,10 @@ def load_score(bundle, BacktestSetting):
     filtered_scores = scores[found_tickers]
 
     # Rename columns with asset IDs and localize to UTC timezone
-    return (filtered_scores.rename(columns=ticker_map).tz_localize('UTC')), found_assets
+    filtered_scores = filtered_scores.rename(columns=ticker_map).tz_localize('UTC')
+    save_cached_score(filtered_scores, found_assets, BacktestSetting, ingestion)
+
+    return filtered_scores, found_assets
 
 
 def save_backtest_setting(settings, directory):
@@ -221,4 +192,25 @@ def get_sp500_etf_data(start_date, end_date):
 
     spy['Return'] = spy['Close'].pct_change()
     spy = spy.tz_localize('UTC')
-    return spy['Return']
\ No newline at end of file
+    return spy['Return']
+
+
+benchmark_loaders = {
+    "S&P 500": get_sp500_etf_data,
+    "Russell 2000": get_russell2000_data,
+    "Russell 1000": get_russell1000_data,
+}
+
+# Benchmark returns already read by this process, by primary index
+_benchmarks = {}
+
+
+def load_benchmark(primaryindex, start_date="2007-01-01", end_date=None):
+    """
+    Return the benchmark returns for a primary index, reading its CSV once per process.
+    The loaders return the whole stored series whatever the dates, so one read serves every run;
+    the dates only bound the first download.
+    """
+    if primaryindex not in _benchmarks:
+        _benchmarks[primaryindex] = benchmark_loaders[primaryindex](start_date, end_date)
+    return _benchmarks[primaryindex]